@@ -1,15 +1,26 @@
-import re
 import os
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, abort
+from werkzeug.utils import secure_filename
+from ignore_rules import IgnoreRules
+from comparison_jobs import ComparisonJobs, QueueFull, is_job_id
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DIFF_FOLDER'] = 'diffs'
+app.config['COMPARE_WORKERS'] = int(os.environ.get('COMPARE_WORKERS', os.cpu_count() or 1))
+app.config['MAX_PENDING_JOBS'] = int(os.environ.get('MAX_PENDING_JOBS', 32))
 
-# Ensure the upload and diff folders exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Ensure the diff folder exists
 os.makedirs(app.config['DIFF_FOLDER'], exist_ok=True)
 
+# Comparisons run on a bounded process pool so large configs never block a
+# request thread. Each job keeps its uploads, status and result in its own
+# directory, so concurrent users no longer overwrite each other's configdiff.txt.
+# Parsed configs are cached by content and the ignore rules compiled once per worker.
+jobs = ComparisonJobs(os.path.join(app.config['DIFF_FOLDER'], 'jobs'),
+                      workers=app.config['COMPARE_WORKERS'],
+                      max_pending=app.config['MAX_PENDING_JOBS'],
+                      ignore_rules=IgnoreRules.from_file())
+
 # Define a route to render the upload.html file
 @app.route('/')
 def home():
@@ -27,136 +38,48 @@ def upload_files():
     if file1.filename == '' or file2.filename == '':
         return redirect(request.url)
 
-    file1_path = os.path.join(app.config['UPLOAD_FOLDER'], file1.filename)
-    file2_path = os.path.join(app.config['UPLOAD_FOLDER'], file2.filename)
-
-    file1.save(file1_path)
-    file2.save(file2_path)
-
-    # Process the uploaded files and generate the difference file
-    config1_lines = read_config_file(file1_path)
-    config2_lines = read_config_file(file2_path)
-
-    config1 = parse_config(config1_lines)
-    config2 = parse_config(config2_lines)
-
-    config1_name = "_".join(os.path.splitext(os.path.basename(file1_path))[0].split("_")[:2])
-    config2_name = "_".join(os.path.splitext(os.path.basename(file2_path))[0].split("_")[:2])
-
-    ignore_keys = ['hostname', 'set-date', 'set password', 'set passphrase', 'set psksecret', 'set secret',
-                   'set secondary-secret', 'set passphrase ENC', 'set psksecret ENC', 'set secret ENC',
-                   'set secondary-secret ENC']
-
-    differences = compare_configs(config1, config2, config1_name, config2_name, ignore_keys)
-
-    diff_file = os.path.join(app.config['DIFF_FOLDER'], 'configdiff.txt')
-    write_differences_to_file(differences, diff_file)
-
-    return render_template('result.html', diff_file='configdiff.txt')
-
-# Define a route to download the difference file
-@app.route('/download/<filename>')
-def download_file(filename):
-    return send_from_directory(app.config['DIFF_FOLDER'], filename)
-
-# Function to read configuration file
-def read_config_file(file_path):
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-
-    with open(file_path, 'r') as file:
-        return file.read().splitlines()
-
-# Function to parse configuration file
-def parse_config(lines):
-    config = {}
-    current_section = None
-    current_subsection = None
-    skip_public_key = False
-
-    for line in lines:
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
+    # Save both uploads into the job's directory; the two files are kept apart
+    # so uploading two files with the same name still works
+    def save(job_dir):
+        paths = []
+        for index, upload in enumerate((file1, file2), 1):
+            upload_dir = os.path.join(job_dir, f'file{index}')
+            os.makedirs(upload_dir)
+            path = os.path.join(upload_dir, secure_filename(upload.filename) or f'config{index}.conf')
+            upload.save(path)
+            paths.append(path)
+        return paths
 
-        if line.startswith('config '):
-            current_section = line[7:]
-            config[current_section] = {}
-            current_subsection = None
-        elif current_section is not None:
-            # Handle subsections or other configurations here
-            pass
-
-    return config
-
-# Function to compare configurations
-def compare_configs(config1, config2, filename1, filename2, ignore_keys=None):
-    differences = []
-
-    # Convert ignore_keys to a set for faster lookup
-    ignore_keys = set(ignore_keys or [])
-
-    # Compare sections
-    all_sections = set(config1.keys()).union(config2.keys())
-    for section in all_sections:
-        if section not in config1:
-            differences.append(f"Section '{section}' found in {filename2} but not in {filename1}")
-            continue
-        if section not in config2:
-            differences.append(f"Section '{section}' found in {filename1} but not in {filename2}")
-            continue
-
-        # Compare keys within the section
-        all_keys = set(config1[section].keys()).union(config2[section].keys())
-        for key in all_keys:
-            if key in ignore_keys:
-                continue
-            if key not in config1[section]:
-                differences.append(f"Key '{key}' in section '{section}' found in {filename2} but not in {filename1}")
-                continue
-            if key not in config2[section]:
-                differences.append(f"Key '{key}' in section '{section}' found in {filename1} but not in {filename2}")
-                continue
-            if config1[section][key] != config2[section][key]:
-                differences.append(f"Key '{key}' in section '{section}' differs between {filename1} and {filename2}")
-
-    return differences
-
-# Function to write differences to a file
-def write_differences_to_file(differences, output_file):
-    with open(output_file, 'w') as file:
-        for difference in differences:
-            file.write(difference + '\n')
-
-def main():
     try:
-        config1_path = 'path_to_config1'
-        config2_path = 'path_to_config2'
-
-        config1 = read_config_file(config1_path)
-        config2 = read_config_file(config2_path)
-
-        config1_name = "_".join(os.path.splitext(os.path.basename(config1_path))[0].split("_")[:2])
-        config2_name = "_".join(os.path.splitext(os.path.basename(config2_path))[0].split("_")[:2])
-
-        ignore_keys = ['hostname', 'set-date', 'set password', 'set passphrase', 'set psksecret', 'set secret',
-                       'set secondary-secret', 'set passphrase ENC', 'set psksecret ENC', 'set secret ENC',
-                       'set secondary-secret ENC']
-
-        differences = compare(config, config2, config1_name, config2_name, ignore_keys)
-
-        output_file = "configdiff.txt"
-        write_differences_to_file(differences, output_file)
-        print(f"Differences written to {output_file}")
-
-    except FileNotFoundError as e:
-        print(e)
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        import traceback
-        print("Traceback:")
-        print(traceback.format_exc())
+        job_id = jobs.submit(save)
+    except QueueFull:
+        return "Too many comparisons are running, please try again shortly.", 503
+
+    return redirect(url_for('job_page', job_id=job_id))
+
+# Define a route showing a job's progress until its result is ready
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    if jobs.status(job_id) is None:
+        abort(404)
+    return render_template('result.html', job_id=job_id)
+
+# Define a route returning a job's status as JSON for polling
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if status.get('diff_file'):
+        status['download_url'] = url_for('download_file', job_id=job_id, filename=status['diff_file'])
+    return jsonify(status)
+
+# Define a route to download a job's difference file
+@app.route('/download/<job_id>/<filename>')
+def download_file(job_id, filename):
+    if not is_job_id(job_id):
+        abort(404)
+    return send_from_directory(jobs.job_dir(job_id), filename, as_attachment=True)
 
 if __name__ == "__main__":
-    main()
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
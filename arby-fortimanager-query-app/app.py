@@ -1,16 +1,24 @@
 import os
-from flask import Flask, jsonify, request, render_template_string, redirect, url_for
+from flask import Flask, jsonify, request, render_template, redirect, url_for
 import requests
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
-from config import FMGR_URL, DB_NAME, LOG_LEVEL, LOG_FILE, DEBUG, HOST, PORT, SSL_VERIFY, FMGR_USERNAME, FMGR_PASSWORD
+import time
+import itertools
+from config import FMGR_URL, DB_NAME, LOG_LEVEL, LOG_FILE, DEBUG, HOST, PORT, SSL_VERIFY, FMGR_USERNAME, FMGR_PASSWORD, FETCH_CONCURRENCY, FETCH_BATCH_SIZE, REQUEST_TIMEOUT, STATIC_MAX_AGE, REFRESH_INTERVAL, DIAGNOSTIC_CACHE_TTL
+# The client, storage, exports and refresh worker come from the fortimanager_common
+# package at the top of the repository; setup.sh and setup.bat install it
+from fortimanager_common.fortimanager_client import FortiManagerClient, Query
+from fortimanager_common.storage import Storage, interface_row, EXPORTS
+from fortimanager_common.refresh_worker import RefreshWorker
+from fortimanager_common.exports import write_xlsx
 import traceback
 import logging
 from logging.handlers import RotatingFileHandler
 import sys
 from io import StringIO
 from dotenv import load_dotenv
-from openpyxl import Workbook
 from flask import send_file
 # Load environment variables FIRST
 load_dotenv()
@@ -50,443 +58,325 @@ if not SSL_VERIFY:
     logger.warning("SSL verification is disabled. This is not recommended for production use.")
 
 app = Flask(__name__)
-def export_to_excel():
-    """Export VLAN 10 IPs to an Excel file."""
-    logger.info("Exporting VLAN 10 IPs to Excel")
+
+# Pages are rendered from the templates directory. Jinja keeps every compiled
+# template in its cache, so compiling them all once here means requests only
+# pay for running them.
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
+# The stylesheet only changes with a new release, so browsers may cache it
+@app.after_request
+def cache_static_files(response):
+    if request.endpoint == 'static':
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+    return response
+def export_to_excel(export="vlan10_ips"):
+    """Export VLAN 10 IPs, or the whole interface inventory, to an Excel file.
+
+    Rows are streamed from a SQLite cursor into a write_only workbook saved
+    to a temporary file of this request's own, which is deleted once the
+    download has been sent.
+    """
+    logger.info(f"Exporting {export} to Excel")
+    if export not in EXPORTS:
+        return f"Unknown export: {export}", 400
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT device_name, ip_address FROM vlan10_ips")
-        rows = c.fetchall()
-        conn.close()
-
-        if not rows:
-            logger.warning("No VLAN 10 IPs found to export")
-            return "No VLAN 10 IPs found to export", 404
-
-        # Create an Excel workbook and sheet
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "VLAN 10 IPs"
-
-        # Add headers
-        ws.append(["Device Name", "IP Address"])
-
-        # Add data rows
-        for row in rows:
-            ws.append([row["device_name"], row["ip_address"]])
-
-        # Save the workbook to a file
-        file_path = "vlan10_ips.xlsx"
-        wb.save(file_path)
-        logger.info(f"VLAN 10 IPs exported to {file_path}")
-
-        return send_file(file_path, as_attachment=True)
+        row_chunks = storage.export_rows(export)
+        first_chunk = next(row_chunks, None)
+
+        if first_chunk is None:
+            logger.warning("No rows found to export")
+            return "No data available to export. Please fetch IPs first.", 404
+
+        file = write_xlsx(EXPORTS[export][0], itertools.chain([first_chunk], row_chunks), export)
+        logger.info(f"{export} exported to Excel")
+
+        return send_file(file, as_attachment=True, download_name=f"{export}.xlsx",
+                         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"), 200
     except sqlite3.Error as e:
         logger.error(f"Database error in export_to_excel: {str(e)}")
         return f"Database error: {str(e)}", 500
     except Exception as e:
         logger.error(f"Unexpected error in export_to_excel: {str(e)}")
         return f"Unexpected error: {str(e)}", 500
-# Global variable to store the session token
-session_token = None
-
-def get_session_token():
-    """Obtain a session token from FortiManager."""
-    global session_token
-    logger.info("Obtaining session token from FortiManager")
-    login_payload = {
-        "id": 1,
-        "method": "exec",
-        "params": [
-            {
-                "data": {
-                    "user": FMGR_USERNAME,
-                    "passwd": FMGR_PASSWORD
-                },
-                "url": "/sys/login/user"
-            }
-        ]
-    }
-    try:
-        response = requests.post(FMGR_URL, json=login_payload, verify=SSL_VERIFY)
-        response.raise_for_status()
-        json_response = response.json()
-        if 'session' in json_response:
-            session_token = json_response['session']
-            logger.info("Session token obtained successfully")
-            return session_token
-        else:
-            logger.error("Failed to obtain session token")
-            return None
-    except Exception as e:
-        logger.error(f"Error obtaining session token: {str(e)}")
-        return None
+# Shared FortiManager client: one pooled keep-alive session for every route,
+# logged in on first use and again automatically when the session expires.
+# The diagnostic pages answer from its response cache for DIAGNOSTIC_CACHE_TTL seconds.
+client = FortiManagerClient(FMGR_URL, FMGR_USERNAME, FMGR_PASSWORD, verify=SSL_VERIFY,
+                            timeout=REQUEST_TIMEOUT, pool_size=FETCH_CONCURRENCY,
+                            cache_ttl=DIAGNOSTIC_CACHE_TTL)
 
-def refresh_session_token():
-    """Refresh the session token if it has expired."""
-    global session_token
-    session_token = get_session_token()
-    if session_token is None:
-        raise Exception("Failed to refresh session token")
+# SQLite storage: one cached connection per thread, in WAL mode so reads
+# from /get_ips are not blocked by a running refresh
+storage = Storage(DB_NAME)
 
 # Database setup
 def get_db_connection():
-    """Create and return a database connection."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Return this thread's database connection."""
+    return storage.connection()
 
 def init_db():
-    """Initialize the database by creating the necessary table."""
+    """Initialize the database by creating the necessary tables and indexes."""
     logger.info("Initializing database")
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-              CREATE TABLE IF NOT EXISTS vlan10_ips
-              (id INTEGER PRIMARY KEY, device_name TEXT, ip_address TEXT)
-              ''')
-    conn.commit()
-    conn.close()
+    storage.init()
     logger.info("Database initialized")
 
-# Function to fetch VLAN 10 IPs from FortiManager
-def fetch_vlan_10_ips():
-    """Fetch VLAN 10 IPs from FortiManager and store them in the database."""
-    logger.info("Fetching VLAN 10 IPs from FortiManager")
+# Split a list into consecutive chunks of at most `size` items
+def chunked(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+# Diagnostic pages serve cached FortiManager responses unless ?refresh=1 is given
+def force_refresh():
+    return request.args.get('refresh') == '1'
+
+# Function to describe how old a cached response is, for the diagnostic pages
+def cache_age(fetched_at):
+    return f"{int(time.time() - fetched_at)}s ago"
+
+# Interface attributes kept in the inventory
+INTERFACE_FIELDS = ("name", "vlanid", "ip", "type", "status")
+
+# Query for all of a device's interfaces. FortiManager applies the column list
+# itself, so only the columns kept in the inventory come back.
+def interface_query(device_name):
+    return (Query(f"/pm/config/device/{device_name}/global/system/interface")
+            .fields(*INTERFACE_FIELDS)
+            .loadsub(False))
+
+# Function to fetch the interfaces of a batch of devices in one call
+def fetch_interfaces_batch(device_names):
+    """Return (interfaces, errors) for a batch of devices, keyed by device name.
+
+    If the batched call itself fails, its devices are retried one per call.
+    """
+    queries = [interface_query(device_name) for device_name in device_names]
+    interfaces = {}
+    errors = {}
+    try:
+        results = client.batch_get(queries)
+    except Exception as e:
+        if len(device_names) == 1:
+            return interfaces, {device_names[0]: str(e)}
+        # One slow or unreachable device can fail the whole call, so ask for
+        # each device on its own and report only the ones that really fail
+        logger.warning(f"Batch of {len(device_names)} devices failed ({str(e)}), retrying them one at a time")
+        for device_name in device_names:
+            device_interfaces, device_errors = fetch_interfaces_batch([device_name])
+            interfaces.update(device_interfaces)
+            errors.update(device_errors)
+        return interfaces, errors
+    for device_name, result in zip(device_names, results):
+        status = result.get("status", {})
+        if status.get("code", 0) != 0:
+            errors[device_name] = f"API error: {status.get('message')}"
+        else:
+            interfaces[device_name] = result.get("data") or []
+    return interfaces, errors
+
+# Function to fetch the interfaces of many devices concurrently
+def fetch_all_device_interfaces(device_names):
+    """Fetch interfaces for many devices in batches on a bounded thread pool.
+
+    Devices are packed FETCH_BATCH_SIZE to a JSON-RPC call and at most
+    FETCH_CONCURRENCY calls are in flight at once. Returns (interfaces,
+    errors), both keyed by device name; a device that fails or times out is
+    recorded in errors without affecting the others.
+    """
+    interfaces = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        futures = [executor.submit(fetch_interfaces_batch, batch)
+                   for batch in chunked(device_names, FETCH_BATCH_SIZE)]
+        for future in as_completed(futures):
+            batch_interfaces, batch_errors = future.result()
+            interfaces.update(batch_interfaces)
+            errors.update(batch_errors)
+    for device_name, error in errors.items():
+        logger.error(f"Error fetching interfaces for device {device_name}: {error}")
+    logger.info(f"Fetched interfaces for {len(interfaces)} devices, {len(errors)} failed")
+    return interfaces, errors
+
+# /dvmdb/device attribute holding the checksum of a device's configuration.
+# Sync and modification status fields can read the same before and after a
+# change, so they are not used to decide whether a device changed.
+REVISION_FIELD = "checksum"
+
+# Function to read a device's config revision
+def device_revision(device):
+    """Return a device's config checksum as a string, or None if FortiManager reported none.
+
+    A device without one is fetched in full on every refresh.
+    """
+    value = device.get(REVISION_FIELD)
+    if value is None or value == "":
+        return None
+    return str(value)
+
+# Function to pick the devices that need their interfaces fetched again
+def plan_sync(revisions, known_revisions, full=False):
+    """Return (changed, removed) device names from current and stored revisions.
+
+    A device is changed if it is new, its revision differs from the stored one
+    or its revision is unknown; removed devices are no longer in FortiManager.
+    """
+    changed = [device_name for device_name, revision in revisions.items()
+               if full or revision is None or known_revisions.get(device_name) != revision]
+    removed = [device_name for device_name in known_revisions if device_name not in revisions]
+    return changed, removed
+
+# Function to refresh the interface inventory from FortiManager
+def refresh_inventory(full=False):
+    """Fetch every device's interfaces from FortiManager and store them in the inventory.
+
+    Only devices whose config revision changed since the last refresh are
+    queried again, unless `full` is set. The VLAN 10 list is a view of the
+    inventory, so it is refreshed in the same sweep.
+    """
+    logger.info("Refreshing the interface inventory from FortiManager")
     try:
-        session_token = get_session_token()
-        if not session_token:
-            return "Failed to obtain session token", 500
-
         # Query for FortiGate devices
-        query_payload = {
-            "method": "get",
-            "params": [
-                {
-                    "url": "/dvmdb/device"
-                }
-            ],
-            "session": session_token
-        }
-
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        response_data = response.json()
-        print(response_data)  # Temporary print statement to inspect the response structure
-
-        if response.status_code != 200 or response_data.get("result")[0].get("status").get("code") != 0:
-            if response_data.get("error", {}).get("message") == "Invalid session":
-                logger.info("Session token expired, refreshing token")
-                session_token = refresh_session_token()
-                query_payload["session"] = session_token
-                response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-                response_data = response.json()
+        response_data = client.call("get", [Query("/dvmdb/device").fields("name", REVISION_FIELD).build()])
+        status = response_data.get("result", [{}])[0].get("status", {})
+        if status.get("code") != 0:
+            logger.error(f"API error: {status.get('message')}")
+            return f"API error: {status.get('message')}", 500
 
         devices = response_data.get("result")[0].get("data", [])
-        vlan_10_ips = []
-
-        for device in devices:
-            device_name = device.get("name")
-            logger.info(f"Querying interfaces for device: {device_name}")
-            dev_query_payload = {
-                "method": "get",
-                "params": [
-                    {
-                        "url": f"/pm/config/device/{device_name}/global/system/interface"
-                    }
-                ],
-                "session": session_token
-            }
-            response = requests.post(FMGR_URL, json=dev_query_payload, verify=SSL_VERIFY)
-            interfaces = response.json().get("result")[0].get("data", [])
-            for interface in interfaces:
-                if interface.get("vlanid") == 10:
-                    ip_address = interface.get("ip")
-                    vlan_10_ips.append((device_name, ip_address))
-
-        if not vlan_10_ips:
-            logger.warning("No VLAN 10 IPs found for any device")
-            return "No VLAN 10 IPs found", 404
-
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("DELETE FROM vlan10_ips")
-        c.executemany("INSERT INTO vlan10_ips (device_name, ip_address) VALUES (?, ?)", vlan_10_ips)
-        conn.commit()
-        conn.close()
-        logger.info(f"VLAN 10 IPs stored in database: {vlan_10_ips}")
-
-        return "VLAN 10 IPs fetched and stored successfully", 200
+        revisions = {device.get("name"): device_revision(device) for device in devices}
+        changed, removed = plan_sync(revisions, storage.device_revisions(), full)
+        logger.info(f"{len(changed)} of {len(revisions)} devices changed since the last refresh, {len(removed)} removed")
+        device_interfaces, errors = fetch_all_device_interfaces(changed)
+        interfaces = [interface_row(device_name, interface)
+                      for device_name, device_rows in device_interfaces.items()
+                      for interface in device_rows]
+
+        storage.replace_devices(interfaces, list(device_interfaces), revisions, removed)
+        logger.info(f"{len(interfaces)} interfaces stored in database")
+
+        unchanged = len(revisions) - len(changed)
+        return (f"Interfaces fetched and stored successfully. Refreshed {len(device_interfaces)} devices "
+                f"({unchanged} unchanged, {len(removed)} removed, {len(errors)} failed) "
+                f"with {len(interfaces)} interfaces."), 200
     except requests.RequestException as e:
-        logger.error(f"Request error in fetch_vlan_10_ips: {str(e)}")
+        logger.error(f"Request error in refresh_inventory: {str(e)}")
         return f"Request error: {str(e)}", 500
     except sqlite3.Error as e:
-        logger.error(f"Database error in fetch_vlan_10_ips: {str(e)}")
+        logger.error(f"Database error in refresh_inventory: {str(e)}")
         return f"Database error: {str(e)}", 500
     except Exception as e:
-        logger.error(f"Unexpected error in fetch_vlan_10_ips: {str(e)}")
+        logger.error(f"Unexpected error in refresh_inventory: {str(e)}")
         return f"Unexpected error: {str(e)}", 500
 
+# Background refreshes: on demand from /fetch_ips and, if REFRESH_INTERVAL is
+# set, periodically. Reads keep serving the last stored snapshot meanwhile.
+refresher = RefreshWorker(refresh_inventory, interval=REFRESH_INTERVAL)
+
 @app.route('/')
 def index():
     """Render the index page with buttons to fetch, retrieve, and export IPs."""
     logger.info("Received request to /")
     ssl_warning = "WARNING: SSL verification is disabled. This is not recommended for production use." if not SSL_VERIFY else ""
-    return render_template_string("""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-        <title>Arbys FortiManager Query App</title>
-        <link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-    </head>
-    <body>
-    <div class="container mt-5">
-        <h1 class="mb-4">Arbys FortiManager Query App</h1>
-        <p class="text-danger font-weight-bold">{{ ssl_warning }}</p>
-        <form action="{{ url_for('fetch_ips') }}" method="post" class="mb-3">
-            <button type="submit" class="btn btn-primary">Fetch VLAN 10 IPs</button>
-        </form>
-        <form action="{{ url_for('get_ips') }}" method="get" class="mb-3">
-            <button type="submit" class="btn btn-secondary">Retrieve VLAN 10 IPs</button>
-        </form>
-        <form action="{{ url_for('export_ips') }}" method="get" class="mb-3">
-            <button type="submit" class="btn btn-success">Export VLAN 10 IPs to Excel</button>
-        </form>
-        <a href="{{ url_for('debug_api') }}" class="btn btn-link">Debug API Response</a>
-        <a href="{{ url_for('debug_api_full') }}" class="btn btn-link">Debug API Response (Full)</a>
-        <a href="{{ url_for('test_endpoints') }}" class="btn btn-link">Test API Endpoints</a>
-        <a href="{{ url_for('check_token') }}" class="btn btn-link">Check Session Token</a>
-        <a href="{{ url_for('user_info') }}" class="btn btn-link">Get User Info</a>
-    </div>
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.4/dist/umd/popper.min.js"></script>
-    <script src="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js"></script>
-    </body>
-    </html>
-    """, ssl_warning=ssl_warning)
+    return render_template('index.html', ssl_warning=ssl_warning)
 @app.route('/export_ips', methods=['GET'])
 def export_ips():
-    """Endpoint to export VLAN 10 IPs to an Excel file."""
+    """Endpoint to export VLAN 10 IPs, or all interfaces with ?export=interfaces, to an Excel file."""
     logger.info("Received request to /export_ips")
-    message, status = export_to_excel()
+    message, status = export_to_excel(request.args.get('export', 'vlan10_ips'))
     if status == 200:
         return message
     else:
-        return render_template_string("""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-            <title>Export VLAN 10 IPs Result</title>
-            <link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-        </head>
-        <body>
-        <div class="container mt-5">
-            <h1 class="mb-4">Export VLAN 10 IPs Result</h1>
-            <p>{{ message }}</p>
-            <a href="{{ url_for('index') }}" class="btn btn-primary">Back to Home</a>
-        </div>
-        <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-        <script src="https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.4/dist/umd/popper.min.js"></script>
-        <script src="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js"></script>
-        </body>
-        </html>
-        """, message=message)
-@app.route('/fetch_ips', methods=['GET'])
+        return render_template('message.html', heading='Export VLAN 10 IPs Result', message=message), status
+@app.route('/fetch_ips', methods=['POST'])
 def fetch_ips():
-    """Endpoint to fetch IPs for VLAN 10."""
+    """Endpoint to start a background refresh of the interface inventory from FortiManager."""
     logger.info("Received request to /fetch_ips")
-    
-    vlan_id = 10
+    if refresher.request(full=request.form.get('full') == '1'):
+        message = "Refresh started in the background. The stored VLAN 10 IPs stay available until it finishes."
+    else:
+        message = "A refresh is already running."
+    return render_template('message.html', heading='Fetch VLAN 10 IPs Result', message=message,
+                           status_url=url_for('refresh_status')), 202
+
+@app.route('/refresh_status', methods=['GET'])
+def refresh_status():
+    """Endpoint reporting the background refresh and when the stored snapshot was taken."""
     try:
-        session_token = login_to_fortimanager()
-        query_payload = {
-            "method": "get",
-            "params": [
-                {
-                    "url": f"/pm/config/device/{dev_name}/global/system/interface"
-                }
-            ],
-            "session": session_token,
-            "id": 1
-        }
-        
-        logger.info(f"Sending request to FortiManager: {FMGR_URL}")
-        logger.info(f"Request payload: {json.dumps(query_payload, indent=2)}")
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {json.dumps(dict(response.headers), indent=2)}")
-        
-        json_response = response.json()
-        logger.info(f"User info response: {json.dumps(json_response, indent=2)}")
-        # Check if VLAN 10 IPs are found
-        if not json_response.get('result'):
-            logger.warning("No VLAN 10 IPs found for any device")
-            return render_template_string("""
-            <h1>No VLAN 10 IPs Found</h1>
-            <p>No IPs were found for VLAN 10 on any device.</p>
-            <a href="{{ url_for('index') }}">Back to Home</a>
-            """), 404
-
-        return render_template_string("""
-        <h1>Current User Information</h1>
-        <pre>{{ response }}</pre>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, response=json.dumps(json_response, indent=2))
-    except Exception as e:
-        logger.error(f"Error in user_info: {str(e)}")
-        return render_template_string("""
-        <h1>User Info Error</h1>
-        <p>{{ error }}</p>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, error=str(e))
+        refreshed_at = storage.refreshed_at()
+    except sqlite3.Error as e:
+        logger.error(f"Database error in refresh_status: {str(e)}")
+        refreshed_at = None
+    return jsonify(dict(refresher.status(), refreshed_at=refreshed_at, interval=REFRESH_INTERVAL))
+
+@app.route('/interfaces', methods=['GET'])
+def interfaces():
+    """Endpoint to page through the interface inventory as JSON.
+
+    Filters by ?vlan=, ?subnet= and ?device=, sorts by ?sort=device|ip and
+    ?order=asc|desc, and returns {"items": [...], "next": cursor}. Pass the
+    cursor back as ?after= for the next page; it is null on the last page.
+    Also reports when the stored snapshot was refreshed and whether a
+    refresh is running, since pages keep serving the old snapshot until the
+    new one is committed.
+    Pages are keyset paginated, so each costs the same however deep it is.
+    e.g. /interfaces?vlan=10&subnet=10.20.0.0/16&sort=ip&limit=100
+    """
+    logger.info(f"Received request to /interfaces with {dict(request.args)}")
+    vlanid = request.args.get('vlan', type=int)
+    if request.args.get('vlan') and vlanid is None:
+        return jsonify({"error": "vlan must be an integer"}), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    try:
+        refreshed_at = storage.refreshed_at()
+        rows, next_cursor = storage.interface_page(
+            vlanid=vlanid, subnet=request.args.get('subnet'), device_name=request.args.get('device'),
+            sort=request.args.get('sort', 'device'), descending=request.args.get('order') == 'desc',
+            after=request.args.get('after'), limit=limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except sqlite3.Error as e:
+        logger.error(f"Database error in interfaces: {str(e)}")
+        return jsonify({"error": f"Database error: {str(e)}"}), 500
+    return jsonify({"items": [dict(row) for row in rows], "next": next_cursor,
+                    "refreshed_at": refreshed_at, "refreshing": refresher.is_running()})
 
 @app.route('/get_ips', methods=['GET'])
 def get_ips():
-    """Endpoint to retrieve VLAN 10 IPs from the database."""
+    """Endpoint to browse VLAN 10 IPs from the database.
+
+    The page loads rows on demand from /interfaces, one keyset-paginated page
+    at a time, so it renders quickly however many devices are stored.
+    """
     logger.info("Received request to /get_ips")
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM vlan10_ips")
-        rows = c.fetchall()
-        conn.close()
-        return render_template_string("""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-            <title>VLAN 10 IPs</title>
-            <link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-        </head>
-        <body>
-        <div class="container mt-5">
-            <h1 class="mb-4">VLAN 10 IPs</h1>
-            <table class="table table-striped">
-                <thead>
-                    <tr>
-                        <th>ID</th>
-                        <th>Device Name</th>
-                        <th>IP Address</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {% for row in rows %}
-                    <tr>
-                        <td>{{ row.id }}</td>
-                        <td>{{ row.device_name }}</td>
-                        <td>{{ row.ip_address }}</td>
-                    </tr>
-                    {% endfor %}
-                </tbody>
-            </table>
-            <a href="{{ url_for('index') }}" class="btn btn-primary">Back to Home</a>
-        </div>
-        <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-        <script src="https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.4/dist/umd/popper.min.js"></script>
-        <script src="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js"></script>
-        </body>
-        </html>
-        """, rows=rows)
-    except sqlite3.Error as e:
-        logger.error(f"Database error in get_ips: {str(e)}")
-        return render_template_string("""
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-            <title>Error</title>
-            <link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-        </head>
-        <body>
-        <div class="container mt-5">
-            <h1 class="mb-4">Error</h1>
-            <p class="text-danger">Database error: {{ error }}</p>
-            <a href="{{ url_for('index') }}" class="btn btn-primary">Back to Home</a>
-        </div>
-        <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-        <script src="https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.4/dist/umd/popper.min.js"></script>
-        <script src="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js"></script>
-        </body>
-        </html>
-        """, error=str(e))
+    return render_template('get_ips.html')
+
 @app.route('/debug_api', methods=['GET'])
 def debug_api():
     """Endpoint to debug API response."""
     logger.info("Received request to /debug_api")
-    query_payload = {
-        "method": "get",
-        "params": [
-            {
-                "url": "/dvmdb/device"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "get"
+    params = [{"url": "/dvmdb/device"}]
     try:
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        response.raise_for_status()
-        json_response = response.json()
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"Debug API response: {json.dumps(json_response, indent=2)}")
-        return render_template_string("""
-        <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-        <title>Debug API Response</title>
-        <link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-    </head>
-    <body>
-    <div class="container mt-5">
-        <h1 class="mb-4">Debug API Response</h1>
-        <pre>{{ response }}</pre>
-        <a href="{{ url_for('index') }}" class="btn btn-primary">Back to Home</a>
-    </div>
-    <script src="https://code.jquery.com/jquery-3.5.1.slim.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/@popperjs/core@2.5.4/dist/umd/popper.min.js"></script>
-    <script src="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/js/bootstrap.min.js"></script>
-    </body>
-    </html>
-    """, response=response)
+        return render_template('response.html', heading='Debug API Response', response=json.dumps(json_response, indent=2),
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in debug_api: {str(e)}")
-        return render_template_string("""
-        <h1>Debug API Error</h1>
-        <p>{{ error }}</p>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, error=str(e))
+        return render_template('message.html', heading='Debug API Error', message=str(e))
 
 @app.route('/debug_api_full', methods=['GET'])
 def debug_api_full():
     """Endpoint to debug API response with full logs."""
     logger.info("Received request to /debug_api_full")
-    query_payload = {
-        "method": "get",
-        "params": [
-            {
-                "url": "/dvmdb/device"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "get"
+    params = [{"url": "/dvmdb/device"}]
     try:
         logger.info(f"Sending request to FortiManager: {FMGR_URL}")
-        logger.info(f"Request payload: {json.dumps(query_payload, indent=2)}")
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {json.dumps(dict(response.headers), indent=2)}")
-        logger.info(f"Response content: {response.text}")
-
-        response.raise_for_status()
-        json_response = response.json()
+        logger.info(f"Request params: {json.dumps(params, indent=2)}")
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"Parsed JSON response: {json.dumps(json_response, indent=2)}")
 
         log_contents = StringIO()
@@ -495,14 +385,8 @@ def debug_api_full():
                 log_contents = handler.stream.getvalue()
                 break
         
-        return render_template_string("""
-        <h1>Debug API Response (Full)</h1>
-        <h2>API Response:</h2>
-        <pre>{{ response }}</pre>
-        <h2>Full Logs:</h2>
-        <pre>{{ logs }}</pre>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, response=json.dumps(json_response, indent=2), logs=log_contents)
+        return render_template('response.html', heading='Debug API Response (Full)', response=json.dumps(json_response, indent=2), logs=log_contents,
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in debug_api_full: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -511,13 +395,27 @@ def debug_api_full():
             if isinstance(handler, logging.StreamHandler):
                 log_contents = handler.stream.getvalue()
                 break
-        return render_template_string("""
-        <h1>Debug API Error (Full)</h1>
-        <p>{{ error }}</p>
-        <h2>Full Logs:</h2>
-        <pre>{{ logs }}</pre>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, error=str(e), logs=log_contents)
+        return render_template('message.html', heading='Debug API Error (Full)', message=str(e), logs=log_contents)
+
+# Function to query a batch of endpoints for /test_endpoints in one call
+def probe_endpoints(urls, refresh=False):
+    try:
+        logger.info(f"Testing endpoints: {', '.join(urls)}")
+        batch_results, fetched_at = client.cached_batch_get(urls, refresh=refresh)
+    except Exception as e:
+        logger.error(f"Error testing endpoints {urls}: {str(e)}")
+        return [{"url": url, "error": str(e)} for url in urls]
+    results = []
+    for url, result in zip(urls, batch_results):
+        status = result.get('status', {})
+        results.append({
+            "url": url,
+            "status_code": status.get('code'),
+            "message": status.get('message'),
+            "response": result,
+            "fetched": cache_age(fetched_at)
+        })
+    return results
 
 @app.route('/test_endpoints', methods=['GET'])
 def test_endpoints():
@@ -535,127 +433,55 @@ def test_endpoints():
         "/sys/global"
     ]
     
+    # All endpoints are queried together, FETCH_BATCH_SIZE per JSON-RPC call, and
+    # each batch's response is cached, so repeated page loads cost no calls at all
+    refresh = force_refresh()
     results = []
-    for url in test_urls:
-        query_payload = {
-            "method": "get",
-            "params": [
-                {
-                    "url": url
-                }
-            ],
-            "session": session_token,
-            "id": 1
-        }
-        try:
-            logger.info(f"Testing endpoint: {url}")
-            response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-            response.raise_for_status()
-            json_response = response.json()
-            status = json_response.get('result', [{}])[0].get('status', {})
-            results.append({
-                "url": url,
-                "status_code": status.get('code'),
-                "message": status.get('message'),
-                "response": json_response
-            })
-        except Exception as e:
-            logger.error(f"Error testing endpoint {url}: {str(e)}")
-            results.append({
-                "url": url,
-                "error": str(e)
-            })
+    for batch in chunked(test_urls, FETCH_BATCH_SIZE):
+        results.extend(probe_endpoints(batch, refresh))
     
-    return render_template_string("""
-    <h1>FortiManager API Endpoint Test Results</h1>
-    {% for result in results %}
-    <h2>{{ result.url }}</h2>
-    {% if result.get('error') %}
-    <p>Error: {{ result.error }}</p>
-    {% else %}
-    <p>Status Code: {{ result.status_code }}</p>
-    <p>Message: {{ result.message }}</p>
-    <pre>{{ result.response | tojson(indent=2) }}</pre>
-    {% endif %}
-    <hr>
-    {% endfor %}
-    <a href="{{ url_for('index') }}">Back to Home</a>
-    """, results=results)
+    return render_template('test_endpoints.html', results=results)
 
 @app.route('/check_token', methods=['GET'])
 def check_token():
     """Endpoint to check the status of the session token."""
     logger.info("Received request to /check_token")
-    query_payload = {
-        "method": "exec",
-        "params": [
-            {
-                "url": "/sys/status"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "exec"
+    params = [{"url": "/sys/status"}]
     try:
         logger.info(f"Sending request to FortiManager: {FMGR_URL}")
-        logger.info(f"Request payload: {json.dumps(query_payload, indent=2)}")
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {json.dumps(dict(response.headers), indent=2)}")
-        logger.info(f"Response content: {response.text}")
-        response.raise_for_status()
-        json_response = response.json()
+        logger.info(f"Request params: {json.dumps(params, indent=2)}")
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"Token check response: {json.dumps(json_response, indent=2)}")
-        return render_template_string("""
-        <h1>Session Token Status</h1>
-        <pre>{{ response }}</pre>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, response=json.dumps(json_response, indent=2))
+        return render_template('response.html', heading='Session Token Status', response=json.dumps(json_response, indent=2),
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in check_token: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
-        return render_template_string("""
-        <h1>Session Token Check Error</h1>
-        <p>{{ error }}</p>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, error=str(e))
+        return render_template('message.html', heading='Session Token Check Error', message=str(e))
 
 @app.route('/user_info', methods=['GET'])
 def user_info():
     """Endpoint to retrieve current user information."""
     logger.info("Received request to /user_info")
-    query_payload = {
-        "method": "get",
-        "params": [
-            {
-                "url": "/sys/admin/user"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "get"
+    params = [{"url": "/sys/admin/user"}]
     try:
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        response.raise_for_status()
-        json_response = response.json()
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"User info response: {json.dumps(json_response, indent=2)}")
-        return render_template_string("""
-        <h1>Current User Information</h1>
-        <pre>{{ response }}</pre>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, response=json.dumps(json_response, indent=2))
+        return render_template('response.html', heading='Current User Information', response=json.dumps(json_response, indent=2),
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in user_info: {str(e)}")
-        return render_template_string("""
-        <h1>User Info Error</h1>
-        <p>{{ error }}</p>
-        <a href="{{ url_for('index') }}">Back to Home</a>
-        """, error=str(e))
+        return render_template('message.html', heading='User Info Error', message=str(e))
 
 if __name__ == '__main__':
     init_db()
-    session_token = get_session_token()
-    if session_token is None:
-        logger.error("Failed to obtain initial session token. Exiting.")
+    try:
+        client.login()
+    except Exception as e:
+        logger.error(f"Failed to obtain initial session token: {str(e)}. Exiting.")
         sys.exit(1)
+    if REFRESH_INTERVAL > 0:
+        refresher.request()
     app.run(debug=DEBUG, host=HOST, port=PORT, use_reloader=False)
@@ -46,6 +46,26 @@ logger = logging.getLogger()
 logger.setLevel(LOG_LEVEL)
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
+# Flask configuration
+DEBUG = os.getenv('DEBUG', 'False').lower() in ('true', '1', 't')
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '5000'))
+# Concurrent device queries: how many requests may be in flight at once,
+# how many devices are packed into each JSON-RPC call, and how long to wait
+# for each call (seconds)
+FETCH_CONCURRENCY = int(os.getenv('FETCH_CONCURRENCY', '16'))
+FETCH_BATCH_SIZE = int(os.getenv('FETCH_BATCH_SIZE', '20'))
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', '30'))
+
+# How long browsers may cache the stylesheet (seconds)
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', '86400'))
+
+# Seconds between background inventory refreshes; 0 refreshes only on demand
+REFRESH_INTERVAL = float(os.getenv('REFRESH_INTERVAL', '0'))
+
+# Seconds the diagnostic pages reuse a FortiManager response; 0 always asks again
+DIAGNOSTIC_CACHE_TTL = float(os.getenv('DIAGNOSTIC_CACHE_TTL', '60'))
+
 # Now load SSL_VERIFY
 SSL_VERIFY = os.getenv('SSL_VERIFY', 'False').lower() == 'true'
 # Log all environment variables (excluding any sensitive information)
@@ -51,4 +51,119 @@ def test_404_error(client):
     assert data['error'] == 'Not found'
     assert 'message' in data
 
+def test_fetch_all_device_interfaces_batches_and_isolates_failures(mocker):
+    from app import fetch_all_device_interfaces
+
+    def fake_batch_get(queries):
+        if any('/offline/' in query.url for query in queries):
+            raise Exception('timed out')
+        return [{'status': {'code': -3, 'message': 'Object does not exist'}} if '/broken/' in query.url
+                else {'status': {'code': 0}, 'data': [{'name': 'vlan10', 'vlanid': 10}]} for query in queries]
+
+    batch_get = mocker.patch('app.client.batch_get', side_effect=fake_batch_get)
+    mocker.patch('app.FETCH_BATCH_SIZE', 2)
+    interfaces, errors = fetch_all_device_interfaces(['store1', 'broken', 'store2', 'offline'])
+    # The failed batch is retried one device per call, so store2 still succeeds
+    assert batch_get.call_count == 4
+    assert sorted(interfaces) == ['store1', 'store2']
+    assert errors == {'broken': 'API error: Object does not exist', 'offline': 'timed out'}
+
+def test_plan_sync_only_refetches_changed_devices():
+    from app import plan_sync, device_revision
+    revisions = {
+        'store1': device_revision({'name': 'store1', 'checksum': 'a', 'conf_status': 1}),
+        'store2': device_revision({'name': 'store2', 'checksum': 'c', 'conf_status': 1}),
+        'store3': device_revision({'name': 'store3', 'conf_status': 1, 'db_status': 1}),
+        'store4': device_revision({'name': 'store4', 'checksum': 'd'}),
+    }
+    known = {'store1': revisions['store1'], 'store2': device_revision({'checksum': 'b', 'conf_status': 1}),
+             'store3': None, 'closed': 'x'}
+    # Status fields alone are not a revision, so store3 is fetched again every time
+    assert revisions['store3'] is None
+    changed, removed = plan_sync(revisions, known)
+    assert changed == ['store2', 'store3', 'store4']
+    assert removed == ['closed']
+    assert plan_sync(revisions, known, full=True)[0] == list(revisions)
+
+def test_refresh_inventory_removes_devices_without_a_checksum(mocker, tmp_path):
+    from app import refresh_inventory
+    from fortimanager_common.storage import Storage
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    mocker.patch('app.storage', storage)
+    mocker.patch('app.client.batch_get', side_effect=lambda queries: [
+        {'status': {'code': 0}, 'data': [{'name': 'vlan10', 'vlanid': 10, 'ip': ['10.0.0.1', '255.255.255.0']}]}
+        for query in queries])
+    call = mocker.patch('app.client.call', return_value={'result': [{'status': {'code': 0}, 'data': [
+        {'name': 'store1', 'checksum': 'a'}, {'name': 'store2'}]}]})
+    assert refresh_inventory()[1] == 200
+    assert storage.device_revisions() == {'store1': 'a', 'store2': None}
+
+    # store2 left FortiManager, so its interfaces go with it
+    call.return_value = {'result': [{'status': {'code': 0}, 'data': [{'name': 'store1', 'checksum': 'a'}]}]}
+    assert refresh_inventory()[1] == 200
+    assert [tuple(row)[1:] for row in storage.vlan_10_ips()] == [('store1', '10.0.0.1')]
+    assert storage.device_revisions() == {'store1': 'a'}
+
+def test_interfaces_endpoint_pages_with_keyset_cursors(client, mocker, tmp_path):
+    from fortimanager_common.storage import Storage, interface_row
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    rows = [interface_row(f'store{index % 7}', {'name': f'vlan{index}', 'vlanid': 10, 'ip': [f'10.0.{index}.1', '255.255.255.0']})
+            for index in range(25)]
+    storage.replace_devices(rows, [row[0] for row in rows], {}, [])
+    mocker.patch('app.storage', storage)
+
+    for sort, key in (('device', lambda row: (row[0], row[1])), ('ip', lambda row: (row[5], row[0], row[1]))):
+        for order in ('asc', 'desc'):
+            seen = []
+            after = ''
+            while True:
+                page = client.get(f'/interfaces?vlan=10&sort={sort}&order={order}&limit=10&after={after}').get_json()
+                assert len(page['items']) <= 10
+                seen += [(item['device_name'], item['name']) for item in page['items']]
+                after = page['next']
+                if after is None:
+                    break
+            expected = sorted(rows, key=key, reverse=order == 'desc')
+            assert seen == [(row[0], row[1]) for row in expected]
+
+    assert client.get('/interfaces?sort=bogus').status_code == 400
+    assert client.get('/interfaces?after=not-a-cursor').status_code == 400
+
+def test_fetch_ips_starts_a_background_refresh(client, mocker, tmp_path):
+    from fortimanager_common.storage import Storage
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    storage.replace_devices([], [], {}, [])
+    mocker.patch('app.storage', storage)
+    request = mocker.patch('app.refresher.request', return_value=True)
+    response = client.post('/fetch_ips', data={'full': '1'})
+    assert response.status_code == 202
+    request.assert_called_once_with(full=True)
+    status = client.get('/refresh_status').get_json()
+    assert status['state'] == 'idle' and status['refreshed_at'] == storage.refreshed_at()
+
+def test_diagnostic_pages_reuse_cached_responses_until_refreshed(client, mocker):
+    import app as app_module
+    mocker.patch.object(app_module.client.cache, 'ttl', 60)
+    app_module.client.cache.clear()
+    call = mocker.patch('app.client.call', side_effect=lambda method, params: {
+        'result': [{'status': {'code': 0, 'message': 'OK'}, 'url': entry['url']} for entry in params]})
+
+    response = client.get('/test_endpoints')
+    assert response.status_code == 200 and b'/sys/global' in response.data
+    # The eight endpoints fit in one batched call
+    probes = call.call_count
+    assert probes == 1 and len(call.call_args.args[1]) == 8
+    assert client.get('/test_endpoints').status_code == 200
+    assert call.call_count == probes
+    assert client.get('/test_endpoints?refresh=1').status_code == 200
+    assert call.call_count == 2 * probes
+
+    client.get('/user_info')
+    client.get('/user_info')
+    assert call.call_count == 2 * probes + 1
+    app_module.client.cache.clear()
+
 # Add more tests as needed for other routes and edge cases
\ No newline at end of file
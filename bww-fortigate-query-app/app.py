@@ -1,11 +1,19 @@
 import os
-from flask import Flask, jsonify, request, render_template_string, redirect, url_for, send_file
+from flask import Flask, jsonify, request, render_template, redirect, url_for, Response, stream_with_context
 import requests
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
-import csv
+import time
+import itertools
 from io import StringIO
-from config import FMGR_URL, DB_NAME, LOG_LEVEL, LOG_FILE, DEBUG, HOST, PORT, SSL_VERIFY, FMGR_USERNAME, FMGR_PASSWORD
+from config import FMGR_URL, DB_NAME, LOG_LEVEL, LOG_FILE, DEBUG, HOST, PORT, SSL_VERIFY, FMGR_USERNAME, FMGR_PASSWORD, FETCH_CONCURRENCY, FETCH_BATCH_SIZE, REQUEST_TIMEOUT, STATIC_MAX_AGE, REFRESH_INTERVAL, DIAGNOSTIC_CACHE_TTL
+# The client, storage, exports and refresh worker come from the fortimanager_common
+# package at the top of the repository; setup.sh and setup.bat install it
+from fortimanager_common.fortimanager_client import FortiManagerClient, Query
+from fortimanager_common.storage import Storage, interface_row, EXPORTS
+from fortimanager_common.refresh_worker import RefreshWorker
+from fortimanager_common.exports import csv_chunks
 import traceback
 import logging
 import sys
@@ -30,122 +38,178 @@ if not SSL_VERIFY:
 
 app = Flask(__name__)
 
-# Global variable to store the session token
-session_token = None
-
-def get_session_token():
-    """Obtain a session token from FortiManager."""
-    global session_token
-    logger.info("Obtaining session token from FortiManager")
-    login_payload = {
-        "id": 1,
-        "method": "exec",
-        "params": [
-            {
-                "data": {
-                    "user": FMGR_USERNAME,
-                    "passwd": FMGR_PASSWORD
-                },
-                "url": "/sys/login/user"
-            }
-        ]
-    }
-    try:
-        response = requests.post(FMGR_URL, json=login_payload, verify=SSL_VERIFY)
-        response.raise_for_status()
-        json_response = response.json()
-        if 'session' in json_response:
-            session_token = json_response['session']
-            logger.info("Session token obtained successfully")
-            return session_token
-        else:
-            logger.error("Failed to obtain session token")
-            return None
-    except Exception as e:
-        logger.error(f"Error obtaining session token: {str(e)}")
-        return None
-
-def refresh_session_token():
-    """Refresh the session token if it has expired."""
-    global session_token
-    session_token = get_session_token()
-    if session_token is None:
-        raise Exception("Failed to refresh session token")
+# Pages are rendered from the templates directory. Jinja keeps every compiled
+# template in its cache, so compiling them all once here means requests only
+# pay for running them.
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
+# The stylesheet only changes with a new release, so browsers may cache it
+@app.after_request
+def cache_static_files(response):
+    if request.endpoint == 'static':
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+    return response
+
+# Shared FortiManager client: one pooled keep-alive session for every route,
+# logged in on first use and again automatically when the session expires.
+# The diagnostic pages answer from its response cache for DIAGNOSTIC_CACHE_TTL seconds.
+client = FortiManagerClient(FMGR_URL, FMGR_USERNAME, FMGR_PASSWORD, verify=SSL_VERIFY,
+                            timeout=REQUEST_TIMEOUT, pool_size=FETCH_CONCURRENCY,
+                            cache_ttl=DIAGNOSTIC_CACHE_TTL)
+
+# SQLite storage: one cached connection per thread, in WAL mode so reads
+# from /get_ips are not blocked by a running refresh
+storage = Storage(DB_NAME)
 
 # Database setup
 def get_db_connection():
-    """Create and return a database connection with error handling."""
+    """Return this thread's database connection."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return storage.connection()
     except sqlite3.Error as e:
         logger.error(f"Error connecting to database: {str(e)}")
         raise
 
 def init_db():
-    """Initialize the database by creating the necessary table."""
+    """Initialize the database by creating the necessary tables and indexes."""
     logger.info("Initializing database")
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''
-                  CREATE TABLE IF NOT EXISTS vlan10_ips
-                  (id INTEGER PRIMARY KEY, device_name TEXT, ip_address TEXT)
-                  ''')
-        conn.commit()
+        storage.init()
         logger.info("Database initialized")
     except sqlite3.Error as e:
         logger.error(f"Error initializing database: {str(e)}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def clear_database():
-    """Clear all entries from the vlan10_ips table."""
+    """Clear all entries from the interfaces and device_revisions tables."""
     logger.info("Clearing database")
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("DELETE FROM vlan10_ips")
-        conn.commit()
+        storage.clear()
         logger.info("Database cleared successfully")
     except sqlite3.Error as e:
         logger.error(f"Error clearing database: {str(e)}")
         raise
-    finally:
-        if conn:
-            conn.close()
-
-# Function to fetch VLAN 10 IPs from FortiManager
-def fetch_vlan_10_ips():
-    """Fetch VLAN 10 IPs from FortiManager and store them in the database."""
-    global session_token
-    logger.info("Starting fetch_vlan_10_ips function")
+
+# Split a list into consecutive chunks of at most `size` items
+def chunked(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+# Diagnostic pages serve cached FortiManager responses unless ?refresh=1 is given
+def force_refresh():
+    return request.args.get('refresh') == '1'
+
+# Function to describe how old a cached response is, for the diagnostic pages
+def cache_age(fetched_at):
+    return f"{int(time.time() - fetched_at)}s ago"
+
+# Interface attributes kept in the inventory
+INTERFACE_FIELDS = ("name", "vlanid", "ip", "type", "status")
+
+# Query for all of a device's interfaces. FortiManager applies the column list
+# itself, so only the columns kept in the inventory come back.
+def interface_query(device_name):
+    return (Query(f"/pm/config/device/{device_name}/global/system/interface")
+            .fields(*INTERFACE_FIELDS)
+            .loadsub(False))
+
+# Function to fetch the interfaces of a batch of devices in one call
+def fetch_interfaces_batch(device_names):
+    """Return (interfaces, errors) for a batch of devices, keyed by device name.
+
+    If the batched call itself fails, its devices are retried one per call.
+    """
+    queries = [interface_query(device_name) for device_name in device_names]
+    interfaces = {}
+    errors = {}
+    try:
+        results = client.batch_get(queries)
+    except Exception as e:
+        if len(device_names) == 1:
+            return interfaces, {device_names[0]: str(e)}
+        # One slow or unreachable device can fail the whole call, so ask for
+        # each device on its own and report only the ones that really fail
+        logger.warning(f"Batch of {len(device_names)} devices failed ({str(e)}), retrying them one at a time")
+        for device_name in device_names:
+            device_interfaces, device_errors = fetch_interfaces_batch([device_name])
+            interfaces.update(device_interfaces)
+            errors.update(device_errors)
+        return interfaces, errors
+    for device_name, result in zip(device_names, results):
+        status = result.get("status", {})
+        if status.get("code", 0) != 0:
+            errors[device_name] = f"API error: {status.get('message')}"
+        else:
+            interfaces[device_name] = result.get("data") or []
+    return interfaces, errors
+
+# Function to fetch the interfaces of many devices concurrently
+def fetch_all_device_interfaces(device_names):
+    """Fetch interfaces for many devices in batches on a bounded thread pool.
+
+    Devices are packed FETCH_BATCH_SIZE to a JSON-RPC call and at most
+    FETCH_CONCURRENCY calls are in flight at once. Returns (interfaces,
+    errors), both keyed by device name; a device that fails or times out is
+    recorded in errors without affecting the others.
+    """
+    interfaces = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        futures = [executor.submit(fetch_interfaces_batch, batch)
+                   for batch in chunked(device_names, FETCH_BATCH_SIZE)]
+        for future in as_completed(futures):
+            batch_interfaces, batch_errors = future.result()
+            interfaces.update(batch_interfaces)
+            errors.update(batch_errors)
+    for device_name, error in errors.items():
+        logger.error(f"Error fetching interfaces for device {device_name}: {error}")
+    logger.info(f"Fetched interfaces for {len(interfaces)} devices, {len(errors)} failed")
+    return interfaces, errors
+
+# /dvmdb/device attribute holding the checksum of a device's configuration.
+# Sync and modification status fields can read the same before and after a
+# change, so they are not used to decide whether a device changed.
+REVISION_FIELD = "checksum"
+
+# Function to read a device's config revision
+def device_revision(device):
+    """Return a device's config checksum as a string, or None if FortiManager reported none.
+
+    A device without one is fetched in full on every refresh.
+    """
+    value = device.get(REVISION_FIELD)
+    if value is None or value == "":
+        return None
+    return str(value)
+
+# Function to pick the devices that need their interfaces fetched again
+def plan_sync(revisions, known_revisions, full=False):
+    """Return (changed, removed) device names from current and stored revisions.
+
+    A device is changed if it is new, its revision differs from the stored one
+    or its revision is unknown; removed devices are no longer in FortiManager.
+    """
+    changed = [device_name for device_name, revision in revisions.items()
+               if full or revision is None or known_revisions.get(device_name) != revision]
+    removed = [device_name for device_name in known_revisions if device_name not in revisions]
+    return changed, removed
+
+# Function to refresh the interface inventory from FortiManager
+def refresh_inventory(full=False):
+    """Fetch every device's interfaces from FortiManager and store them in the inventory.
+
+    Only devices whose config revision changed since the last refresh are
+    queried again, unless `full` is set. The VLAN 10 list is a view of the
+    inventory, so it is refreshed in the same sweep.
+    """
+    logger.info("Starting refresh_inventory function")
     
     try:
         # Query for FortiGate devices
-        query_payload = {
-            "method": "get",
-            "params": [
-                {
-                    "url": "/dvmdb/device"
-                }
-            ],
-            "session": session_token,
-            "id": 1
-        }
         logger.info(f"Sending request to FortiManager: {FMGR_URL}")
-        logger.info(f"Request payload: {json.dumps(query_payload, indent=2)}")
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {json.dumps(dict(response.headers), indent=2)}")
-        logger.info(f"Response content: {response.text}")
-
-        response.raise_for_status()
-        
-        json_response = response.json()
+        json_response = client.call("get", [Query("/dvmdb/device").fields("name", REVISION_FIELD).build()])
         logger.info(f"Full API response: {json.dumps(json_response, indent=2)}")
         
         # Check for API-level errors
@@ -163,56 +227,29 @@ def fetch_vlan_10_ips():
             logger.warning("No devices returned from FortiManager")
             return "No devices returned from FortiManager", 200
 
-        vlan_10_ips = {}
-        for device in devices:
-            dev_name = device['name']
-            logger.info(f"Querying interfaces for device: {dev_name}")
-            dev_query_payload = {
-                "method": "get",
-                "params": [
-                    {
-                        "url": f"/pm/config/device/{dev_name}/global/system/interface"
-                    }
-                ],
-                "session": session_token,
-                "id": 2
-            }
-            response = requests.post(FMGR_URL, json=dev_query_payload, verify=SSL_VERIFY)
-            logger.info(f"Response status code for {dev_name}: {response.status_code}")
-            logger.info(f"Response content for {dev_name}: {response.text}")
-            response.raise_for_status()
-            interfaces = response.json().get('result', [])[0].get('data', [])
-            logger.info(f"Received {len(interfaces)} interfaces for device {dev_name}")
-            for interface in interfaces:
-                if 'vlanid' in interface and interface['vlanid'] == 10:
-                    ip_address = interface.get('ip', None)
-                    if ip_address:
-                        vlan_10_ips[dev_name] = ip_address
-                        logger.info(f"Found VLAN 10 IP for device {dev_name}: {ip_address}")
-
-        logger.info(f"VLAN 10 IPs found: {vlan_10_ips}")
-
-        if not vlan_10_ips:
-            logger.warning("No VLAN 10 IPs found for any device")
-            return "No VLAN 10 IPs found for any device", 200
-
-        # Store in database
+        revisions = {device['name']: device_revision(device) for device in devices}
+        changed, removed = plan_sync(revisions, storage.device_revisions(), full)
+        logger.info(f"{len(changed)} of {len(revisions)} devices changed since the last refresh, {len(removed)} removed")
+        logger.info(f"Querying interfaces for {len(changed)} devices, {FETCH_CONCURRENCY} at a time, {FETCH_BATCH_SIZE} per call")
+        device_interfaces, errors = fetch_all_device_interfaces(changed)
+
+        interfaces = [interface_row(dev_name, interface)
+                      for dev_name, device_rows in device_interfaces.items()
+                      for interface in device_rows]
+        logger.info(f"Fetched {len(interfaces)} interfaces")
+
+        # Store in database, replacing only the rows of devices that were refreshed
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("DELETE FROM vlan10_ips")
-            for dev_name, ip in vlan_10_ips.items():
-                c.execute("INSERT INTO vlan10_ips (device_name, ip_address) VALUES (?, ?)", (dev_name, ip))
-            conn.commit()
+            storage.replace_devices(interfaces, list(device_interfaces), revisions, removed)
             logger.info("Data stored in database successfully")
         except sqlite3.Error as e:
             logger.error(f"Database error: {str(e)}")
             return f"Database error: {str(e)}", 500
-        finally:
-            if conn:
-                conn.close()
 
-        return f"Data fetched and stored successfully. Found {len(vlan_10_ips)} VLAN 10 IPs.", 200
+        unchanged = len(revisions) - len(changed)
+        return (f"Data fetched and stored successfully. Refreshed {len(device_interfaces)} devices "
+                f"({unchanged} unchanged, {len(removed)} removed, {len(errors)} failed) "
+                f"and stored {len(interfaces)} interfaces from them."), 200
     except requests.RequestException as e:
         logger.error(f"Error fetching data from FortiManager: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -226,155 +263,79 @@ def fetch_vlan_10_ips():
         logger.error(f"Traceback: {traceback.format_exc()}")
         return f"Unexpected error: {str(e)}", 500
 
-# CSS styles
-css = """
-<style>
-    body {
-        font-family: Arial, sans-serif;
-        line-height: 1.6;
-        margin: 0;
-        padding: 20px;
-        background-color: #f4f4f4;
-    }
-    h1 {
-        color: #333;
-    }
-    .container {
-        width: 80%;
-        margin: auto;
-        overflow: hidden;
-        background: #fff;
-        padding: 20px;
-        border-radius: 5px;
-        box-shadow: 0 0 10px rgba(0, 0, 0, 0.1);
-    }
-    input[type="submit"], a.button {
-        display: inline-block;
-        color: #fff;
-        background: #333;
-        padding: 10px 15px;
-        border: none;
-        border-radius: 5px;
-        cursor: pointer;
-        text-decoration: none;
-        font-size: 15px;
-    }
-    input[type="submit"]:hover, a.button:hover {
-        background: #555;
-    }
-    table {
-        width: 100%;
-        border-collapse: collapse;
-        margin-top: 20px;
-    }
-    th, td {
-        padding: 10px;
-        border: 1px solid #ddd;
-        text-align: left;
-    }
-    th {
-        background-color: #f2f2f2;
-    }
-</style>
-"""
+# Background refreshes: on demand from /fetch_ips and, if REFRESH_INTERVAL is
+# set, periodically. Reads keep serving the last stored snapshot meanwhile.
+refresher = RefreshWorker(refresh_inventory, interval=REFRESH_INTERVAL)
 
 @app.route('/')
 def index():
     """Render the index page with buttons to fetch and retrieve IPs."""
     logger.info("Received request to /")
     ssl_warning = "WARNING: SSL verification is disabled. This is not recommended for production use." if not SSL_VERIFY else ""
-    return render_template_string(css + """
-    <div class="container">
-        <h1>FortiManager Query App</h1>
-        <p style="color: red; font-weight: bold;">{{ ssl_warning }}</p>
-        <form action="{{ url_for('fetch_ips') }}" method="post" onsubmit="return confirm('Are you sure you want to fetch VLAN 10 IPs?');">
-            <input type="submit" value="Fetch VLAN 10 IPs">
-        </form>
-        <br>
-        <form action="{{ url_for('get_ips') }}" method="get">
-            <input type="submit" value="Retrieve VLAN 10 IPs">
-        </form>
-        <br>
-        <form action="{{ url_for('clear_db') }}" method="post" onsubmit="return confirm('Are you sure you want to clear the database?');">
-            <input type="submit" value="Clear Database">
-        </form>
-        <br>
-        <a href="{{ url_for('export_csv') }}" class="button">Export to CSV</a>
-        <br><br>
-        <a href="{{ url_for('debug_api') }}" class="button">Debug API Response</a>
-        <br><br>
-        <a href="{{ url_for('debug_api_full') }}" class="button">Debug API Response (Full)</a>
-        <br><br>
-        <a href="{{ url_for('test_endpoints') }}" class="button">Test API Endpoints</a>
-        <br><br>
-        <a href="{{ url_for('check_token') }}" class="button">Check Session Token</a>
-        <br><br>
-        <a href="{{ url_for('user_info') }}" class="button">Get User Info</a>
-    </div>
-    """, ssl_warning=ssl_warning)
+    return render_template('index.html', ssl_warning=ssl_warning)
 
 @app.route('/fetch_ips', methods=['POST'])
 def fetch_ips():
-    """Endpoint to fetch VLAN 10 IPs from FortiManager."""
+    """Endpoint to start a background refresh of the interface inventory from FortiManager."""
     logger.info("Received request to /fetch_ips")
-    message, status = fetch_vlan_10_ips()
-    logger.info(f"Completed /fetch_ips request with status {status}")
-    return render_template_string(css + """
-    <div class="container">
-        <h1>Fetch VLAN 10 IPs Result</h1>
-        <p>{{ message }}</p>
-        <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-    </div>
-    """, message=message)
+    if refresher.request(full=request.form.get('full') == '1'):
+        message = "Refresh started in the background. The stored VLAN 10 IPs stay available until it finishes."
+    else:
+        message = "A refresh is already running."
+    return render_template('message.html', heading='Fetch VLAN 10 IPs Result', message=message,
+                           status_url=url_for('refresh_status')), 202
+
+@app.route('/refresh_status', methods=['GET'])
+def refresh_status():
+    """Endpoint reporting the background refresh and when the stored snapshot was taken."""
+    try:
+        refreshed_at = storage.refreshed_at()
+    except sqlite3.Error as e:
+        logger.error(f"Database error in refresh_status: {str(e)}")
+        refreshed_at = None
+    return jsonify(dict(refresher.status(), refreshed_at=refreshed_at, interval=REFRESH_INTERVAL))
 
 @app.route('/get_ips', methods=['GET'])
 def get_ips():
-    """Endpoint to retrieve stored VLAN 10 IPs."""
+    """Endpoint to browse stored VLAN 10 IPs.
+
+    The page loads rows on demand from /interfaces, one keyset-paginated page
+    at a time, so it renders quickly however many devices are stored.
+    """
     logger.info("Received request to /get_ips")
+    return render_template('get_ips.html')
+
+@app.route('/interfaces', methods=['GET'])
+def interfaces():
+    """Endpoint to page through the interface inventory as JSON.
+
+    Filters by ?vlan=, ?subnet= and ?device=, sorts by ?sort=device|ip and
+    ?order=asc|desc, and returns {"items": [...], "next": cursor}. Pass the
+    cursor back as ?after= for the next page; it is null on the last page.
+    Also reports when the stored snapshot was refreshed and whether a
+    refresh is running, since pages keep serving the old snapshot until the
+    new one is committed.
+    Pages are keyset paginated, so each costs the same however deep it is.
+    e.g. /interfaces?vlan=10&subnet=10.20.0.0/16&sort=ip&limit=100
+    """
+    logger.info(f"Received request to /interfaces with {dict(request.args)}")
+    vlanid = request.args.get('vlan', type=int)
+    if request.args.get('vlan') and vlanid is None:
+        return jsonify({"error": "vlan must be an integer"}), 400
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT device_name, ip_address FROM vlan10_ips")
-        rows = [dict(row) for row in c.fetchall()]
-        conn.close()
-        logger.info(f"Retrieved IPs from database: {rows}")
-        if not rows:
-            message = 'No VLAN 10 IPs found. Please fetch IPs first.'
-            return render_template_string(css + """
-            <div class="container">
-                <h1>VLAN 10 IPs</h1>
-                <p>{{ message }}</p>
-                <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-            </div>
-            """, message=message)
-        return render_template_string(css + """
-        <div class="container">
-            <h1>VLAN 10 IPs</h1>
-            <table>
-                <tr>
-                    <th>Device Name</th>
-                    <th>IP Address</th>
-                </tr>
-                {% for row in rows %}
-                <tr>
-                    <td>{{ row['device_name'] }}</td>
-                    <td>{{ row['ip_address'] }}</td>
-                </tr>
-                {% endfor %}
-            </table>
-            <br>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, rows=rows)
+        refreshed_at = storage.refreshed_at()
+        rows, next_cursor = storage.interface_page(
+            vlanid=vlanid, subnet=request.args.get('subnet'), device_name=request.args.get('device'),
+            sort=request.args.get('sort', 'device'), descending=request.args.get('order') == 'desc',
+            after=request.args.get('after'), limit=limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except sqlite3.Error as e:
-        logger.error(f"Database error in get_ips: {str(e)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Error</h1>
-            <p>Database error: {{ error }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e))
+        logger.error(f"Database error in interfaces: {str(e)}")
+        return jsonify({"error": f"Database error: {str(e)}"}), 500
+    return jsonify({"items": [dict(row) for row in rows], "next": next_cursor,
+                    "refreshed_at": refreshed_at, "refreshing": refresher.is_running()})
 
 @app.route('/clear_db', methods=['POST'])
 def clear_db():
@@ -384,125 +345,64 @@ def clear_db():
         clear_database()
         message = "Database cleared successfully."
         logger.info(message)
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Clear Database Result</h1>
-            <p>{{ message }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, message=message)
+        return render_template('message.html', heading='Clear Database Result', message=message)
     except sqlite3.Error as e:
         logger.error(f"Error clearing database: {str(e)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Error</h1>
-            <p>Database error: {{ error }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e))
+        return render_template('message.html', heading='Error', message=f"Database error: {str(e)}")
 
 @app.route('/export_csv', methods=['GET'])
 def export_csv():
-    """Endpoint to export VLAN 10 IPs as a CSV file."""
+    """Endpoint to export VLAN 10 IPs, or the whole interface inventory, as a CSV file.
+
+    The CSV is streamed from a SQLite cursor a chunk of rows at a time, so
+    memory use does not depend on the number of rows exported.
+    """
     logger.info("Received request to /export_csv")
+    export = request.args.get('export', 'vlan10_ips')
+    if export not in EXPORTS:
+        return jsonify({"error": f"Unknown export: {export}"}), 400
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT device_name, ip_address FROM vlan10_ips")
-        rows = c.fetchall()
-        conn.close()
-
-        if not rows:
-            return render_template_string(css + """
-            <div class="container">
-                <h1>Export Error</h1>
-                <p>No data available to export. Please fetch IPs first.</p>
-                <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-            </div>
-            """)
-
-        si = StringIO()
-        cw = csv.writer(si)
-        cw.writerow(['Device Name', 'IP Address'])
-        cw.writerows(rows)
-        output = si.getvalue()
-
-        return send_file(
-            StringIO(output),
+        row_chunks = storage.export_rows(export)
+        first_chunk = next(row_chunks, None)
+
+        if first_chunk is None:
+            return render_template('message.html', heading='Export Error', message='No data available to export. Please fetch IPs first.')
+
+        header = EXPORTS[export][0]
+        return Response(
+            stream_with_context(csv_chunks(header, itertools.chain([first_chunk], row_chunks))),
             mimetype='text/csv',
-            as_attachment=True,
-            attachment_filename='vlan10_ips.csv'
+            headers={'Content-Disposition': f'attachment; filename={export}.csv'}
         )
     except sqlite3.Error as e:
         logger.error(f"Database error in export_csv: {str(e)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Export Error</h1>
-            <p>Database error: {{ error }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e))
+        return render_template('message.html', heading='Export Error', message=f"Database error: {str(e)}")
 
 @app.route('/debug_api', methods=['GET'])
 def debug_api():
     """Endpoint to debug API response."""
     logger.info("Received request to /debug_api")
-    query_payload = {
-        "method": "get",
-        "params": [
-            {
-                "url": "/dvmdb/device"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "get"
+    params = [{"url": "/dvmdb/device"}]
     try:
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        response.raise_for_status()
-        json_response = response.json()
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"Debug API response: {json.dumps(json_response, indent=2)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Debug API Response</h1>
-            <pre>{{ response }}</pre>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, response=json.dumps(json_response, indent=2))
+        return render_template('response.html', heading='Debug API Response', response=json.dumps(json_response, indent=2),
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in debug_api: {str(e)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Debug API Error</h1>
-            <p>{{ error }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e))
+        return render_template('message.html', heading='Debug API Error', message=str(e))
 
 @app.route('/debug_api_full', methods=['GET'])
 def debug_api_full():
     """Endpoint to debug API response with full logs."""
     logger.info("Received request to /debug_api_full")
-    query_payload = {
-        "method": "get",
-        "params": [
-            {
-                "url": "/dvmdb/device"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "get"
+    params = [{"url": "/dvmdb/device"}]
     try:
         logger.info(f"Sending request to FortiManager: {FMGR_URL}")
-        logger.info(f"Request payload: {json.dumps(query_payload, indent=2)}")
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {json.dumps(dict(response.headers), indent=2)}")
-        logger.info(f"Response content: {response.text}")
-
-        response.raise_for_status()
-        json_response = response.json()
+        logger.info(f"Request params: {json.dumps(params, indent=2)}")
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"Parsed JSON response: {json.dumps(json_response, indent=2)}")
 
         log_contents = StringIO()
@@ -511,16 +411,8 @@ def debug_api_full():
                 log_contents = handler.stream.getvalue()
                 break
         
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Debug API Response (Full)</h1>
-            <h2>API Response:</h2>
-            <pre>{{ response }}</pre>
-            <h2>Full Logs:</h2>
-            <pre>{{ logs }}</pre>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, response=json.dumps(json_response, indent=2), logs=log_contents)
+        return render_template('response.html', heading='Debug API Response (Full)', response=json.dumps(json_response, indent=2), logs=log_contents,
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in debug_api_full: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -529,15 +421,27 @@ def debug_api_full():
             if isinstance(handler, logging.StreamHandler):
                 log_contents = handler.stream.getvalue()
                 break
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Debug API Error (Full)</h1>
-            <p>{{ error }}</p>
-            <h2>Full Logs:</h2>
-            <pre>{{ logs }}</pre>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e), logs=log_contents)
+        return render_template('message.html', heading='Debug API Error (Full)', message=str(e), logs=log_contents)
+
+# Function to query a batch of endpoints for /test_endpoints in one call
+def probe_endpoints(urls, refresh=False):
+    try:
+        logger.info(f"Testing endpoints: {', '.join(urls)}")
+        batch_results, fetched_at = client.cached_batch_get(urls, refresh=refresh)
+    except Exception as e:
+        logger.error(f"Error testing endpoints {urls}: {str(e)}")
+        return [{"url": url, "error": str(e)} for url in urls]
+    results = []
+    for url, result in zip(urls, batch_results):
+        status = result.get('status', {})
+        results.append({
+            "url": url,
+            "status_code": status.get('code'),
+            "message": status.get('message'),
+            "response": result,
+            "fetched": cache_age(fetched_at)
+        })
+    return results
 
 @app.route('/test_endpoints', methods=['GET'])
 def test_endpoints():
@@ -555,137 +459,55 @@ def test_endpoints():
         "/sys/global"
     ]
     
+    # All endpoints are queried together, FETCH_BATCH_SIZE per JSON-RPC call, and
+    # each batch's response is cached, so repeated page loads cost no calls at all
+    refresh = force_refresh()
     results = []
-    for url in test_urls:
-        query_payload = {
-            "method": "get",
-            "params": [
-                {
-                    "url": url
-                }
-            ],
-            "session": session_token,
-            "id": 1
-        }
-        try:
-            logger.info(f"Testing endpoint: {url}")
-            response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-            response.raise_for_status()
-            json_response = response.json()
-            status = json_response.get('result', [{}])[0].get('status', {})
-            results.append({
-                "url": url,
-                "status_code": status.get('code'),
-                "message": status.get('message'),
-                "response": json_response
-            })
-        except Exception as e:
-            logger.error(f"Error testing endpoint {url}: {str(e)}")
-            results.append({
-                "url": url,
-                "error": str(e)
-            })
+    for batch in chunked(test_urls, FETCH_BATCH_SIZE):
+        results.extend(probe_endpoints(batch, refresh))
     
-    return render_template_string(css + """
-    <div class="container">
-        <h1>FortiManager API Endpoint Test Results</h1>
-        {% for result in results %}
-        <h2>{{ result.url }}</h2>
-        {% if result.get('error') %}
-        <p>Error: {{ result.error }}</p>
-        {% else %}
-        <p>Status Code: {{ result.status_code }}</p>
-        <p>Message: {{ result.message }}</p>
-        <pre>{{ result.response | tojson(indent=2) }}</pre>
-        {% endif %}
-        <hr>
-        {% endfor %}
-        <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-    </div>
-    """, results=results)
+    return render_template('test_endpoints.html', results=results)
 
 @app.route('/check_token', methods=['GET'])
 def check_token():
     """Endpoint to check the status of the session token."""
     logger.info("Received request to /check_token")
-    query_payload = {
-        "method": "exec",
-        "params": [
-            {
-                "url": "/sys/status"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "exec"
+    params = [{"url": "/sys/status"}]
     try:
         logger.info(f"Sending request to FortiManager: {FMGR_URL}")
-        logger.info(f"Request payload: {json.dumps(query_payload, indent=2)}")
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        logger.info(f"Response status code: {response.status_code}")
-        logger.info(f"Response headers: {json.dumps(dict(response.headers), indent=2)}")
-        logger.info(f"Response content: {response.text}")
-        response.raise_for_status()
-        json_response = response.json()
+        logger.info(f"Request params: {json.dumps(params, indent=2)}")
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"Token check response: {json.dumps(json_response, indent=2)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Session Token Status</h1>
-            <pre>{{ response }}</pre>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, response=json.dumps(json_response, indent=2))
+        return render_template('response.html', heading='Session Token Status', response=json.dumps(json_response, indent=2),
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in check_token: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Session Token Check Error</h1>
-            <p>{{ error }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e))
+        return render_template('message.html', heading='Session Token Check Error', message=str(e))
 
 @app.route('/user_info', methods=['GET'])
 def user_info():
     """Endpoint to retrieve current user information."""
     logger.info("Received request to /user_info")
-    query_payload = {
-        "method": "get",
-        "params": [
-            {
-                "url": "/sys/admin/user"
-            }
-        ],
-        "session": session_token,
-        "id": 1
-    }
+    method = "get"
+    params = [{"url": "/sys/admin/user"}]
     try:
-        response = requests.post(FMGR_URL, json=query_payload, verify=SSL_VERIFY)
-        response.raise_for_status()
-        json_response = response.json()
+        json_response, fetched_at = client.cached_call(method, params, refresh=force_refresh())
         logger.info(f"User info response: {json.dumps(json_response, indent=2)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>Current User Information</h1>
-            <pre>{{ response }}</pre>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, response=json.dumps(json_response, indent=2))
+        return render_template('response.html', heading='Current User Information', response=json.dumps(json_response, indent=2),
+                               fetched=cache_age(fetched_at))
     except Exception as e:
         logger.error(f"Error in user_info: {str(e)}")
-        return render_template_string(css + """
-        <div class="container">
-            <h1>User Info Error</h1>
-            <p>{{ error }}</p>
-            <a href="{{ url_for('index') }}" class="button">Back to Home</a>
-        </div>
-        """, error=str(e))
+        return render_template('message.html', heading='User Info Error', message=str(e))
 
 if __name__ == '__main__':
     init_db()
-    session_token = get_session_token()
-    if session_token is None:
-        logger.error("Failed to obtain initial session token. Exiting.")
+    try:
+        client.login()
+    except Exception as e:
+        logger.error(f"Failed to obtain initial session token: {str(e)}. Exiting.")
         sys.exit(1)
+    if REFRESH_INTERVAL > 0:
+        refresher.request()
     app.run(debug=DEBUG, host=HOST, port=PORT, use_reloader=False)
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config_cache import ParseCache, DEFAULT_CACHE_DIR
+from config_model import ValueTable
+from fortigate_config_comparator import load_config, compare_configs, write_differences_to_file, config_display_name
+
+# Job states, in the order a job moves through them
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATUS_FILE = 'status.json'
+DIFF_FILE = 'configdiff.txt'
+
+class QueueFull(Exception):
+    pass
+
+# Job IDs are random hex strings so they can be used as directory names
+def new_job_id():
+    return uuid.uuid4().hex
+
+def is_job_id(job_id):
+    return len(job_id) == 32 and all(char in '0123456789abcdef' for char in job_id)
+
+# Write a job's status atomically so a poll never reads a partial file.
+# The status lives on disk, so any web process can answer for any job.
+def write_status(job_dir, state, progress, message='', **extra):
+    status = {'state': state, 'progress': progress, 'message': message, 'updated': time.time()}
+    status.update(extra)
+    fd, temp_path = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(status, file)
+    os.replace(temp_path, os.path.join(job_dir, STATUS_FILE))
+
+# Return a job's status, or None if there is no such job
+def read_status(job_dir):
+    try:
+        with open(os.path.join(job_dir, STATUS_FILE), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+# Per-process state for comparison jobs, set up once by _init_job_worker
+_job_cache = None
+_job_ignore_rules = None
+
+def _init_job_worker(cache_dir, ignore_rules):
+    global _job_cache, _job_ignore_rules
+    _job_cache = ParseCache(cache_dir) if cache_dir else None
+    _job_ignore_rules = ignore_rules
+
+# Compare two uploaded configs, reporting progress in the job directory
+def run_comparison_job(job_dir, file1_path, file2_path):
+    try:
+        write_status(job_dir, RUNNING, 10, 'Parsing ' + os.path.basename(file1_path))
+        # The two configs share values for the length of this job only
+        values = ValueTable()
+        config1 = load_config(file1_path, _job_cache, values)
+        write_status(job_dir, RUNNING, 40, 'Parsing ' + os.path.basename(file2_path))
+        config2 = load_config(file2_path, _job_cache, values)
+
+        write_status(job_dir, RUNNING, 70, 'Comparing')
+        differences = compare_configs(config1, config2, _job_ignore_rules)
+
+        write_status(job_dir, RUNNING, 90, 'Writing results')
+        write_differences_to_file(differences, os.path.join(job_dir, DIFF_FILE),
+                                  config_display_name(file1_path), config_display_name(file2_path))
+    except Exception as e:
+        write_status(job_dir, FAILED, 100, str(e))
+        return False
+
+    write_status(job_dir, DONE, 100, '', difference_count=len(differences), diff_file=DIFF_FILE)
+    return True
+
+class ComparisonJobs:
+    """Runs config comparisons on a bounded process pool.
+
+    Each job gets its own directory under ``job_root`` holding the uploaded
+    files, the status file polled by the web page and the result. At most
+    ``max_pending`` jobs may be queued or running; submit raises QueueFull
+    beyond that rather than letting the backlog grow without limit.
+    """
+
+    def __init__(self, job_root, workers=None, max_pending=32, ignore_rules=None,
+                 cache_dir=DEFAULT_CACHE_DIR, max_age=24 * 60 * 60):
+        self.job_root = job_root
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.ignore_rules = ignore_rules
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        os.makedirs(job_root, exist_ok=True)
+
+    def job_dir(self, job_id):
+        return os.path.join(self.job_root, job_id)
+
+    def status(self, job_id):
+        if not is_job_id(job_id):
+            return None
+        return read_status(self.job_dir(job_id))
+
+    # Create a job directory, let `save` write the uploads into it and queue
+    # the comparison. `save` is called with the job directory and must return
+    # the paths of the two config files. Returns the job ID.
+    def submit(self, save):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFull(f"{self._pending} comparisons already queued")
+            self._pending += 1
+
+        queued = False
+        try:
+            self.purge()
+            job_id = new_job_id()
+            job_dir = self.job_dir(job_id)
+            os.makedirs(job_dir)
+            file1_path, file2_path = save(job_dir)
+            write_status(job_dir, QUEUED, 0, 'Waiting for a worker')
+            queued = True
+            future, executor = self._queue(run_comparison_job, job_dir, file1_path, file2_path)
+        except BaseException as e:
+            # Don't leave the page waiting on a job that never reached a worker
+            if queued:
+                write_status(job_dir, FAILED, 100, str(e))
+            self._finished(None)
+            raise
+
+        future.add_done_callback(lambda future: self._finished(future, job_dir, executor))
+        return job_id
+
+    # Return the process pool, starting it on first use
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # Workers are spawned rather than forked: the pool is started
+                # from a web request thread, and a fork copies the state of
+                # the other threads (held locks included) into each worker.
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_job_worker,
+                                                     initargs=(self.cache_dir, self.ignore_rules),
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    # Forget a pool whose worker died (killed for using too much memory, say).
+    # A broken pool refuses all further work, so the next job starts a new one.
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    # Submit a call to the pool and return (future, pool). If the pool broke
+    # since the last job, it is replaced and the call submitted once more.
+    def _queue(self, function, *args):
+        executor = self._pool()
+        try:
+            return executor.submit(function, *args), executor
+        except BrokenProcessPool:
+            self._discard(executor)
+        executor = self._pool()
+        return executor.submit(function, *args), executor
+
+    def _finished(self, future, job_dir=None, executor=None):
+        with self._lock:
+            self._pending -= 1
+        if future is None:
+            return
+        # A cancelled job or a worker that died never got to record the failure itself
+        if future.cancelled():
+            write_status(job_dir, FAILED, 100, 'Cancelled')
+        elif future.exception() is not None:
+            if isinstance(future.exception(), BrokenProcessPool):
+                self._discard(executor)
+            write_status(job_dir, FAILED, 100, str(future.exception()))
+
+    # Remove job directories not touched for max_age seconds
+    def purge(self):
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.job_root):
+            try:
+                if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
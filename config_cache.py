@@ -0,0 +1,93 @@
+import os
+import pickle
+import hashlib
+import tempfile
+
+# Default location and size limit of the on-disk parse cache
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.parse_cache')
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Return the SHA-256 hex digest of a file's bytes, read in chunks
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ParseCache:
+    """Content-addressed cache of parsed configs stored as pickle files.
+
+    Entries are keyed by the SHA-256 of the file bytes plus the parser
+    version, so an edited file or a parser change never returns a stale tree.
+    The least recently used entries are removed once the cache grows past
+    ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, content_hash, version):
+        return os.path.join(self.cache_dir, f"{version}-{content_hash}.pickle")
+
+    # Return the cached tree for a file, parsing and storing it on a miss
+    def load(self, file_path, parse, version):
+        path = self.entry_path(file_sha256(file_path), version)
+        try:
+            with open(path, 'rb') as file:
+                config = pickle.load(file)
+            # Bump the modification time so eviction sees this entry as recently used
+            os.utime(path)
+            return config
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+
+        config = parse(file_path)
+        self.store(path, config)
+        return config
+
+    # Write an entry atomically so concurrent readers never see a partial file
+    def store(self, path, config):
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                pickle.dump(config, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.evict()
+
+    # Remove least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.pickle'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pickle'):
+                os.remove(entry.path)
@@ -0,0 +1,121 @@
+import io
+import csv
+import json
+import html
+from collections import namedtuple
+from config_model import ConfigNode
+
+# Kinds of difference between two configs
+MISSING_LEFT = 'missing_left'    # present only in the right-hand config
+MISSING_RIGHT = 'missing_right'  # present only in the left-hand config
+CHANGED = 'changed'              # present in both with different values
+MOVED = 'moved'                  # entry of an ordered table at a different position
+
+# A single difference. ``path`` is the tuple of names from the top-level section
+# down to the differing entry or key; ``left`` and ``right`` hold the parsed
+# values (a tuple, None for unset or absent, or a ConfigNode for a subtree).
+# For MOVED entries ``left`` and ``right`` hold the 1-based positions as 1-tuples.
+Difference = namedtuple('Difference', ['kind', 'path', 'left', 'right'])
+
+# Format a parsed value for display
+def format_value(value):
+    if value is None:
+        return '<unset>'
+    if isinstance(value, ConfigNode):
+        return '{...}'
+    return ' '.join(value)
+
+# Convert a parsed value to something json.dumps can write
+def value_to_json(value):
+    if isinstance(value, ConfigNode):
+        return {'entries': len(value)}
+    if value is None:
+        return None
+    return list(value)
+
+# Renderers turn a sequence of Difference records into chunks of text.
+# Each takes (differences, left_name, right_name) and returns an iterable of str.
+RENDERERS = {}
+FILE_EXTENSIONS = {}
+
+# Decorator registering a renderer under an output format name
+def register_renderer(name, extension):
+    def register(render):
+        RENDERERS[name] = render
+        FILE_EXTENSIONS[name] = extension
+        return render
+    return register
+
+@register_renderer('text', '.txt')
+def render_text(differences, left_name, right_name):
+    empty = True
+    for difference in differences:
+        empty = False
+        kind, path, left, right = difference
+        name = path[-1]
+        location = ' > '.join(path[:-1])
+        if kind == CHANGED:
+            yield f"[Value Difference]\n  Section: '{location}'\n  Key: '{name}'\n  {left_name}: '{format_value(left)}'\n  {right_name}: '{format_value(right)}'\n\n"
+            continue
+        if kind == MOVED:
+            yield f"[Entry Moved]\n  Section: '{location}'\n  Entry: '{name}'\n  {left_name}: position {format_value(left)}\n  {right_name}: position {format_value(right)}\n\n"
+            continue
+
+        missing, present = (left_name, right_name) if kind == MISSING_LEFT else (right_name, left_name)
+        value = right if kind == MISSING_LEFT else left
+        if not isinstance(value, ConfigNode):
+            yield f"[Key Missing in {missing}]\n  Key: '{name}' in section '{location}' is in {present} but not in {missing}\n\n"
+        elif len(path) == 1:
+            yield f"[Section Missing in {missing}]\n  Section: '{name}' is in {present} but not in {missing}\n\n"
+        else:
+            yield f"[Subsection Missing in {missing}]\n  Subsection: '{name}' in section '{location}' is in {present} but not in {missing}\n\n"
+    if empty:
+        yield "No differences found between the configurations.\n"
+
+# Records keep the same keys whatever the configs are called, so two backups
+# of one store with the same display name do not overwrite each other's value
+@register_renderer('jsonl', '.jsonl')
+def render_jsonl(differences, left_name, right_name):
+    for kind, path, left, right in differences:
+        yield json.dumps({
+            'kind': kind,
+            'path': list(path),
+            'left_name': left_name,
+            'right_name': right_name,
+            'left': value_to_json(left),
+            'right': value_to_json(right),
+        }) + '\n'
+
+@register_renderer('csv', '.csv')
+def render_csv(differences, left_name, right_name):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['kind', 'path', 'left_name', 'right_name', 'left', 'right'])
+    for kind, path, left, right in differences:
+        left = format_value(left) if kind != MISSING_LEFT else ''
+        right = format_value(right) if kind != MISSING_RIGHT else ''
+        writer.writerow([kind, ' > '.join(path), left_name, right_name, left, right])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@register_renderer('html', '.html')
+def render_html(differences, left_name, right_name):
+    left_name = html.escape(left_name)
+    right_name = html.escape(right_name)
+    yield ('<table class="table table-striped">\n'
+           f'<thead><tr><th>Kind</th><th>Path</th><th>{left_name}</th><th>{right_name}</th></tr></thead>\n'
+           '<tbody>\n')
+    for kind, path, left, right in differences:
+        left = format_value(left) if kind != MISSING_LEFT else ''
+        right = format_value(right) if kind != MISSING_RIGHT else ''
+        yield (f'<tr><td>{kind}</td><td>{html.escape(" > ".join(path))}</td>'
+               f'<td>{html.escape(left)}</td><td>{html.escape(right)}</td></tr>\n')
+    yield '</tbody>\n</table>\n'
+
+# Render differences in the given format, returning an iterable of text chunks
+def render_differences(differences, left_name, right_name, output_format='text'):
+    if output_format not in RENDERERS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return RENDERERS[output_format](differences, left_name, right_name)
@@ -0,0 +1,141 @@
+import sys
+import hashlib
+
+# Values longer than this are kept as-is instead of being shared, so one-off
+# strings are not pinned in memory by a value table
+MAX_INTERN_LENGTH = 256
+
+# Values at least this long (base64 images, certificates, keys) are replaced by
+# a short placeholder holding only their length and digest. FortiOS comments are
+# capped at 1023 characters, so ordinary text values are never affected.
+BLOB_MIN_LENGTH = 1024
+
+intern_name = sys.intern
+
+# Placeholder stored instead of a blob's text; equal blobs give equal placeholders
+def format_blob(length, hexdigest):
+    return f"<blob {length} chars {hexdigest}>"
+
+def new_blob_hash():
+    return hashlib.blake2b(digest_size=16)
+
+# Reduce a blob's text to its placeholder
+def blob_value(text):
+    blob_hash = new_blob_hash()
+    blob_hash.update(text.encode('utf-8', 'surrogatepass'))
+    return format_blob(len(text), blob_hash.hexdigest())
+
+class ConfigNode:
+    """A node of the parsed config tree.
+
+    ``children`` maps each name to either a nested node or the value of a
+    ``set`` statement (a tuple of strings, or None for ``unset``).
+    ``digest`` is a hash of the node's whole subtree, filled in by
+    ``update_digest`` once the node is complete.
+    """
+
+    __slots__ = ('name', 'children', 'digest')
+
+    def __init__(self, name=''):
+        self.name = name
+        self.children = {}
+        self.digest = None
+
+    # Hash the node's content, reusing the digests of its child nodes so two
+    # subtrees with equal digests can be treated as identical without walking them.
+    # Attributes are hashed in sorted order, but nested entries keep their order
+    # since reordering firewall policies changes what the config does.
+    def update_digest(self):
+        attributes = []
+        nodes = []
+        for name, value in self.children.items():
+            if value is None:
+                attributes.append(name + '\x15')
+            elif isinstance(value, ConfigNode):
+                if value.digest is None:
+                    value.update_digest()
+                nodes.append(name + '\x1d' + value.digest.hex())
+            else:
+                attributes.append(name + '\x1f' + '\x1f'.join(value))
+        attributes.sort()
+        attributes.extend(nodes)
+        self.digest = hashlib.blake2b('\x1e'.join(attributes).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+        return self.digest
+
+    # Return the child node with the given name, creating it if needed
+    def child(self, node_class, name):
+        node = self.children.get(name)
+        if node is None or not isinstance(node, ConfigNode):
+            node = self.children[name] = node_class(name)
+        return node
+
+    def __getitem__(self, name):
+        return self.children[name]
+
+    def __contains__(self, name):
+        return name in self.children
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def keys(self):
+        return self.children.keys()
+
+    def items(self):
+        return self.children.items()
+
+    def get(self, name, default=None):
+        return self.children.get(name, default)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r}, {len(self.children)} children)"
+
+class ConfigSection(ConfigNode):
+    """A ``config <path>`` block."""
+
+    __slots__ = ()
+
+class ConfigEntry(ConfigNode):
+    """An ``edit <name>`` entry inside a config block."""
+
+    __slots__ = ()
+
+class ValueTable:
+    """Shared value tuples for configs parsed or loaded together.
+
+    Identical ``set`` values across the configs of one batch (a comparison,
+    a job, a fleet worker's store) point at the same tuple. The table lives
+    only as long as the batch holds on to it, so a long-running process does
+    not keep every value it has ever seen.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    # Return a shared tuple for the value tokens of a `set` statement
+    def intern(self, tokens):
+        for token in tokens:
+            if len(token) > MAX_INTERN_LENGTH:
+                tokens = [blob_value(token) if len(token) >= BLOB_MIN_LENGTH else token for token in tokens]
+                if any(len(token) > MAX_INTERN_LENGTH for token in tokens):
+                    return tuple(tokens)
+                break
+        value = tuple([sys.intern(token) for token in tokens])
+        return self._values.setdefault(value, value)
+
+    # Point the values of an already built tree, such as one unpickled from the
+    # parse cache, at this table's tuples. Returns the node.
+    def share(self, node):
+        children = node.children
+        for name, value in children.items():
+            if isinstance(value, ConfigNode):
+                self.share(value)
+            elif value is not None and all(len(token) <= MAX_INTERN_LENGTH for token in value):
+                children[name] = self._values.setdefault(value, value)
+        return node
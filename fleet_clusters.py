@@ -0,0 +1,130 @@
+import hashlib
+from collections import namedtuple, Counter
+from config_model import ConfigNode
+
+# Number of MinHash values kept per config, and how many of them make up one
+# LSH band. Two configs land in a shared bucket when all values of any band
+# agree, which for 16 bands of 8 is likely from about 70% similarity upwards.
+SIGNATURE_SIZE = 128
+ROWS_PER_BAND = 8
+# Estimated Jaccard similarity two configs in a shared bucket need to be clustered
+DEFAULT_THRESHOLD = 0.8
+
+_HASH_RANGE = 1 << 64
+
+# A cluster of similar configs. ``members`` are store indices, ``medoid`` is
+# the member most similar to all the others and ``similarity`` holds each
+# member's estimated similarity to the medoid, in ``members`` order.
+Cluster = namedtuple('Cluster', ['members', 'medoid', 'similarity'])
+
+# Yield one string per attribute of a parsed config: its path and value.
+# Names and values the ignore rules match (hostnames, serials, secrets) are
+# left out, so stores built from the same template produce the same set.
+def config_features(node, ignore_rules=None, prefix='', location=''):
+    for name, value in node.children.items():
+        if ignore_rules is not None and ignore_rules.ignores(name, location, value):
+            continue
+        if isinstance(value, ConfigNode):
+            yield from config_features(value, ignore_rules, prefix + name + '\x1f',
+                                       location + ' > ' + name if location else name)
+        elif value is None:
+            yield prefix + name + '\x15'
+        else:
+            yield prefix + name + '\x1e' + '\x1f'.join(value)
+
+def feature_hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+
+# MinHash signature of a set of 64-bit feature hashes using one permutation
+# hashing: each hash is routed to one of `size` bins by its low bits and every
+# bin keeps its smallest value, so a config is hashed once rather than once per
+# signature value. Empty bins borrow from the next filled bin, offset by the
+# distance, so they still only match configs with the same content there.
+def minhash_signature(hashes, size=SIGNATURE_SIZE):
+    bins = [None] * size
+    for value in hashes:
+        index = value % size
+        value //= size
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    if all(value is None for value in bins):
+        return tuple([-1] * size)
+
+    span = _HASH_RANGE // size + 1
+    signature = list(bins)
+    for index in range(size):
+        if bins[index] is None:
+            distance = 1
+            while bins[(index + distance) % size] is None:
+                distance += 1
+            signature[index] = bins[(index + distance) % size] + distance * span
+    return tuple(signature)
+
+# Signature of a parsed config's (path, value) set
+def config_signature(config, ignore_rules=None, size=SIGNATURE_SIZE):
+    return minhash_signature({feature_hash(feature) for feature in config_features(config, ignore_rules)}, size)
+
+# Fraction of signature values two configs share; estimates their Jaccard similarity
+def estimated_similarity(signature1, signature2):
+    return sum(1 for value1, value2 in zip(signature1, signature2) if value1 == value2) / len(signature1)
+
+class SimilarityIndex:
+    """Groups configs with similar (path, value) sets using MinHash and LSH.
+
+    Each config added contributes its signature to one bucket per band; only
+    configs sharing a bucket are ever compared, so clustering takes near
+    linear time instead of a full diff between every pair of stores.
+    """
+
+    def __init__(self, rows_per_band=ROWS_PER_BAND, threshold=DEFAULT_THRESHOLD):
+        self.rows_per_band = rows_per_band
+        self.threshold = threshold
+        self.signatures = []
+        self._buckets = {}
+
+    # Add a config's signature and return its store index
+    def add(self, signature):
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        for band, start in enumerate(range(0, len(signature), self.rows_per_band)):
+            key = (band, signature[start:start + self.rows_per_band])
+            self._buckets.setdefault(key, []).append(index)
+        return index
+
+    # Return the clusters, largest first. Stores in a shared bucket are joined
+    # when similar enough to the bucket's first store; stores that never are
+    # end up in clusters of their own.
+    def clusters(self):
+        parents = list(range(len(self.signatures)))
+
+        def root(index):
+            while parents[index] != index:
+                parents[index] = parents[parents[index]]
+                index = parents[index]
+            return index
+
+        for members in self._buckets.values():
+            first = members[0]
+            for member in members[1:]:
+                if root(member) != root(first) and \
+                        estimated_similarity(self.signatures[first], self.signatures[member]) >= self.threshold:
+                    parents[root(member)] = root(first)
+
+        groups = {}
+        for index in range(len(self.signatures)):
+            groups.setdefault(root(index), []).append(index)
+        clusters = [self._cluster(members) for members in groups.values()]
+        clusters.sort(key=lambda cluster: (-len(cluster.members), cluster.members[0]))
+        return clusters
+
+    # The medoid is the member agreeing with the others on the most signature
+    # values in total. Counting each position's values once makes that linear
+    # in the cluster size.
+    def _cluster(self, members):
+        signatures = [self.signatures[member] for member in members]
+        counts = [Counter(column) for column in zip(*signatures)]
+        scores = [sum(count[value] for count, value in zip(counts, signature)) for signature in signatures]
+        medoid_position = max(range(len(members)), key=lambda position: scores[position])
+        medoid_signature = signatures[medoid_position]
+        return Cluster(members, members[medoid_position],
+                       [estimated_similarity(medoid_signature, signature) for signature in signatures])
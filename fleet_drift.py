@@ -0,0 +1,188 @@
+import io
+import csv
+import json
+from collections import namedtuple
+from config_model import ConfigNode
+from config_diff import format_value
+
+# Histogram keys besides parsed values: the name is a nested block in that
+# store, or the store has no such name although it has the enclosing block
+NODE = '<block>'
+ABSENT = '<absent>'
+# Stores whose value an ignore rule matched; counted as neither present nor absent
+_IGNORED = object()
+
+# Drift at one path. ``histogram`` is a list of (value, stores) pairs, most
+# common value first, where ``stores`` is a bitset with bit i set for store i.
+# The first pair is the majority; every other pair lists outliers.
+Drift = namedtuple('Drift', ['path', 'histogram'])
+
+# Store indices of the bits set in a bitset, in increasing order
+def store_indices(stores):
+    indices = []
+    while stores:
+        lowest = stores & -stores
+        indices.append(lowest.bit_length() - 1)
+        stores ^= lowest
+    return indices
+
+def store_count(stores):
+    return bin(stores).count('1')
+
+class _DriftNode:
+    """One path of the merged fleet tree.
+
+    ``values`` is the histogram of what the stores that reached the parent
+    hold under this name. ``variants`` maps each distinct subtree digest seen
+    here to [first store, stores with that digest]; only the first store of a
+    variant is folded into ``children``, the rest are identical below here.
+    """
+
+    __slots__ = ('values', 'variants', 'children')
+
+    def __init__(self):
+        self.values = {}
+        self.variants = {}
+        self.children = {}
+
+class FleetDrift:
+    """N-way comparison of many parsed configs.
+
+    Each config is folded into one merged tree as it is added, so the whole
+    fleet is compared in a single pass and a config can be dropped once added.
+    Subtrees already seen under the same path are recognised by their digest
+    and not walked again, so the cost grows with the number of distinct
+    variants rather than the number of stores. Entries of ordered tables are
+    lined up by edit ID; moves and renumbering are left to compare_configs.
+    """
+
+    def __init__(self, ignore_rules=None):
+        self.ignore_rules = ignore_rules
+        self.root = _DriftNode()
+        self.store_count = 0
+
+    # Fold one parsed config into the merged tree and return its store index
+    def add(self, config):
+        index = self.store_count
+        bit = 1 << index
+        self.root.values[NODE] = self.root.values.get(NODE, 0) | bit
+        self._fold(self.root, config, index, bit, '')
+        self.store_count += 1
+        return index
+
+    def _fold(self, merged, node, index, bit, location):
+        if node.digest is None:
+            node.update_digest()
+        variant = merged.variants.get(node.digest)
+        if variant is not None:
+            variant[1] |= bit
+            return
+        merged.variants[node.digest] = [index, bit]
+
+        ignore_rules = self.ignore_rules
+        for name, value in node.children.items():
+            # Value rules only mark the store as ignored below, so pass the value on for nodes alone
+            if ignore_rules is not None and ignore_rules.ignores(name, location,
+                                                                 value if isinstance(value, ConfigNode) else None):
+                continue
+            child = merged.children.get(name)
+            if child is None:
+                child = merged.children[name] = _DriftNode()
+            if isinstance(value, ConfigNode):
+                key = NODE
+            elif ignore_rules is not None and ignore_rules.ignores_value(value):
+                key = _IGNORED
+            else:
+                key = value
+            child.values[key] = child.values.get(key, 0) | bit
+            if key is NODE:
+                self._fold(child, value, index, bit, location + ' > ' + name if location else name)
+
+    # Yield a Drift for every path where the stores do not all agree.
+    #
+    # Stores that were not walked below a node because an earlier store had
+    # the same subtree are expanded back in through ``aliases``, which maps
+    # each walked store to every store it stands for.
+    def drifts(self):
+        aliases = {index: 1 << index for index in range(self.store_count)}
+        yield from self._drifts(self.root, (), aliases)
+
+    def _drifts(self, merged, path, aliases):
+        child_aliases = {}
+        walked = 0
+        for first, stores in merged.variants.values():
+            child_aliases[first] = _expand(stores, aliases)
+            walked |= 1 << first
+
+        for name, child in merged.children.items():
+            histogram = {}
+            seen = 0
+            for key, stores in child.values.items():
+                seen |= stores
+                if key is not _IGNORED:
+                    histogram[key] = _expand(stores, child_aliases)
+            if walked & ~seen:
+                histogram[ABSENT] = _expand(walked & ~seen, child_aliases)
+            if len(histogram) > 1:
+                yield Drift(path + (name,), sorted(histogram.items(), key=lambda item: -store_count(item[1])))
+            if child.variants:
+                yield from self._drifts(child, path + (name,), child_aliases)
+
+# Union of the stores each walked store in `stores` stands for
+def _expand(stores, aliases):
+    expanded = 0
+    for index in store_indices(stores):
+        expanded |= aliases[index]
+    return expanded
+
+# Format a histogram value for display
+def format_drift_value(value):
+    if value is NODE or value is ABSENT:
+        return value
+    return format_value(value)
+
+# Drift renderers take (drifts, store_names) and return an iterable of str
+DRIFT_RENDERERS = {}
+DRIFT_FILE_EXTENSIONS = {}
+
+def register_drift_renderer(name, extension):
+    def register(render):
+        DRIFT_RENDERERS[name] = render
+        DRIFT_FILE_EXTENSIONS[name] = extension
+        return render
+    return register
+
+# One line per drifting path with its majority value and the outlying stores
+@register_drift_renderer('jsonl', '.jsonl')
+def render_drift_jsonl(drifts, store_names):
+    for path, histogram in drifts:
+        (majority, majority_stores), outliers = histogram[0], histogram[1:]
+        yield json.dumps({
+            'path': list(path),
+            'majority': format_drift_value(majority),
+            'majority_count': store_count(majority_stores),
+            'outliers': [{'value': format_drift_value(value),
+                          'stores': [store_names[index] for index in store_indices(stores)]}
+                         for value, stores in outliers],
+        }) + '\n'
+
+# One row per value of each drifting path; the majority rows list no stores
+@register_drift_renderer('csv', '.csv')
+def render_drift_csv(drifts, store_names):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['path', 'value', 'count', 'majority', 'stores'])
+    for path, histogram in drifts:
+        location = ' > '.join(path)
+        for position, (value, stores) in enumerate(histogram):
+            names = '' if position == 0 else ';'.join(store_names[index] for index in store_indices(stores))
+            writer.writerow([location, format_drift_value(value), store_count(stores), position == 0, names])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def render_drift(drifts, store_names, output_format='jsonl'):
+    if output_format not in DRIFT_RENDERERS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return DRIFT_RENDERERS[output_format](drifts, store_names)
@@ -1,167 +1,578 @@
 import re
 import os
+import sys
+import csv
+import argparse
+import hashlib
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from config_model import (ConfigNode, ConfigSection, ConfigEntry, ValueTable, intern_name,
+                          blob_value, new_blob_hash, format_blob)
+from config_cache import ParseCache
+from ignore_rules import IgnoreRules
+from config_diff import Difference, MISSING_LEFT, MISSING_RIGHT, CHANGED, MOVED, FILE_EXTENSIONS, render_differences
+from policy_diff import ORDERED_SECTIONS, match_entries, find_moves
+from fleet_drift import FleetDrift, DRIFT_FILE_EXTENSIONS, render_drift, store_indices
+from fleet_clusters import SimilarityIndex, config_signature, DEFAULT_THRESHOLD
+from object_refs import referenced_differences, render_referenced_text
+
+# Bump whenever parse_config produces a different tree, so cached parses are not reused
+PARSER_VERSION = 3
+
+# Matches one token of a FortiOS statement: a quoted string (possibly still open
+# at the end of the text, for values that continue on the next line) or a bare word
+_TOKEN_RE = re.compile(r'"((?:[^"\\]|\\.)*)("?)|(\S+)', re.S)
+_ESCAPE_RE = re.compile(r'\\(.)', re.S)
+
 
 # Function to read configuration file
 def read_config_file(file_path):
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
-<<<<<<< HEAD
 
-=======
-    
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-    with open(file_path, 'r') as file:
-        return file.read().splitlines()
+    return _iter_file_lines(file_path)
 
-# Function to parse configuration file
-def parse_config(lines):
-    config = {}
-    current_section = None
-    current_subsection = None
-    skip_public_key = False
+# Yield the lines of a file one at a time instead of loading the whole file
+def _iter_file_lines(file_path):
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as file:
+        yield from file
+
+# Split a statement into tokens, returning None if a quoted value is not closed yet
+def split_statement(text):
+    if '"' not in text:
+        return text.split()
+    if '\\' in text:
+        return _split_escaped_statement(text)
+
+    # Without escapes, every other piece between quotes is a quoted value
+    parts = text.split('"')
+    if len(parts) % 2 == 0:
+        return None
+    tokens = []
+    for index, part in enumerate(parts):
+        if index % 2:
+            tokens.append(part)
+        else:
+            tokens.extend(part.split())
+    return tokens
+
+# Slower tokenizer for statements containing backslash escapes
+def _split_escaped_statement(text):
+    tokens = []
+    for quoted, closed, bare in _TOKEN_RE.findall(text):
+        if bare:
+            tokens.append(bare)
+        elif not closed:
+            return None
+        elif '\\' in quoted:
+            tokens.append(_ESCAPE_RE.sub(r'\1', quoted))
+        else:
+            tokens.append(quoted)
+    return tokens
+
+# Index of the first quote at or after `start` that is not escaped with a backslash, or -1
+def _find_unescaped_quote(text, start=0):
+    index = text.find('"', start)
+    while index > 0:
+        backslashes = 0
+        position = index - 1
+        while position >= 0 and text[position] == '\\':
+            backslashes += 1
+            position -= 1
+        if backslashes % 2 == 0:
+            break
+        index = text.find('"', index + 1)
+    return index
+
+# Index of the last unescaped quote in text, or -1
+def _rfind_unescaped_quote(text):
+    last = -1
+    index = _find_unescaped_quote(text)
+    while index >= 0:
+        last = index
+        index = _find_unescaped_quote(text, index + 1)
+    return last
 
+# Yield the tokens of each statement.
+#
+# A quoted value that runs over several lines (certificates, keys, replacement
+# message bodies) is never assembled in memory: its lines are fed straight into
+# a hash and the statement gets a blob placeholder with the length and digest.
+def iter_statements(lines):
+    blob_head = blob_hash = None
+    blob_length = 0
     for line in lines:
+        if blob_head is not None:
+            text = line.rstrip('\r\n')
+            end = _find_unescaped_quote(text)
+            chunk = '\n' + (text if end < 0 else text[:end])
+            blob_hash.update(chunk.encode('utf-8', 'surrogatepass'))
+            blob_length += len(chunk)
+            if end >= 0:
+                tokens = blob_head + [format_blob(blob_length, blob_hash.hexdigest())]
+                tokens.extend(split_statement(text[end + 1:]) or ())
+                blob_head = None
+                yield tokens
+            continue
+
         line = line.strip()
-        if not line or line.startswith('#'):
+        if not line or line[0] == '#':
             continue
 
-        if line.startswith('config '):
-            current_section = line[7:]
-            config[current_section] = {}
-            current_subsection = None
-        elif line.startswith('edit '):
-            if current_section:
-                current_subsection = line[5:].strip('"')
-                config[current_section][current_subsection] = {}
-        elif line == 'end':
-            if current_subsection:
-                current_subsection = None
-            elif current_section:
-                if not config[current_section]:
-                    del config[current_section]
-                current_section = None
-            skip_public_key = False
-        elif '=' in line and current_section:
-            key, value = line.split('=', 1)
-            key = key.strip()
-            value = value.strip().strip('"')
-<<<<<<< HEAD
-
-=======
-            
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-            # Skip public key information
-            if key == 'ssh-public-key1':
-                skip_public_key = True
-                continue
-            if skip_public_key and key == 'set':
-                continue
-<<<<<<< HEAD
+        tokens = split_statement(line)
+        if tokens is None:
+            opening = _rfind_unescaped_quote(line)
+            blob_head = split_statement(line[:opening]) or []
+            blob_hash = new_blob_hash()
+            first = line[opening + 1:]
+            blob_hash.update(first.encode('utf-8', 'surrogatepass'))
+            blob_length = len(first)
+        elif tokens:
+            yield tokens
+
+# Function to parse configuration file
+#
+# Builds a tree of config_model nodes in a single pass:
+#   config <path>  -> ConfigSection holding the block's entries and attributes
+#   edit <name>    -> ConfigEntry holding the entry's attributes and nested blocks
+#   set <key> ...  -> tuple of the value tokens
+#   unset <key>    -> None
+# Names are interned, and values go through `values`, a ValueTable shared by the
+# configs of one batch (a fresh one for this config if none is given),
+# and every node gets a digest of its subtree as soon as it is closed. Blobs and
+# ENC secrets are kept only as a length and digest (see config_model.blob_value).
+def parse_config(lines, values=None):
+    if values is None:
+        values = ValueTable()
+    config = ConfigNode()
+    current = config
+    # Each frame is (statement, parent, name) for the block being filled in
+    stack = []
 
-=======
-            
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-            if current_subsection:
-                config[current_section][current_subsection][key] = value
-            else:
-                config[current_section][key] = value
+    for tokens in iter_statements(lines):
+        command = tokens[0]
 
+        if command == 'set':
+            if stack and len(tokens) > 1:
+                value_tokens = tokens[2:]
+                if len(value_tokens) > 1 and value_tokens[0] == 'ENC':
+                    value_tokens = ['ENC'] + [blob_value(value) for value in value_tokens[1:]]
+                current.children[intern_name(tokens[1])] = values.intern(value_tokens)
+        elif command == 'unset':
+            if stack and len(tokens) > 1:
+                current.children[intern_name(tokens[1])] = None
+        elif command == 'edit':
+            if len(tokens) > 1:
+                name = intern_name(tokens[1])
+                stack.append(('edit', current, name))
+                current = current.child(ConfigEntry, name)
+        elif command == 'next':
+            if stack and stack[-1][0] == 'edit':
+                current.update_digest()
+                current = stack.pop()[1]
+        elif command == 'config':
+            name = intern_name(' '.join(tokens[1:]))
+            stack.append(('config', current, name))
+            current = current.child(ConfigSection, name)
+        elif command == 'end':
+            # Close any edit left open, then the config block itself
+            while stack:
+                statement, parent, name = stack.pop()
+                if statement == 'config':
+                    if not current.children:
+                        del parent.children[name]
+                    else:
+                        current.update_digest()
+                    current = parent
+                    break
+                current.update_digest()
+                current = parent
+
+    # Nodes still open at the end of a truncated file get their digests here
+    config.update_digest()
     return config
 
+def _parse_config_file(file_path):
+    return parse_config(read_config_file(file_path))
+
+# Read and parse a configuration file, going through the parse cache if one is
+# given. Configs loaded with the same ValueTable share their values, whether
+# they were parsed or unpickled from the cache.
+def load_config(file_path, cache=None, values=None):
+    if cache is None:
+        return parse_config(read_config_file(file_path), values)
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+    config = cache.load(file_path, _parse_config_file, PARSER_VERSION)
+    return values.share(config) if values is not None else config
+
+# Marks a name missing from one side of a comparison
+_ABSENT = object()
+
 # Function to compare configurations
-<<<<<<< HEAD
-def compare_configs(config1, config2, filename1, filename2, ignore_keys=None):
-=======
-def compare_configs(config1, config2, ignore_keys=None):
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-    if ignore_keys is None:
-        ignore_keys = []
+#
+# Returns a list of Difference records; turning them into text is left to the
+# renderers in config_diff so unread differences are never formatted.
+def compare_configs(config1, config2, ignore_rules=None):
     differences = []
+    if config1.digest is None or config1.digest != config2.digest:
+        _compare_blocks(config1, config2, (), '', ignore_rules, differences)
+    return differences
 
-    all_sections = set(config1.keys()) | set(config2.keys())
-
-    for section in all_sections:
-        if section not in config1:
-<<<<<<< HEAD
-            differences.append(f"[Section Missing in {filename1}]\n  Section: '{section}' is in {filename2} but not in {filename1}\n")
-        elif section not in config2:
-            differences.append(f"[Section Missing in {filename2}]\n  Section: '{section}' is in {filename1} but not in {filename2}\n")
-=======
-            differences.append(f"[Section Missing in config1]\n  Section: '{section}' is in config2 but not in config1\n")
-        elif section not in config2:
-            differences.append(f"[Section Missing in config2]\n  Section: '{section}' is in config1 but not in config2\n")
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-        else:
-            section1 = config1[section]
-            section2 = config2[section]
-
-            if isinstance(section1, dict) and isinstance(section2, dict):
-                all_subsections = set(section1.keys()) | set(section2.keys())
-
-                for subsection in all_subsections:
-                    if subsection not in section1:
-<<<<<<< HEAD
-                        differences.append(f"[Subsection Missing in {filename1}]\n  Subsection: '{subsection}' in section '{section}' is in {filename2} but not in {filename1}\n")
-                    elif subsection not in section2:
-                        differences.append(f"[Subsection Missing in {filename2}]\n  Subsection: '{subsection}' in section '{section}' is in {filename1} but not in {filename2}\n")
-=======
-                        differences.append(f"[Subsection Missing in config1]\n  Subsection: '{subsection}' in section '{section}' is in config2 but not in config1\n")
-                    elif subsection not in section2:
-                        differences.append(f"[Subsection Missing in config2]\n  Subsection: '{subsection}' in section '{section}' is in config1 but not in config2\n")
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-                    else:
-                        subsection1 = section1[subsection]
-                        subsection2 = section2[subsection]
-
-                        if isinstance(subsection1, dict) and isinstance(subsection2, dict):
-                            all_keys = set(subsection1.keys()) | set(subsection2.keys())
-
-                            for key in all_keys:
-<<<<<<< HEAD
-                                if any(ignore_word in key for ignore_word in ignore_keys):
-=======
-                                if key in ignore_keys:
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-                                    continue
-                                if 'image-base64' in key or 'vpn certificate' in key:
-                                    continue
-                                if key not in subsection1:
-<<<<<<< HEAD
-                                    differences.append(f"[Key Missing in {filename1}]\n  Key: '{key}' in subsection '{subsection}' of section '{section}' is in {filename2} but not in {filename1}\n")
-                                elif key not in subsection2:
-                                    differences.append(f"[Key Missing in {filename2}]\n  Key: '{key}' in subsection '{subsection}' of section '{section}' is in {filename1} but not in {filename2}\n")
-                                elif subsection1[key] != subsection2[key]:
-                                    differences.append(f"[Value Difference]\n  Section: '{section}'\n  Subsection: '{subsection}'\n  Key: '{key}'\n  {filename1}: '{subsection1[key]}'\n  {filename2}: '{subsection2[key]}'\n")
-                        else:
-                            if subsection1 != subsection2:
-                                differences.append(f"[Subsection Value Difference]\n  Section: '{section}'\n  Subsection: '{subsection}'\n  {filename1}: '{subsection1}'\n  {filename2}: '{subsection2}'\n")
-            else:
-                if section1 != section2:
-                    differences.append(f"[Section Value Difference]\n  Section: '{section}'\n  {filename1}: '{section1}'\n  {filename2}: '{section2}'\n")
-=======
-                                    differences.append(f"[Key Missing in config1]\n  Key: '{key}' in subsection '{subsection}' of section '{section}' is in config2 but not in config1\n")
-                                elif key not in subsection2:
-                                    differences.append(f"[Key Missing in config2]\n  Key: '{key}' in subsection '{subsection}' of section '{section}' is in config1 but not in config2\n")
-                                elif subsection1[key] != subsection2[key]:
-                                    differences.append(f"[Value Difference]\n  Section: '{section}'\n  Subsection: '{subsection}'\n  Key: '{key}'\n  config1: '{subsection1[key]}'\n  config2: '{subsection2[key]}'\n")
-                        else:
-                            if subsection1 != subsection2:
-                                differences.append(f"[Subsection Value Difference]\n  Section: '{section}'\n  Subsection: '{subsection}'\n  config1: '{subsection1}'\n  config2: '{subsection2}'\n")
-            else:
-                if section1 != section2:
-                    differences.append(f"[Section Value Difference]\n  Section: '{section}'\n  config1: '{section1}'\n  config2: '{section2}'\n")
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
+# Recursively compare two blocks of the parsed tree, only descending into
+# subtrees whose digests differ and skipping anything the ignore rules match
+def _compare_blocks(block1, block2, path, location, ignore_rules, differences):
+    children1 = block1.children
+    children2 = block2.children
 
-    return differences
+    for name, value1 in children1.items():
+        value2 = children2.get(name, _ABSENT)
+        if value1 is value2:
+            continue
+        if ignore_rules is not None and (ignore_rules.ignores(name, location, value1)
+                                         or ignore_rules.ignores_value(value2)):
+            continue
 
-# Function to write differences to a file
-def write_differences_to_file(differences, output_file):
+        if value2 is _ABSENT:
+            differences.append(Difference(MISSING_RIGHT, path + (name,), value1, None))
+        elif isinstance(value1, ConfigNode) and isinstance(value2, ConfigNode):
+            if value1.digest is not None and value1.digest == value2.digest:
+                continue
+            compare = _compare_ordered_section if not path and name in ORDERED_SECTIONS else _compare_blocks
+            compare(value1, value2, path + (name,), location + ' > ' + name if location else name,
+                    ignore_rules, differences)
+        elif value1 != value2:
+            differences.append(Difference(CHANGED, path + (name,), value1, value2))
+
+    for name, value2 in children2.items():
+        if name in children1:
+            continue
+        if ignore_rules is not None and ignore_rules.ignores(name, location, value2):
+            continue
+        differences.append(Difference(MISSING_LEFT, path + (name,), None, value2))
+
+# Compare a table whose entries are evaluated in order, such as firewall policies.
+# Entries are paired by uuid, name or ID rather than by ID alone, so renumbered
+# policies are compared with their counterparts, and entries that changed
+# position relative to the rest are reported as moves.
+def _compare_ordered_section(section1, section2, path, location, ignore_rules, differences):
+    pairs, only1, only2 = match_entries(section1, section2)
+
+    for entry_id in only1:
+        if ignore_rules is None or not ignore_rules.ignores(entry_id, location, section1.children[entry_id]):
+            differences.append(Difference(MISSING_RIGHT, path + (entry_id,), section1.children[entry_id], None))
+    for entry_id in only2:
+        if ignore_rules is None or not ignore_rules.ignores(entry_id, location, section2.children[entry_id]):
+            differences.append(Difference(MISSING_LEFT, path + (entry_id,), None, section2.children[entry_id]))
+
+    for id1, id2 in pairs:
+        if ignore_rules is not None and ignore_rules.ignores(id1, location, section1.children[id1]):
+            continue
+        if id1 != id2:
+            differences.append(Difference(CHANGED, path + (id1, 'policyid'), (id1,), (id2,)))
+        entry1 = section1.children[id1]
+        entry2 = section2.children[id2]
+        if entry1.digest is None or entry1.digest != entry2.digest:
+            _compare_blocks(entry1, entry2, path + (id1,), location + ' > ' + id1, ignore_rules, differences)
+
+    for id1, id2, position1, position2 in find_moves(section1, section2, pairs):
+        if ignore_rules is None or not ignore_rules.ignores(id1, location, section1.children[id1]):
+            differences.append(Difference(MOVED, path + (id1,), (str(position1),), (str(position2),)))
+
+# Function to write differences to a file in one of the config_diff output formats
+def write_differences_to_file(differences, output_file, left_name='config1', right_name='config2', output_format='text'):
+    with open(output_file, 'w', newline='' if output_format == 'csv' else None) as file:
+        file.writelines(render_differences(differences, left_name, right_name, output_format))
+
+# Function to write the differences in objects that policies use, with the policies using them
+def write_referenced_differences_to_file(differences, config1, config2, output_file, left_name='config1', right_name='config2'):
+    flagged = referenced_differences(differences, config1, config2)
     with open(output_file, 'w') as file:
-        if not differences:
-            file.write("No differences found between the configurations.\n")
+        file.writelines(render_referenced_text(flagged, left_name, right_name))
+    return flagged
+
+# Short name for a config file, e.g. IBR_SONIC-01151 for IBR_SONIC-01151_7-0_0601_202410110853.conf
+def config_display_name(file_path):
+    return "_".join(os.path.splitext(os.path.basename(file_path))[0].split("_")[:2])
+
+# Expand directories into the config files they contain
+def collect_config_paths(paths):
+    config_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            config_paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.conf')))
         else:
-            for diff in differences:
-                file.write(diff + '\n')
+            config_paths.append(path)
+    return config_paths
+
+# Per-process state for fleet comparisons, set up once by _init_fleet_worker
+_fleet_template = None
+_fleet_template_name = None
+_fleet_output_dir = None
+_fleet_ignore_rules = None
+_fleet_output_format = None
+
+def _init_fleet_worker(template, template_name, output_dir, ignore_rules, output_format):
+    global _fleet_template, _fleet_template_name, _fleet_output_dir, _fleet_ignore_rules, _fleet_output_format
+    _fleet_template = template
+    _fleet_template_name = template_name
+    _fleet_output_dir = output_dir
+    _fleet_ignore_rules = ignore_rules
+    _fleet_output_format = output_format
+
+# Name of each store's diff file, without extension. Stores sharing a file name
+# in different directories get a digest of their directory appended, and any
+# name still taken (the same path given twice) a counter, so no diff file is
+# overwritten by another store's.
+def diff_file_stems(store_paths):
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in store_paths]
+    counts = Counter(stem.lower() for stem in stems)
+    used = set()
+    unique = []
+    for path, stem in zip(store_paths, stems):
+        if counts[stem.lower()] > 1:
+            directory = os.path.dirname(os.path.abspath(path)).encode('utf-8', 'surrogateescape')
+            stem = f"{stem}_{hashlib.blake2b(directory, digest_size=4).hexdigest()}"
+        candidate = stem
+        number = 2
+        while candidate.lower() in used:
+            candidate = f"{stem}_{number}"
+            number += 1
+        used.add(candidate.lower())
+        unique.append(candidate)
+    return unique
+
+# Compare one store config against the template and write its diff file
+def _compare_fleet_store(store_path, output_stem):
+    store_name = config_display_name(store_path)
+    output_file = os.path.join(_fleet_output_dir, output_stem + FILE_EXTENSIONS[_fleet_output_format])
+    try:
+        store = parse_config(read_config_file(store_path))
+        differences = compare_configs(_fleet_template, store, _fleet_ignore_rules)
+        write_differences_to_file(differences, output_file, _fleet_template_name, store_name, _fleet_output_format)
+        return {'store': store_name, 'path': store_path, 'difference_count': len(differences), 'diff_file': output_file, 'error': ''}
+    except Exception as e:
+        return {'store': store_name, 'path': store_path, 'difference_count': '', 'diff_file': '', 'error': str(e)}
+
+# Compare a golden template against many store configs using a process pool.
+# The template is parsed once and handed to each worker when it starts; every
+# store gets its own diff file and a roll-up CSV summarises the whole run.
+def compare_fleet(template_path, store_paths, output_dir, ignore_rules=None, workers=None, output_format='jsonl'):
+    os.makedirs(output_dir, exist_ok=True)
+
+    template = parse_config(read_config_file(template_path))
+    template_name = config_display_name(template_path)
+    init_args = (template, template_name, output_dir, ignore_rules, output_format)
+    output_stems = diff_file_stems(store_paths)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(store_paths) < 2:
+        _init_fleet_worker(*init_args)
+        results = list(map(_compare_fleet_store, store_paths, output_stems))
+    else:
+        chunksize = max(1, len(store_paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_fleet_worker, initargs=init_args) as executor:
+            results = list(executor.map(_compare_fleet_store, store_paths, output_stems, chunksize=chunksize))
+
+    summary_file = os.path.join(output_dir, 'fleet_summary.csv')
+    with open(summary_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['store', 'path', 'difference_count', 'diff_file', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+    return results, summary_file
+
+# Parse one store config for compare_fleet_drift, returning the tree or the error
+def _load_drift_store(store_path):
+    try:
+        return parse_config(read_config_file(store_path)), ''
+    except Exception as e:
+        return None, str(e)
+
+# Like executor.map, but with at most `window` calls submitted and not yet
+# consumed, so results that are large (whole parsed trees) do not pile up
+# in the parent faster than they are used. Results come back in order.
+def _bounded_map(executor, function, items, window):
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+    while pending:
+        yield pending.popleft().result()
+
+# Compare many store configs with each other rather than with a template.
+# Worker processes parse the configs and each tree is folded into a FleetDrift
+# as it comes back. Only a couple of parses per worker are in flight at once,
+# so the parsed trees held at any time do not grow with the fleet. Writes every
+# path where stores disagree with the majority, and a roll-up CSV with each
+# store's number of outlying paths.
+def compare_fleet_drift(store_paths, output_dir, ignore_rules=None, workers=None, output_format='jsonl'):
+    os.makedirs(output_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(store_paths) < 2:
+        loaded = map(_load_drift_store, store_paths)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        loaded = _bounded_map(executor, _load_drift_store, store_paths, workers * 2)
+
+    drift = FleetDrift(ignore_rules)
+    results = []
+    store_names = []
+    try:
+        for store_path, (config, error) in zip(store_paths, loaded):
+            result = {'store': config_display_name(store_path), 'path': store_path, 'outlier_count': '', 'error': error}
+            if config is not None:
+                drift.add(config)
+                store_names.append(result['store'])
+                result['outlier_count'] = 0
+            results.append(result)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    drifts = list(drift.drifts())
+    parsed = [result for result in results if not result['error']]
+    for _, histogram in drifts:
+        for _, stores in histogram[1:]:
+            for index in store_indices(stores):
+                parsed[index]['outlier_count'] += 1
+
+    drift_file = os.path.join(output_dir, 'fleet_drift' + DRIFT_FILE_EXTENSIONS[output_format])
+    with open(drift_file, 'w', newline='' if output_format == 'csv' else None) as file:
+        file.writelines(render_drift(drifts, store_names, output_format))
+
+    summary_file = os.path.join(output_dir, 'drift_summary.csv')
+    with open(summary_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['store', 'path', 'outlier_count', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+    return drifts, results, drift_file, summary_file
+
+# Per-process ignore rules for cluster_fleet, set up once by _init_cluster_worker
+_cluster_ignore_rules = None
+
+def _init_cluster_worker(ignore_rules):
+    global _cluster_ignore_rules
+    _cluster_ignore_rules = ignore_rules
+
+# Parse one store config and return its MinHash signature, or the error
+def _store_signature(store_path):
+    try:
+        return config_signature(parse_config(read_config_file(store_path)), _cluster_ignore_rules), ''
+    except Exception as e:
+        return None, str(e)
+
+# Group store configs built from the same template by the similarity of their
+# (path, value) sets. Workers parse each config and send back only its MinHash
+# signature, and stores are bucketed by LSH rather than diffed pairwise. Writes
+# each store's cluster, the cluster's medoid (the store to diff the others
+# against) and the store's estimated similarity to it.
+def cluster_fleet(store_paths, output_dir, ignore_rules=None, workers=None, threshold=DEFAULT_THRESHOLD):
+    os.makedirs(output_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(store_paths) < 2:
+        _init_cluster_worker(ignore_rules)
+        signatures = [_store_signature(path) for path in store_paths]
+    else:
+        chunksize = max(1, len(store_paths) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_cluster_worker,
+                                 initargs=(ignore_rules,)) as executor:
+            signatures = list(executor.map(_store_signature, store_paths, chunksize=chunksize))
+
+    index = SimilarityIndex(threshold=threshold)
+    parsed_paths = []
+    results = []
+    for store_path, (signature, error) in zip(store_paths, signatures):
+        if signature is not None:
+            index.add(signature)
+            parsed_paths.append(store_path)
+        else:
+            results.append({'cluster': '', 'store': config_display_name(store_path), 'path': store_path,
+                            'medoid': '', 'similarity': '', 'error': error})
+
+    clusters = index.clusters()
+    membership = []
+    for number, cluster in enumerate(clusters, 1):
+        medoid = config_display_name(parsed_paths[cluster.medoid])
+        for member, similarity in zip(cluster.members, cluster.similarity):
+            membership.append({'cluster': number, 'store': config_display_name(parsed_paths[member]),
+                               'path': parsed_paths[member], 'medoid': medoid,
+                               'similarity': round(similarity, 3), 'error': ''})
+    results = membership + results
+
+    clusters_file = os.path.join(output_dir, 'fleet_clusters.csv')
+    with open(clusters_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['cluster', 'store', 'path', 'medoid', 'similarity', 'error'])
+        writer.writeheader()
+        writer.writerows(results)
+    return [cluster._replace(members=[parsed_paths[member] for member in cluster.members],
+                             medoid=parsed_paths[cluster.medoid]) for cluster in clusters], results, clusters_file
+
+# Batch entry point: compare one template against every store config given
+def fleet_main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare a golden FortiGate template against many store configs.")
+    parser.add_argument('--template', help="Template configuration file")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--drift', action='store_true',
+                      help="Compare the stores with each other and report where each deviates from the majority")
+    mode.add_argument('--cluster', action='store_true',
+                      help="Group similar stores and pick the medoid config of each group")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help=f"Estimated similarity stores need to share a cluster (with --cluster, default {DEFAULT_THRESHOLD})")
+    parser.add_argument('--output-dir', default=os.path.join('diffs', 'fleet'), help="Directory for per-store diffs and the roll-up")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    parser.add_argument('--ignore-rules', default=None,
+                        help="Ignore rules file (default: ignore_rules.txt next to this script)")
+    parser.add_argument('--format', dest='output_format', default=None, choices=sorted(FILE_EXTENSIONS),
+                        help="Output format of the per-store diff files or the drift report (default: jsonl)")
+    parser.add_argument('stores', nargs='+', help="Store configuration files or directories of .conf files")
+    args = parser.parse_args(argv)
+    if not (args.drift or args.cluster) and not args.template:
+        parser.error("--template is required unless --drift or --cluster is given")
+    if (args.drift or args.cluster) and args.template:
+        parser.error("--drift and --cluster compare the stores with each other; --template does not apply")
+    if args.cluster and args.output_format is not None:
+        parser.error("--cluster always writes fleet_clusters.csv; --format does not apply")
+    if args.threshold is not None and not args.cluster:
+        parser.error("--threshold only applies with --cluster")
+    if args.output_format is None:
+        args.output_format = 'jsonl'
+    if args.drift and args.output_format not in DRIFT_FILE_EXTENSIONS:
+        parser.error(f"--drift writes one of: {', '.join(sorted(DRIFT_FILE_EXTENSIONS))}")
+
+    store_paths = [path for path in collect_config_paths(args.stores)
+                   if not args.template or os.path.abspath(path) != os.path.abspath(args.template)]
+    ignore_rules = IgnoreRules.from_file(args.ignore_rules) if args.ignore_rules else IgnoreRules.from_file()
+
+    if args.cluster:
+        clusters, results, clusters_file = cluster_fleet(store_paths, args.output_dir, ignore_rules,
+                                                         workers=args.workers,
+                                                         threshold=args.threshold if args.threshold is not None else DEFAULT_THRESHOLD)
+        for result in results:
+            if result['error']:
+                print(f"Failed to parse {result['path']}: {result['error']}")
+        print(f"{len(store_paths)} store configs form {len(clusters)} clusters; membership written to {clusters_file}")
+        return
+
+    if args.drift:
+        drifts, results, drift_file, summary_file = compare_fleet_drift(
+            store_paths, args.output_dir, ignore_rules, workers=args.workers, output_format=args.output_format)
+        for result in results:
+            if result['error']:
+                print(f"Failed to parse {result['path']}: {result['error']}")
+        print(f"{len(drifts)} paths differ across {len(store_paths)} store configs; "
+              f"written to {drift_file}, per-store counts in {summary_file}")
+        return
+    results, summary_file = compare_fleet(args.template, store_paths, args.output_dir, ignore_rules,
+                                          workers=args.workers, output_format=args.output_format)
+
+    failed = [result for result in results if result['error']]
+    for result in failed:
+        print(f"Failed to compare {result['path']}: {result['error']}")
+    print(f"Compared {len(results) - len(failed)} of {len(results)} store configs; summary written to {summary_file}")
 
 # Main function to load, parse, compare configurations, and write differences
 def main():
@@ -172,48 +583,33 @@ def main():
         # Get input files with default paths
         config1_path = input(f"Enter the name of the first configuration file (default directory: {default_dir}): ")
         config2_path = input(f"Enter the name of the second configuration file (default directory: {default_dir}): ")
-<<<<<<< HEAD
-=======
-        output_file = input(f"Enter the name for the output differences file (default directory: {default_dir}): ")
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
 
         # Prepend the default directory if the user didn't provide a full path
         config1_path = os.path.join(default_dir, config1_path) if not os.path.isabs(config1_path) else config1_path
         config2_path = os.path.join(default_dir, config2_path) if not os.path.isabs(config2_path) else config2_path
-<<<<<<< HEAD
-=======
-        output_file = os.path.join(default_dir, output_file) if not os.path.isabs(output_file) else output_file
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
 
-        config1_lines = read_config_file(config1_path)
-        config2_lines = read_config_file(config2_path)
+        cache = ParseCache()
+        values = ValueTable()
+        config1 = load_config(config1_path, cache, values)
+        config2 = load_config(config2_path, cache, values)
 
-        config1 = parse_config(config1_lines)
-        config2 = parse_config(config2_lines)
-
-<<<<<<< HEAD
         # Extract relevant filename parts
-        config1_name = "_".join(os.path.splitext(os.path.basename(config1_path))[0].split("_")[:2])
-        config2_name = "_".join(os.path.splitext(os.path.basename(config2_path))[0].split("_")[:2])
-
-        # You can customize this list based on your needs
-        ignore_keys = ['hostname', 'set-date', 'set password', 'set passphrase', 'set psksecret', 'set secret',
-                       'set secondary-secret', 'set passphrase ENC', 'set psksecret ENC', 'set secret ENC',
-                       'set secondary-secret ENC']
+        config1_name = config_display_name(config1_path)
+        config2_name = config_display_name(config2_path)
 
-        differences = compare_configs(config1, config2, config1_name, config2_name, ignore_keys)
+        # Customize ignore_rules.txt to change what the comparison skips
+        differences = compare_configs(config1, config2, IgnoreRules.from_file())
 
         output_file = "configdiff.txt"  # Constant output file name
-=======
-        # You can customize this list based on your needs
-        ignore_keys = ['hostname', 'set-date', 'set password','set passphrase','set psksecret','set secret','set secondary-secret']
-
-        differences = compare_configs(config1, config2, ignore_keys)
-
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
-        write_differences_to_file(differences, output_file)
+        write_differences_to_file(differences, output_file, config1_name, config2_name)
         print(f"Differences written to {output_file}")
 
+        # Changes to addresses, services and interfaces that policies rely on
+        referenced_file = "configdiff_referenced.txt"
+        flagged = write_referenced_differences_to_file(differences, config1, config2, referenced_file,
+                                                       config1_name, config2_name)
+        print(f"{len(flagged)} differences in objects used by policies written to {referenced_file}")
+
     except FileNotFoundError as e:
         print(e)
     except Exception as e:
@@ -223,8 +619,7 @@ def main():
         print(traceback.format_exc())
 
 if __name__ == "__main__":
-<<<<<<< HEAD
-    main()
-=======
-    main()
->>>>>>> f40ff1b41f35073a61fe390063306bcdb1a50dc2
+    if len(sys.argv) > 1:
+        fleet_main()
+    else:
+        main()
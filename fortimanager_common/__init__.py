@@ -0,0 +1,2 @@
+# FortiManager client, interface inventory storage, exports and background
+# refresh shared by the bww, arby and sonic query apps
@@ -0,0 +1,46 @@
+import io
+import csv
+import tempfile
+from openpyxl import Workbook
+
+# Function to stream rows as CSV text
+def csv_chunks(header, row_chunks):
+    """Yield CSV text for a header and an iterable of row lists, one piece per list.
+
+    Only one list of rows is formatted at a time, so memory does not grow with
+    the size of the export.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+# Function to write rows to a new temporary Excel file
+def write_xlsx(header, row_chunks, title):
+    """Write a header and an iterable of row lists to a new temporary .xlsx file.
+
+    The workbook is opened in write_only mode, which streams rows out instead
+    of keeping every cell in memory. Each call gets its own anonymous temporary
+    file, so concurrent exports never overwrite each other, and the file is
+    deleted as soon as it is closed. Returns the file, rewound to the start.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title[:31])
+    sheet.append(list(header))
+    for rows in row_chunks:
+        for row in rows:
+            sheet.append(list(row))
+
+    file = tempfile.TemporaryFile(prefix="export-", suffix=".xlsx")
+    try:
+        workbook.save(file)
+        file.seek(0)
+    except BaseException:
+        file.close()
+        raise
+    return file
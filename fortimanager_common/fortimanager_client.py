@@ -0,0 +1,253 @@
+import json
+import time
+import itertools
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+class FortiManagerError(Exception):
+    """Raised when FortiManager rejects a login or reports an API error."""
+
+class Query:
+    """Builder for the params entry of a FortiManager get request.
+
+    Asking FortiManager for only the needed columns and rows keeps responses
+    small, e.g. the VLAN 10 interfaces of a device with only their name and IP:
+
+        Query(url).fields('name', 'ip').filter('vlanid', '==', 10).loadsub(False)
+
+    Several filter() calls are combined with "&&".
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._params = {}
+
+    def fields(self, *names):
+        self._params["fields"] = list(names)
+        return self
+
+    def filter(self, attribute, operator, *values):
+        condition = [attribute, operator, *values]
+        existing = self._params.get("filter")
+        self._params["filter"] = condition if existing is None else [existing, "&&", condition]
+        return self
+
+    def option(self, *options):
+        self._params.setdefault("option", []).extend(options)
+        return self
+
+    # Whether to include sub-tables (e.g. an interface's secondary IPs) in each row
+    def loadsub(self, enabled):
+        self._params["loadsub"] = 1 if enabled else 0
+        return self
+
+    def build(self):
+        return dict(self._params, url=self.url)
+
+# Turn a URL or Query into a params entry
+def build_params(query):
+    if isinstance(query, Query):
+        return query.build()
+    return {"url": query}
+
+# Concurrent misses for the same key wait on one lock. Keys share a fixed set
+# of locks by hash, so the locks never grow with the number of keys cached.
+LOCK_STRIPES = 32
+
+class ResponseCache:
+    """Thread-safe cache of JSON-RPC responses that expire after `ttl` seconds.
+
+    Responses are keyed by method and params (which hold the URL and any
+    fields, filters or options). Concurrent requests for the same key wait
+    for the first one instead of each asking FortiManager, and failed calls
+    are never cached. A ttl of 0 disables caching.
+    """
+
+    def __init__(self, ttl, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._key_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(method, params):
+        return method + " " + json.dumps(params, sort_keys=True)
+
+    def get(self, key):
+        """Return (response, fetched_at) for a fresh entry, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or time.time() - entry[1] >= self.ttl:
+            return None
+        return entry
+
+    def put(self, key, response):
+        fetched_at = time.time()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                # Make room by dropping expired entries, or else the oldest one
+                self._entries = {k: entry for k, entry in self._entries.items() if fetched_at - entry[1] < self.ttl}
+                if len(self._entries) >= self.max_entries:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][1])]
+            entry = self._entries[key] = (response, fetched_at)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def fetch(self, key, call, refresh=False):
+        """Return (response, fetched_at) for key, calling `call()` on a miss or when refresh is set."""
+        if self.ttl <= 0:
+            return call(), time.time()
+        requested_at = time.time()
+        if not refresh:
+            entry = self.get(key)
+            if entry is not None:
+                return entry
+        with self._key_locks[hash(key) % len(self._key_locks)]:
+            # Another thread may have fetched it while this one waited; a forced
+            # refresh only accepts a response fetched after it was asked for
+            entry = self.get(key)
+            if entry is not None and (not refresh or entry[1] >= requested_at):
+                return entry
+            return self.put(key, call())
+
+class FortiManagerClient:
+    """JSON-RPC client for FortiManager.
+
+    All calls share one pooled keep-alive requests.Session with a retry
+    adapter, so connections and TLS sessions are reused across routes and
+    threads. The client logs in lazily on the first call, reuses the session
+    token afterwards and logs in again once if FortiManager reports the
+    session as invalid. A single client is safe to share between threads.
+    cached_call answers repeated requests from a ResponseCache for cache_ttl
+    seconds.
+    """
+
+    def __init__(self, url, username, password, verify=True, timeout=30, pool_size=16,
+                 retries=3, backoff_factor=0.3, cache_ttl=0):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.token = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.cache = ResponseCache(cache_ttl)
+
+        # JSON-RPC runs over POST, so retries must be allowed for any method
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(500, 502, 503, 504), allowed_methods=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _post(self, method, params, token=None):
+        payload = {"id": next(self._ids), "method": method, "params": params}
+        if token is not None:
+            payload["session"] = token
+        response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def login(self):
+        """Log in and return a new session token."""
+        logger.info("Obtaining session token from FortiManager")
+        json_response = self._post("exec", [{
+            "data": {"user": self.username, "passwd": self.password},
+            "url": "/sys/login/user"
+        }])
+        token = json_response.get("session")
+        if not token:
+            status = (json_response.get("result") or [{}])[0].get("status", {})
+            raise FortiManagerError(f"Failed to obtain session token: {status.get('message')}")
+        self.token = token
+        logger.info("Session token obtained successfully")
+        return token
+
+    def get_token(self):
+        """Return the current session token, logging in first if there is none."""
+        with self._lock:
+            if self.token is None:
+                self.login()
+            return self.token
+
+    # Log in again unless another thread already replaced the stale token
+    def _relogin(self, stale_token):
+        with self._lock:
+            if self.token == stale_token:
+                self.token = None
+                self.login()
+            return self.token
+
+    def logout(self):
+        with self._lock:
+            if self.token is None:
+                return
+            try:
+                self._post("exec", [{"url": "/sys/logout"}], self.token)
+            finally:
+                self.token = None
+
+    def call(self, method, params):
+        """Send a JSON-RPC request and return the decoded response."""
+        token = self.get_token()
+        json_response = self._post(method, params, token)
+        if is_invalid_session(json_response):
+            logger.info("Session token expired, logging in again")
+            json_response = self._post(method, params, self._relogin(token))
+        return json_response
+
+    def cached_call(self, method, params, refresh=False):
+        """Like call, but answer from the response cache while it is fresh.
+
+        Returns (json_response, fetched_at). Pass refresh=True to ask
+        FortiManager again and replace the cached response.
+        """
+        return self.cache.fetch(ResponseCache.key(method, params), lambda: self.call(method, params), refresh)
+
+    def get(self, query):
+        """Return the result for a URL or Query, raising FortiManagerError on an API error."""
+        result = (self.call("get", [build_params(query)]).get("result") or [{}])[0]
+        status = result.get("status", {})
+        if status.get("code", 0) != 0:
+            raise FortiManagerError(f"API error: {status.get('message')}")
+        return result
+
+    def batch_get(self, queries):
+        """Send several URLs or Query objects in a single JSON-RPC call.
+
+        FortiManager answers each entry of params with its own result, in the
+        same order, so the response is split back out into one result per query.
+        """
+        return split_results(self.call("get", [build_params(query) for query in queries]), len(queries))
+
+    def cached_batch_get(self, queries, refresh=False):
+        """Like batch_get, but answer from the response cache while it is fresh.
+
+        The whole batch is cached as one response. Returns (results, fetched_at).
+        """
+        json_response, fetched_at = self.cached_call("get", [build_params(query) for query in queries], refresh)
+        return split_results(json_response, len(queries)), fetched_at
+
+# One result per entry of a batched get's params, in order
+def split_results(json_response, count):
+    results = json_response.get("result") or []
+    missing = {"status": {"code": -1, "message": "No result returned for this URL"}}
+    return [results[index] if index < len(results) else missing for index in range(count)]
+
+# Check a JSON-RPC response for FortiManager's "Invalid session" error
+def is_invalid_session(json_response):
+    if json_response.get("error", {}).get("message") == "Invalid session":
+        return True
+    return any(result.get("status", {}).get("message") == "Invalid session"
+               for result in json_response.get("result") or [])
@@ -0,0 +1,92 @@
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Worker states
+IDLE = 'idle'
+RUNNING = 'running'
+
+# Timestamps are reported as ISO 8601 strings in UTC
+def utc_now():
+    return datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+class RefreshWorker:
+    """Runs inventory refreshes on a background thread.
+
+    A refresh runs when one is requested and, if ``interval`` is set, every
+    ``interval`` seconds after the previous one finished. Only one refresh
+    runs at a time; requests made while one is running are refused rather
+    than queued behind it. ``refresh`` is called with the requested ``full``
+    flag and returns a (message, status_code) pair, like the route handlers.
+    """
+
+    def __init__(self, refresh, interval=0):
+        self.refresh = refresh
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopping = False
+        self._pending = None  # None, or the full flag of the requested refresh
+        self._status = {'state': IDLE, 'full': None, 'ok': None, 'message': '',
+                        'started_at': None, 'finished_at': None}
+
+    def start(self):
+        """Start the background thread, if it is not running yet."""
+        with self._lock:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name='inventory-refresh', daemon=True)
+                self._thread.start()
+
+    def request(self, full=False):
+        """Ask for a refresh. Returns False if one is already running or requested."""
+        with self._lock:
+            if self._status['state'] == RUNNING or self._pending is not None:
+                return False
+            self._pending = full
+        self.start()
+        self._wake.set()
+        return True
+
+    def status(self):
+        with self._lock:
+            status = dict(self._status)
+            status['requested'] = self._pending is not None
+            return status
+
+    def is_running(self):
+        with self._lock:
+            return self._status['state'] == RUNNING or self._pending is not None
+
+    def stop(self, timeout=None):
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+        self._wake.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            # Sleep until a refresh is requested or the interval has passed
+            self._wake.wait(self.interval if self.interval > 0 else None)
+            self._wake.clear()
+            with self._lock:
+                if self._stopping:
+                    return
+                full = bool(self._pending)
+                self._pending = None
+                self._status.update(state=RUNNING, full=full, started_at=utc_now())
+
+            try:
+                message, status_code = self.refresh(full)
+                ok = status_code < 400
+            except Exception as e:
+                logger.exception("Inventory refresh failed")
+                message, ok = f"Unexpected error: {str(e)}", False
+
+            with self._lock:
+                self._status.update(state=IDLE, ok=ok, message=message, finished_at=utc_now())
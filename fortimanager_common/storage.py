@@ -0,0 +1,257 @@
+import json
+import base64
+import sqlite3
+import threading
+import ipaddress
+from datetime import datetime, timezone
+
+# Applied to every new connection. WAL lets /get_ips and the exports read while
+# a refresh is writing; with WAL, synchronous=NORMAL is still crash-safe and
+# avoids an fsync on every commit.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+)
+
+SCHEMA = (
+    # Every interface of every device from the last sweep. IPs are also kept as
+    # integers with their prefix length so subnet lookups are index range scans.
+    '''CREATE TABLE IF NOT EXISTS interfaces
+       (device_name TEXT NOT NULL, name TEXT NOT NULL, vlanid INTEGER, ip TEXT, netmask TEXT,
+        ip_int INTEGER, prefix_length INTEGER, type TEXT, status TEXT,
+        PRIMARY KEY (device_name, name))''',
+    # Filtering by VLAN and paging in device or IP order both seek straight
+    # into one of these indexes, however many interfaces are stored
+    "CREATE INDEX IF NOT EXISTS interfaces_vlanid_device ON interfaces (vlanid, device_name, name)",
+    "CREATE INDEX IF NOT EXISTS interfaces_vlanid_ip ON interfaces (vlanid, ip_int, device_name, name)",
+    "CREATE INDEX IF NOT EXISTS interfaces_ip ON interfaces (ip_int, device_name, name)",
+    '''CREATE TABLE IF NOT EXISTS device_revisions
+       (device_name TEXT PRIMARY KEY, revision TEXT)''',
+    # Facts about the stored snapshot, e.g. when it was last refreshed
+    '''CREATE TABLE IF NOT EXISTS sync_state
+       (key TEXT PRIMARY KEY, value TEXT)''',
+    # The VLAN 10 list the pages and exports show is now a view of the inventory
+    '''CREATE VIEW IF NOT EXISTS vlan10_ips AS
+       SELECT rowid AS id, device_name, ip AS ip_address FROM interfaces
+       WHERE vlanid = 10 AND ip_int IS NOT NULL AND ip_int != 0''',
+)
+
+# Upgrades for databases written by older versions, in order. A database
+# records how many it has had in PRAGMA user_version, so each one runs once.
+
+# Older databases cached VLAN 10 IPs in a table of their own. Drop it and
+# forget the synced revisions so the next refresh fills the inventory.
+def _drop_vlan10_table(conn):
+    existing = conn.execute("SELECT type FROM sqlite_master WHERE name = 'vlan10_ips'").fetchone()
+    if existing is not None and existing["type"] == "table":
+        conn.execute("DROP TABLE vlan10_ips")
+        conn.execute("DROP TABLE IF EXISTS device_revisions")
+
+# The single column VLAN and IP indexes were replaced by the covering ones in SCHEMA
+def _drop_single_column_indexes(conn):
+    conn.execute("DROP INDEX IF EXISTS interfaces_vlanid")
+    conn.execute("DROP INDEX IF EXISTS interfaces_ip_int")
+
+MIGRATIONS = (_drop_vlan10_table, _drop_single_column_indexes)
+
+# Columns of the interfaces table, in the order interface_row returns them
+INTERFACE_COLUMNS = ("device_name", "name", "vlanid", "ip", "netmask", "ip_int", "prefix_length", "type", "status")
+
+# Function to turn an interface returned by FortiManager into an interfaces row
+def interface_row(device_name, interface):
+    ip = netmask = ip_int = prefix_length = None
+    address = interface.get("ip")
+    if isinstance(address, str):
+        address = address.replace("/", " ").split()
+    if address:
+        try:
+            network = ipaddress.IPv4Interface("/".join(address[:2]))
+            ip, netmask = str(network.ip), str(network.netmask)
+            ip_int, prefix_length = int(network.ip), network.network.prefixlen
+        except ValueError:
+            ip = " ".join(address)
+    return (device_name, interface.get("name"), interface.get("vlanid"), ip, netmask, ip_int, prefix_length,
+            interface.get("type"), interface.get("status"))
+
+# Orderings the interface pages can be sorted by. Each ends with the primary key,
+# so the sort values of a page's last row say exactly where the next page starts.
+SORT_KEYS = {
+    "device": ("device_name", "name"),
+    "ip": ("ip_int", "device_name", "name"),
+}
+
+# Page cursors are the last row's sort values, JSON encoded and made URL safe
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return values
+
+# What each export writes, keyed by the name of the downloaded file: its header
+# row and the query producing its rows
+EXPORTS = {
+    "vlan10_ips": (("Device Name", "IP Address"),
+                   "SELECT device_name, ip_address FROM vlan10_ips ORDER BY device_name, ip_address"),
+    "interfaces": (("Device Name", "Interface", "VLAN ID", "IP Address", "Netmask", "Type", "Status"),
+                   "SELECT device_name, name, vlanid, ip, netmask, type, status FROM interfaces "
+                   "ORDER BY device_name, name"),
+}
+
+class Storage:
+    """SQLite storage for the interface inventory and the device revisions of the last sync.
+
+    Each thread keeps one open connection, so requests no longer pay for a
+    connect and pragma setup every time. Writes are batched with executemany
+    inside a single transaction.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._local = threading.local()
+
+    def connection(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, timeout=30)
+            conn.row_factory = sqlite3.Row
+            for pragma in PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection, if it has one."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def init(self):
+        conn = self.connection()
+        with conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for migration in MIGRATIONS[version:]:
+                migration(conn)
+            for statement in SCHEMA:
+                conn.execute(statement)
+            if version < len(MIGRATIONS):
+                conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+
+    def clear(self):
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM interfaces")
+            conn.execute("DELETE FROM device_revisions")
+            conn.execute("DELETE FROM sync_state")
+
+    def vlan_10_ips(self):
+        return self.connection().execute(
+            "SELECT id, device_name, ip_address FROM vlan10_ips ORDER BY device_name, ip_address").fetchall()
+
+    def interface_page(self, vlanid=None, subnet=None, device_name=None, sort="device", descending=False,
+                       after=None, limit=100):
+        """Return (rows, next_cursor) for one page of the interfaces matching every filter given.
+
+        `subnet` is an IPv4 network such as "10.20.0.0/16"; interfaces whose
+        address falls inside it match. Pages are keyset paginated: `after` is
+        the cursor returned with the previous page and the query seeks straight
+        to it, so a page costs the same however deep into the inventory it is.
+        next_cursor is None on the last page. Raises ValueError for an invalid
+        subnet, sort or cursor.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort: {sort}")
+        keys = SORT_KEYS[sort]
+        clauses = []
+        params = []
+        if vlanid is not None:
+            clauses.append("vlanid = ?")
+            params.append(vlanid)
+        if subnet:
+            network = ipaddress.IPv4Network(subnet, strict=False)
+            clauses.append("ip_int BETWEEN ? AND ?")
+            params.extend([int(network.network_address), int(network.broadcast_address)])
+        if device_name:
+            clauses.append("device_name = ?")
+            params.append(device_name)
+        if sort == "ip":
+            clauses.append("ip_int IS NOT NULL")
+        if after:
+            clauses.append(f"({', '.join(keys)}) {'<' if descending else '>'} ({', '.join('?' * len(keys))})")
+            params.extend(decode_cursor(after, len(keys)))
+
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        order = ", ".join(f"{key} DESC" if descending else key for key in keys)
+        params.append(limit + 1)
+        rows = self.connection().execute(
+            f"SELECT {', '.join(INTERFACE_COLUMNS)} FROM interfaces{where} ORDER BY {order} LIMIT ?",
+            params).fetchall()
+
+        # One row more than a page was asked for, to tell whether another page follows
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor([rows[-1][key] for key in keys])
+
+    def export_rows(self, export, chunk_rows=1000):
+        """Yield the rows of one of EXPORTS in lists of at most chunk_rows.
+
+        Uses a connection of its own, closed when the generator finishes or is
+        closed, so a slow download neither holds nor shares the thread's
+        cached connection and only one chunk is in memory at a time.
+        """
+        conn = sqlite3.connect(self.db_name, timeout=30)
+        try:
+            cursor = conn.execute(EXPORTS[export][1])
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+    def refreshed_at(self):
+        """Return when the stored snapshot was last refreshed (ISO 8601, UTC), or None."""
+        row = self.connection().execute("SELECT value FROM sync_state WHERE key = 'refreshed_at'").fetchone()
+        return row["value"] if row is not None else None
+
+    def device_revisions(self):
+        """Return the stored revision of every device synced so far."""
+        return {row["device_name"]: row["revision"]
+                for row in self.connection().execute("SELECT device_name, revision FROM device_revisions")}
+
+    def replace_devices(self, interfaces, refreshed, revisions, removed):
+        """Replace the interfaces of refreshed and removed devices and upsert their revisions.
+
+        `interfaces` holds interface_row tuples for the refreshed devices.
+        Every refreshed device gets a revision row, NULL if it reported none,
+        so it is still known, and later removed, when it has no checksum.
+        Everything happens in one transaction, so readers see either the old
+        rows or the new ones, together with the time they were refreshed.
+        """
+        refreshed_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        stale = [(device_name,) for device_name in list(refreshed) + list(removed)]
+        conn = self.connection()
+        with conn:
+            conn.executemany("DELETE FROM interfaces WHERE device_name = ?", stale)
+            conn.executemany(f'''INSERT INTO interfaces ({', '.join(INTERFACE_COLUMNS)})
+                                 VALUES ({', '.join('?' * len(INTERFACE_COLUMNS))})
+                                 ON CONFLICT (device_name, name) DO NOTHING''', interfaces)
+            conn.executemany("DELETE FROM device_revisions WHERE device_name = ?",
+                             [(device_name,) for device_name in removed])
+            conn.executemany('''INSERT INTO device_revisions (device_name, revision) VALUES (?, ?)
+                                ON CONFLICT (device_name) DO UPDATE SET revision = excluded.revision''',
+                             [(device_name, revisions.get(device_name)) for device_name in refreshed])
+            conn.execute('''INSERT INTO sync_state (key, value) VALUES ('refreshed_at', ?)
+                            ON CONFLICT (key) DO UPDATE SET value = excluded.value''', (refreshed_at,))
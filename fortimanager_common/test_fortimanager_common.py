@@ -0,0 +1,148 @@
+import sqlite3
+import threading
+import pytest
+from openpyxl import load_workbook
+from fortimanager_common.fortimanager_client import FortiManagerClient, Query, ResponseCache, LOCK_STRIPES
+from fortimanager_common.storage import Storage, interface_row, EXPORTS, MIGRATIONS
+from fortimanager_common.exports import csv_chunks, write_xlsx
+from fortimanager_common.refresh_worker import RefreshWorker, IDLE, RUNNING
+
+def test_storage_replaces_only_refreshed_devices(tmp_path):
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    def vlan10(device_name, ip):
+        return interface_row(device_name, {'name': 'vlan10', 'vlanid': 10, 'ip': [ip, '255.255.255.0']})
+    storage.replace_devices([vlan10('store1', '10.0.0.1'), vlan10('store2', '10.0.0.2'), vlan10('store2', '10.0.0.2')],
+                            ['store1', 'store2'], {'store1': 'r1', 'store2': 'r2'}, [])
+    storage.replace_devices([vlan10('store2', '10.0.0.3')], ['store2'], {'store2': 'r3'}, ['store1'])
+    assert [tuple(row)[1:] for row in storage.vlan_10_ips()] == [('store2', '10.0.0.3')]
+    assert storage.device_revisions() == {'store2': 'r3'}
+    assert storage.connection().execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+def test_storage_init_migrates_old_databases_once(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'test.db'))
+    conn.execute('CREATE TABLE vlan10_ips (id INTEGER PRIMARY KEY, device_name TEXT, ip_address TEXT)')
+    conn.execute('CREATE TABLE interfaces (device_name TEXT NOT NULL, name TEXT NOT NULL, vlanid INTEGER, ip TEXT, '
+                 'netmask TEXT, ip_int INTEGER, prefix_length INTEGER, type TEXT, status TEXT, '
+                 'PRIMARY KEY (device_name, name))')
+    conn.execute('CREATE INDEX interfaces_vlanid ON interfaces (vlanid)')
+    conn.commit()
+    conn.close()
+
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    def names():
+        return {row[0] for row in storage.connection().execute("SELECT name FROM sqlite_master")}
+    assert 'interfaces_vlanid' not in names() and 'interfaces_vlanid_device' in names()
+    assert storage.connection().execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+
+    # Migrations that already ran are not repeated
+    storage.connection().execute('CREATE INDEX interfaces_vlanid ON interfaces (vlanid)')
+    storage.init()
+    assert 'interfaces_vlanid' in names()
+
+def test_query_builder_projects_fields_and_filters():
+    query = Query('/dvmdb/device').fields('name', 'ip').filter('vlanid', '==', 10).filter('status', '==', 'up')
+    assert query.option('count').loadsub(False).build() == {
+        'url': '/dvmdb/device',
+        'fields': ['name', 'ip'],
+        'filter': [['vlanid', '==', 10], '&&', ['status', '==', 'up']],
+        'option': ['count'],
+        'loadsub': 0,
+    }
+
+def test_client_logs_in_once_and_again_on_invalid_session(mocker):
+    client = FortiManagerClient('https://fmg/jsonrpc', 'user', 'secret')
+    responses = [
+        {'session': 'token1'},
+        {'result': [{'status': {'code': 0}, 'data': []}]},
+        {'result': [{'status': {'code': -11, 'message': 'Invalid session'}}]},
+        {'session': 'token2'},
+        {'result': [{'status': {'code': 0}, 'data': [{'name': 'store1'}]}]},
+    ]
+    post = mocker.patch.object(client.session, 'post')
+    post.return_value.json.side_effect = responses
+    client.get('/dvmdb/device')
+    assert client.get('/dvmdb/device')['data'] == [{'name': 'store1'}]
+    sessions = [call.kwargs['json'].get('session') for call in post.call_args_list]
+    assert sessions == [None, 'token1', 'token1', None, 'token2']
+
+def test_response_cache_reuses_fresh_entries_with_a_fixed_set_of_locks():
+    cache = ResponseCache(60, max_entries=8)
+    calls = []
+    for index in range(100):
+        cache.fetch(f'get /url/{index}', lambda: calls.append(index) or {'index': index})
+    assert len(cache._key_locks) == LOCK_STRIPES and len(cache._entries) == 8
+    assert cache.fetch('get /url/99', lambda: calls.append('again'))[0] == {'index': 99}
+    assert cache.fetch('get /url/99', lambda: {'index': 'refreshed'}, refresh=True)[0] == {'index': 'refreshed'}
+    assert len(calls) == 100
+
+def test_interface_inventory_filters_by_vlan_subnet_and_device(tmp_path):
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    rows = [
+        interface_row('store1', {'name': 'vlan10', 'vlanid': 10, 'ip': ['10.1.10.1', '255.255.255.0'], 'type': 'vlan', 'status': 'up'}),
+        interface_row('store1', {'name': 'wan1', 'vlanid': 0, 'ip': ['203.0.113.5', '255.255.255.248'], 'type': 'physical', 'status': 'up'}),
+        interface_row('store2', {'name': 'vlan10', 'vlanid': 10, 'ip': ['10.2.10.1', '255.255.255.0'], 'type': 'vlan', 'status': 'down'}),
+        interface_row('store2', {'name': 'vlan20', 'vlanid': 20, 'ip': ['0.0.0.0', '0.0.0.0'], 'type': 'vlan'}),
+    ]
+    storage.replace_devices(rows, ['store1', 'store2'], {}, [])
+
+    def names(**filters):
+        rows, _ = storage.interface_page(**filters)
+        return [(row['device_name'], row['name']) for row in rows]
+    assert names(vlanid=10) == [('store1', 'vlan10'), ('store2', 'vlan10')]
+    assert names(subnet='10.2.0.0/16') == [('store2', 'vlan10')]
+    assert names(subnet='10.0.0.0/8', device_name='store1') == [('store1', 'vlan10')]
+    assert dict(storage.interface_page(device_name='store1', vlanid=0)[0][0])['prefix_length'] == 29
+    assert [tuple(row)[1:] for row in storage.vlan_10_ips()] == [('store1', '10.1.10.1'), ('store2', '10.2.10.1')]
+    with pytest.raises(ValueError):
+        storage.interface_page(subnet='not-a-subnet')
+
+def test_exports_stream_in_chunks_to_separate_files(tmp_path):
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    rows = [interface_row(f'store{index:03}', {'name': 'vlan10', 'vlanid': 10, 'ip': [f'10.0.{index}.1', '255.255.255.0']})
+            for index in range(250)]
+    storage.replace_devices(rows, [row[0] for row in rows], {}, [])
+
+    chunks = list(csv_chunks(EXPORTS['vlan10_ips'][0], storage.export_rows('vlan10_ips', chunk_rows=100)))
+    assert len(chunks) == 4
+    lines = ''.join(chunks).splitlines()
+    assert lines[0] == 'Device Name,IP Address'
+    assert lines[1] == 'store000,10.0.0.1' and len(lines) == 251
+
+    files = [write_xlsx(EXPORTS['interfaces'][0], storage.export_rows('interfaces'), 'interfaces') for _ in range(2)]
+    assert files[0].fileno() != files[1].fileno()
+    sheet = load_workbook(files[0])['interfaces']
+    assert sheet.max_row == 251
+    assert sheet.cell(row=2, column=4).value == '10.0.0.1'
+    for file in files:
+        file.close()
+
+def test_refresh_worker_runs_one_refresh_at_a_time_in_the_background():
+    release = threading.Event()
+    calls = []
+
+    def refresh(full):
+        calls.append(full)
+        release.wait(5)
+        return 'Refreshed', 200
+
+    worker = RefreshWorker(refresh)
+    assert worker.request(full=True)
+    for _ in range(500):
+        if worker.status()['state'] == RUNNING:
+            break
+        threading.Event().wait(0.01)
+    assert worker.status()['state'] == RUNNING
+    assert not worker.request()
+    release.set()
+    for _ in range(500):
+        if worker.status()['state'] == IDLE:
+            break
+        threading.Event().wait(0.01)
+    status = worker.status()
+    worker.stop(5)
+    assert calls == [True]
+    assert status['ok'] and status['message'] == 'Refreshed' and status['finished_at']
@@ -0,0 +1,98 @@
+import os
+import re
+import fnmatch
+from functools import lru_cache
+from config_model import ConfigNode
+
+# Rules file shipped next to the comparator
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ignore_rules.txt')
+
+RULE_TYPES = ('key', 'path', 'regex', 'value')
+
+# Most names and values recur across configs, so a few thousand memoised
+# answers cover nearly every lookup without growing with each config seen
+MEMO_SIZE = 4096
+
+# Combine several patterns into a single compiled alternation, or None if there are none
+def _combine(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns))
+
+class IgnoreRules:
+    """Compiled set of rules for parts of a config the comparator should skip.
+
+    Rule types:
+      key    glob matched against an attribute (set/unset) name
+      path   glob matched against the full path, e.g. "system global > hostname"
+      regex  regular expression searched for in the full path
+      value  glob matched against an attribute's value, e.g. "ENC *"
+
+    Sections and entries are only skipped by path and regex rules, so a key
+    rule such as "*password*" never drops a whole "system password-policy"
+    block. All patterns of a kind are compiled into one regex up front, and
+    results for names and values are memoised in bounded LRU caches.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+        patterns = {rule_type: [] for rule_type in RULE_TYPES}
+        for rule_type, pattern in self.rules:
+            if rule_type not in patterns:
+                raise ValueError(f"Unknown ignore rule type: {rule_type}")
+            patterns[rule_type].append(pattern)
+
+        self._name_re = _combine([fnmatch.translate(pattern) for pattern in patterns['key']])
+        self._path_re = _combine(['^' + fnmatch.translate(pattern) for pattern in patterns['path']] + patterns['regex'])
+        self._value_re = _combine([fnmatch.translate(pattern) for pattern in patterns['value']])
+        self.ignores_name = lru_cache(maxsize=MEMO_SIZE)(self._ignores_name)
+        self._ignores_value = lru_cache(maxsize=MEMO_SIZE)(self._match_value)
+
+    # Build rules from lines of "<type> <pattern>"; blank lines and # comments are skipped
+    @classmethod
+    def parse(cls, lines):
+        rules = []
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            rule_type, _, pattern = line.partition(' ')
+            pattern = pattern.strip()
+            if rule_type not in RULE_TYPES or not pattern:
+                raise ValueError(f"Invalid ignore rule on line {line_number}: {line}")
+            rules.append((rule_type, pattern))
+        return cls(rules)
+
+    @classmethod
+    def from_file(cls, file_path=DEFAULT_RULES_FILE):
+        with open(file_path, 'r') as file:
+            return cls.parse(file)
+
+    # Whether a key rule matches an attribute name; memoised per instance in __init__
+    def _ignores_name(self, name):
+        return self._name_re is not None and self._name_re.match(name) is not None
+
+    def _match_value(self, value):
+        return self._value_re.match(' '.join(value)) is not None
+
+    def ignores_value(self, value):
+        if self._value_re is None or value is None or not isinstance(value, tuple):
+            return False
+        return self._ignores_value(value)
+
+    # Check whether `name` under the parent path `location` (names joined with
+    # " > ", empty at the top level) should be skipped. `value` is the parsed
+    # value, or the ConfigNode for a section or entry, which key rules never match.
+    def ignores(self, name, location='', value=None):
+        if not isinstance(value, ConfigNode) and self.ignores_name(name):
+            return True
+        if self._path_re is not None and self._path_re.search(location + ' > ' + name if location else name):
+            return True
+        return self.ignores_value(value)
+
+    # Memo tables are rebuilt in each process rather than shipped with the rules
+    def __getstate__(self):
+        return self.rules
+
+    def __setstate__(self, rules):
+        self.__init__(rules)
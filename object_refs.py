@@ -0,0 +1,184 @@
+from collections import namedtuple
+from config_model import ConfigNode
+from config_diff import render_text
+from policy_diff import ORDERED_SECTIONS
+
+# Config tables defining named objects, and the namespace each one's names
+# live in. FortiOS resolves an address name against addresses and address
+# groups alike, so tables sharing a namespace share a kind.
+OBJECT_TABLES = {
+    'firewall address': 'address',
+    'firewall addrgrp': 'address',
+    'firewall vip': 'address',
+    'firewall vipgrp': 'address',
+    'firewall service custom': 'service',
+    'firewall service group': 'service',
+    'system interface': 'interface',
+    'system zone': 'interface',
+}
+
+# Attributes naming other objects, per table. Group members may be groups themselves.
+MEMBER_ATTRIBUTES = {
+    'firewall addrgrp': {'member': 'address'},
+    'firewall vipgrp': {'member': 'address'},
+    'firewall service group': {'member': 'service'},
+    'system zone': {'interface': 'interface'},
+}
+
+# Attributes of a policy naming the objects it matches on
+POLICY_ATTRIBUTES = {
+    'srcaddr': 'address',
+    'dstaddr': 'address',
+    'service': 'service',
+    'srcintf': 'interface',
+    'dstintf': 'interface',
+}
+
+# A difference inside an object that is in use. ``policies1`` and
+# ``policies2`` are the paths of the policies using the object in each config,
+# directly or through groups.
+ReferencedDifference = namedtuple('ReferencedDifference', ['difference', 'kind', 'name', 'policies1', 'policies2'])
+
+class ReferenceIndex:
+    """Links between the policies, groups and objects of one parsed config.
+
+    Objects are identified by (kind, name) and referrers by their config
+    path, e.g. ('firewall policy', '10') or ('firewall addrgrp', 'NON-USA').
+    ``references`` holds the forward edges of every policy and group and
+    ``referrers`` the reverse edges of every object named anywhere, so a
+    lookup is a dict access and a traversal only visits what it returns.
+    """
+
+    def __init__(self, config):
+        self.objects = {}
+        self.references = {}
+        self.referrers = {}
+        self._members = {}
+        self._expanded = {}
+
+        for section_name, kind in OBJECT_TABLES.items():
+            section = config.get(section_name)
+            if section is None:
+                continue
+            attributes = MEMBER_ATTRIBUTES.get(section_name, {})
+            for name, entry in section.items():
+                if not isinstance(entry, ConfigNode):
+                    continue
+                self.objects.setdefault((kind, name), (section_name, name))
+                for attribute, member_kind in attributes.items():
+                    members = entry.get(attribute)
+                    if members:
+                        self._members[(kind, name)] = [(member_kind, member) for member in members]
+                        self._link((section_name, name), self._members[(kind, name)])
+
+        for section_name in ORDERED_SECTIONS:
+            section = config.get(section_name)
+            if section is None:
+                continue
+            for policy_id, policy in section.items():
+                if not isinstance(policy, ConfigNode):
+                    continue
+                targets = [(kind, value) for attribute, kind in POLICY_ATTRIBUTES.items()
+                           for value in policy.get(attribute) or ()]
+                self._link((section_name, policy_id), targets)
+
+    def _link(self, referrer, targets):
+        self.references[referrer] = targets
+        for target in targets:
+            self.referrers.setdefault(target, []).append(referrer)
+
+    def is_group(self, kind, name):
+        return (kind, name) in self._members
+
+    # Policies and groups naming the object directly
+    def used_by(self, kind, name):
+        return self.referrers.get((kind, name), [])
+
+    # Paths of every policy using the object, directly or through any number
+    # of nested groups, each listed once
+    def policies_using(self, kind, name):
+        policies = []
+        seen = set()
+        pending = [(kind, name)]
+        while pending:
+            target = pending.pop()
+            for referrer in self.referrers.get(target, ()):
+                if referrer in seen:
+                    continue
+                seen.add(referrer)
+                if referrer[0] in ORDERED_SECTIONS:
+                    policies.append(referrer)
+                else:
+                    pending.append((OBJECT_TABLES[referrer[0]], referrer[1]))
+        return policies
+
+    # The non-group objects a group resolves to, following nested groups.
+    # Results are memoised, so each group is expanded once per config.
+    def expand(self, kind, name):
+        return self._expand((kind, name), set())[0]
+
+    # Return (leaves, cycle) for a group, where ``cycle`` holds the groups on
+    # the current path that it leads back to. A group inside a cycle sees only
+    # part of the cycle's leaves while its caller is still expanding, so only
+    # results that reach no active group are memoised.
+    def _expand(self, key, active):
+        expanded = self._expanded.get(key)
+        if expanded is not None:
+            return expanded, set()
+        if key not in self._members:
+            return [key], set()
+        if key in active:
+            return [], {key}
+
+        active.add(key)
+        expanded = []
+        seen = set()
+        cycle = set()
+        for member in self._members[key]:
+            leaves, member_cycle = self._expand(member, active)
+            cycle |= member_cycle
+            for leaf in leaves:
+                if leaf not in seen:
+                    seen.add(leaf)
+                    expanded.append(leaf)
+        active.discard(key)
+        cycle.discard(key)
+        if not cycle:
+            self._expanded[key] = expanded
+        return expanded, cycle
+
+    def is_referenced(self, kind, name):
+        return (kind, name) in self.referrers
+
+# Return the differences inside objects that a policy uses in either config,
+# with the policies using them. Differences covering a whole object table are
+# not attributed to any one object. Each config is indexed once per call, and
+# the indexes go with it rather than keeping the configs alive.
+def referenced_differences(differences, config1, config2):
+    index1 = ReferenceIndex(config1)
+    index2 = ReferenceIndex(config2)
+    flagged = []
+    for difference in differences:
+        path = difference.path
+        kind = OBJECT_TABLES.get(path[0])
+        if kind is None or len(path) < 2:
+            continue
+        name = path[1]
+        policies1 = index1.policies_using(kind, name)
+        policies2 = index2.policies_using(kind, name)
+        if policies1 or policies2:
+            flagged.append(ReferencedDifference(difference, kind, name, policies1, policies2))
+    return flagged
+
+def _format_policies(policies):
+    return ', '.join(f"{section} {policy_id}" for section, policy_id in policies) or 'no policies'
+
+# Render flagged differences as text, each headed by the policies it affects
+def render_referenced_text(flagged, left_name, right_name):
+    if not flagged:
+        yield "No differences found in referenced objects.\n"
+    for difference, kind, name, policies1, policies2 in flagged:
+        yield (f"[Referenced {kind.capitalize()} '{name}']\n"
+               f"  Used in {left_name} by: {_format_policies(policies1)}\n"
+               f"  Used in {right_name} by: {_format_policies(policies2)}\n")
+        yield from render_text([difference], left_name, right_name)
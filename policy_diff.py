@@ -0,0 +1,95 @@
+from bisect import bisect_left
+
+# Config tables whose entries are evaluated top-down, so their order matters
+ORDERED_SECTIONS = frozenset([
+    'firewall policy',
+    'firewall policy6',
+    'firewall proxy-policy',
+    'firewall local-in-policy',
+    'firewall multicast-policy',
+    'firewall shaping-policy',
+    'firewall DoS-policy',
+])
+
+# Attributes tried in turn to pair up entries between two configs. Policy IDs
+# are often renumbered between stores and uuids only survive when a policy was
+# pushed rather than recreated, so each stage only sees entries the earlier
+# stages could not pair.
+MATCH_ATTRIBUTES = ('uuid', 'name')
+
+def _first_value(entry, attribute):
+    value = entry.children.get(attribute)
+    if value:
+        return value[0]
+    return None
+
+# Pair the entries of two sections by uuid, then name, then edit ID.
+# Returns (pairs, only1, only2) where pairs is a list of (id1, id2) in section1 order.
+def match_entries(section1, section2):
+    unmatched1 = dict(section1.children)
+    unmatched2 = dict(section2.children)
+    matched = {}
+
+    for attribute in MATCH_ATTRIBUTES:
+        index2 = {}
+        for entry_id, entry in unmatched2.items():
+            key = _first_value(entry, attribute)
+            if key is not None:
+                index2.setdefault(key, entry_id)
+        if not index2:
+            continue
+        for entry_id, entry in list(unmatched1.items()):
+            key = _first_value(entry, attribute)
+            other_id = index2.get(key) if key is not None else None
+            if other_id is not None and other_id in unmatched2:
+                matched[entry_id] = other_id
+                del unmatched1[entry_id]
+                del unmatched2[other_id]
+
+    for entry_id in list(unmatched1):
+        if entry_id in unmatched2:
+            matched[entry_id] = entry_id
+            del unmatched1[entry_id]
+            del unmatched2[entry_id]
+
+    pairs = [(entry_id, matched[entry_id]) for entry_id in section1.children if entry_id in matched]
+    return pairs, list(unmatched1), list(unmatched2)
+
+# Indices of one longest strictly increasing subsequence of `sequence`, in O(n log n)
+def longest_increasing_subsequence(sequence):
+    tails = []          # smallest tail value of an increasing run of each length
+    tail_indices = []   # index in sequence of each of those tails
+    previous = [-1] * len(sequence)
+    for index, value in enumerate(sequence):
+        length = bisect_left(tails, value)
+        if length == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[length] = value
+            tail_indices[length] = index
+        previous[index] = tail_indices[length - 1] if length else -1
+
+    result = set()
+    index = tail_indices[-1] if tail_indices else -1
+    while index >= 0:
+        result.add(index)
+        index = previous[index]
+    return result
+
+# Find the matched entries that changed position relative to the others.
+#
+# Entries in the longest run that kept its relative order stay put; every other
+# matched entry is reported as moved, which gives the fewest moves that turn
+# section1's order into section2's. Returns (id1, id2, position1, position2)
+# tuples with 1-based positions, in section2 order.
+def find_moves(section1, section2, pairs):
+    positions1 = {entry_id: position for position, entry_id in enumerate(section1.children, 1)}
+    positions2 = {entry_id: position for position, entry_id in enumerate(section2.children, 1)}
+
+    in_order2 = sorted(pairs, key=lambda pair: positions2[pair[1]])
+    sequence = [positions1[id1] for id1, _ in in_order2]
+    kept = longest_increasing_subsequence(sequence)
+
+    return [(id1, id2, positions1[id1], positions2[id2])
+            for index, (id1, id2) in enumerate(in_order2) if index not in kept]
@@ -7,6 +7,9 @@ call venv\Scripts\activate.bat
 REM Install requirements
 pip install -r requirements.txt
 
+REM Install the modules shared by the query apps from the top of the repository
+pip install -e ..
+
 REM Create .env file from .env.example if it doesn't exist
 if not exist .env (
     copy .env.example .env
@@ -7,6 +7,9 @@ source venv/bin/activate
 # Install requirements
 pip install -r requirements.txt
 
+# Install the modules shared by the query apps from the top of the repository
+pip install -e ..
+
 # Create .env file from .env.example if it doesn't exist
 if [ ! -f .env ]; then
     cp .env.example .env
@@ -0,0 +1,147 @@
+import pytest
+import app_session
+from app_session import app
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture
+def storage(mocker, tmp_path):
+    from fortimanager_common.storage import Storage
+    storage = Storage(str(tmp_path / 'test.db'))
+    storage.init()
+    mocker.patch('app_session.storage', storage)
+    yield storage
+    storage.close()
+
+def fake_batch_get(queries):
+    if any('/offline/' in query.url for query in queries):
+        raise Exception('timed out')
+    return [{'status': {'code': -3, 'message': 'Object does not exist'}} if '/broken/' in query.url
+            else {'status': {'code': 0},
+                  'data': [{'name': 'vlan10', 'vlanid': 10, 'ip': ['10.0.0.1', '255.255.255.0']}]}
+            for query in queries]
+
+def device_list(*devices):
+    return {'result': [{'status': {'code': 0, 'message': 'OK'}, 'data': list(devices)}]}
+
+def test_index_route(client):
+    response = client.get('/')
+    assert response.status_code == 200
+    assert b"FortiManager Query App" in response.data
+
+def test_fetch_all_device_interfaces_batches_and_isolates_failures(mocker):
+    batch_get = mocker.patch('app_session.client.batch_get', side_effect=fake_batch_get)
+    mocker.patch('app_session.FETCH_BATCH_SIZE', 2)
+    interfaces, errors = app_session.fetch_all_device_interfaces(['store1', 'broken', 'store2', 'offline'])
+    # The failed batch is retried one device per call, so store2 still succeeds
+    assert batch_get.call_count == 4
+    assert sorted(interfaces) == ['store1', 'store2']
+    assert errors == {'broken': 'API error: Object does not exist', 'offline': 'timed out'}
+
+def test_plan_sync_only_refetches_changed_devices():
+    revisions = {
+        'store1': app_session.device_revision({'name': 'store1', 'checksum': 'a'}),
+        'store2': app_session.device_revision({'name': 'store2', 'checksum': 'c'}),
+        'store3': app_session.device_revision({'name': 'store3', 'conf_status': 1, 'db_status': 1}),
+    }
+    known = {'store1': 'a', 'store2': 'b', 'store3': None, 'closed': 'x'}
+    assert revisions['store3'] is None
+    assert app_session.plan_sync(revisions, known) == (['store2', 'store3'], ['closed'])
+    assert app_session.plan_sync(revisions, known, full=True)[0] == list(revisions)
+
+def test_refresh_inventory_fetches_only_changed_devices(mocker, storage):
+    call = mocker.patch('app_session.client.call',
+                        return_value=device_list({'name': 'store1', 'checksum': 'a'}, {'name': 'store2', 'checksum': 'b'}))
+    batch_get = mocker.patch('app_session.client.batch_get', side_effect=fake_batch_get)
+    message, status = app_session.refresh_inventory()
+    assert status == 200
+    assert call.call_args.args[1][0]['fields'] == ['name', 'checksum']
+    assert [tuple(row)[1:] for row in storage.vlan_10_ips()] == [('store1', '10.0.0.1'), ('store2', '10.0.0.1')]
+    assert storage.device_revisions() == {'store1': 'a', 'store2': 'b'}
+
+    call.return_value = device_list({'name': 'store1', 'checksum': 'a'}, {'name': 'store3', 'checksum': 'c'})
+    batch_get.reset_mock()
+    message, status = app_session.refresh_inventory()
+    assert status == 200
+    assert 'Refreshed 1 devices (1 unchanged, 1 removed, 0 failed)' in message
+    assert [query.url for queries in batch_get.call_args_list for query in queries.args[0]] == \
+        ['/pm/config/device/store3/global/system/interface']
+    assert [tuple(row)[1:] for row in storage.vlan_10_ips()] == [('store1', '10.0.0.1'), ('store3', '10.0.0.1')]
+
+def test_refresh_inventory_removes_devices_without_a_checksum(mocker, storage):
+    mocker.patch('app_session.client.batch_get', side_effect=fake_batch_get)
+    call = mocker.patch('app_session.client.call',
+                        return_value=device_list({'name': 'store1', 'checksum': 'a'}, {'name': 'store2'}))
+    assert app_session.refresh_inventory()[1] == 200
+    assert storage.device_revisions() == {'store1': 'a', 'store2': None}
+
+    # store2 left FortiManager, so its interfaces go with it
+    call.return_value = device_list({'name': 'store1', 'checksum': 'a'})
+    assert app_session.refresh_inventory()[1] == 200
+    assert [tuple(row)[1:] for row in storage.vlan_10_ips()] == [('store1', '10.0.0.1')]
+    assert storage.device_revisions() == {'store1': 'a'}
+
+def test_refresh_inventory_reports_api_errors(mocker, storage):
+    mocker.patch('app_session.client.call',
+                 return_value={'result': [{'status': {'code': -6, 'message': 'No permission'}}]})
+    assert app_session.refresh_inventory() == ("API error: No permission", 500)
+
+def test_interfaces_endpoint_pages_with_keyset_cursors(client, storage):
+    from fortimanager_common.storage import interface_row
+    rows = [interface_row(f'store{index % 3}', {'name': f'vlan{index}', 'vlanid': 10, 'ip': [f'10.0.{index}.1', '255.255.255.0']})
+            for index in range(7)]
+    storage.replace_devices(rows, [row[0] for row in rows], {}, [])
+    seen = []
+    after = ''
+    while True:
+        page = client.get(f'/interfaces?vlan=10&sort=ip&limit=3&after={after}').get_json()
+        seen += [item['ip'] for item in page['items']]
+        after = page['next']
+        if after is None:
+            break
+    assert seen == [f'10.0.{index}.1' for index in range(7)]
+    assert client.get('/interfaces?vlan=ten').status_code == 400
+    assert client.get('/interfaces?after=not-a-cursor').status_code == 400
+
+def test_export_ips_downloads_the_inventory_as_excel(client, storage):
+    from io import BytesIO
+    from openpyxl import load_workbook
+    from fortimanager_common.storage import interface_row
+    assert client.get('/export_ips').status_code == 404
+    assert client.get('/export_ips?export=bogus').status_code == 400
+    storage.replace_devices([interface_row('store1', {'name': 'vlan10', 'vlanid': 10, 'ip': ['10.0.0.1', '255.255.255.0']})],
+                            ['store1'], {}, [])
+    response = client.get('/export_ips?export=interfaces')
+    assert response.status_code == 200
+    sheet = load_workbook(BytesIO(response.data))['interfaces']
+    assert [cell.value for cell in sheet[2]][:4] == ['store1', 'vlan10', 10, '10.0.0.1']
+
+def test_fetch_ips_starts_a_background_refresh(client, mocker, storage):
+    storage.replace_devices([], [], {}, [])
+    request = mocker.patch('app_session.refresher.request', return_value=True)
+    response = client.post('/fetch_ips', data={'full': '1'})
+    assert response.status_code == 202
+    request.assert_called_once_with(full=True)
+    status = client.get('/refresh_status').get_json()
+    assert status['state'] == 'idle' and status['refreshed_at'] == storage.refreshed_at()
+
+def test_diagnostic_pages_reuse_cached_responses_until_refreshed(client, mocker):
+    mocker.patch.object(app_session.client.cache, 'ttl', 60)
+    app_session.client.cache.clear()
+    call = mocker.patch('app_session.client.call', side_effect=lambda method, params: {
+        'result': [{'status': {'code': 0, 'message': 'OK'}, 'url': entry['url']} for entry in params]})
+
+    response = client.get('/test_endpoints')
+    assert response.status_code == 200 and b'/sys/global' in response.data
+    # The eight endpoints fit in one batched call
+    probes = call.call_count
+    assert probes == 1 and len(call.call_args.args[1]) == 8
+    assert client.get('/test_endpoints').status_code == 200
+    assert call.call_count == probes
+    assert client.get('/test_endpoints?refresh=1').status_code == 200
+    assert call.call_count == 2 * probes
+    app_session.client.cache.clear()
@@ -0,0 +1,578 @@
+import os
+import csv
+import json
+import time
+import pytest
+import comparison_jobs
+from fortigate_config_comparator import (parse_config, compare_configs, split_statement, compare_fleet, load_config,
+                                         compare_fleet_drift, cluster_fleet, fleet_main)
+from fleet_drift import FleetDrift, NODE, ABSENT, store_indices
+from fleet_clusters import SimilarityIndex, config_signature, estimated_similarity, minhash_signature
+from object_refs import ReferenceIndex, referenced_differences
+from config_cache import ParseCache, file_sha256
+from ignore_rules import IgnoreRules
+from config_diff import Difference, CHANGED, MISSING_LEFT, MISSING_RIGHT, MOVED, render_differences
+from policy_diff import longest_increasing_subsequence
+from config_model import ConfigSection, ConfigEntry, ValueTable, blob_value
+
+SAMPLE_CONFIG = """#config-version=FGT61F-7.0.14-FW-build0601-240206:opmode=1:vdom=0:user=admin
+config system global
+    set admin-sport 2456
+    set hostname "IBR_SONIC-07993"
+end
+config firewall policy
+    edit 1
+        set name "Allow POS"
+        set srcintf "V100_POS"
+        set dstaddr "V200_POP_IP" "V300_MISC_IP"
+        unset icmptype
+    next
+end
+config router static
+    edit 1
+        config entries
+            edit "wan1"
+                set gateway 10.0.0.1
+            next
+        end
+    next
+end
+config system replacemsg http "url-block"
+    set buffer "<HTML><BODY>
+Site: %%URL%%
+</BODY></HTML>"
+end
+config system empty
+end
+"""
+
+@pytest.fixture
+def config():
+    return parse_config(SAMPLE_CONFIG.splitlines(keepends=True))
+
+def test_split_statement():
+    assert split_statement('set dstaddr "V200_POP_IP" "V300_MISC_IP"') == ['set', 'dstaddr', 'V200_POP_IP', 'V300_MISC_IP']
+    assert split_statement('set comments ""') == ['set', 'comments', '']
+    assert split_statement(r'set buffer "say \"hi\""') == ['set', 'buffer', 'say "hi"']
+    assert split_statement('set buffer "<html>') is None
+
+def test_parse_set_and_unset(config):
+    assert config['system global']['admin-sport'] == ('2456',)
+    policy = config['firewall policy']['1']
+    assert policy['dstaddr'] == ('V200_POP_IP', 'V300_MISC_IP')
+    assert policy['icmptype'] is None
+
+def test_parse_nested_config_blocks(config):
+    assert config['router static']['1']['entries']['wan1']['gateway'] == ('10.0.0.1',)
+
+def test_parse_multiline_value_keeps_only_digest(config):
+    assert config['system replacemsg http url-block']['buffer'] == (blob_value('<HTML><BODY>\nSite: %%URL%%\n</BODY></HTML>'),)
+
+def test_parse_long_and_encrypted_values_keep_only_digest():
+    image = 'iVBORw0KGgo' * 500
+    parsed = parse_config([
+        'config system replacemsg-image',
+        '    edit "logo_fw_auth"',
+        f'        set image-base64 "{image}"',
+        '        set password ENC SH2jKZ5B3TEkXTO8KeyJp==',
+        '    next',
+        'end',
+    ])
+    entry = parsed['system replacemsg-image']['logo_fw_auth']
+    assert entry['image-base64'] == (blob_value(image),)
+    assert entry['image-base64'][0].startswith(f'<blob {len(image)} chars ')
+    assert entry['password'] == ('ENC', blob_value('SH2jKZ5B3TEkXTO8KeyJp=='))
+
+def test_changed_certificate_is_detected():
+    certificate = 'set ca "-----BEGIN CERTIFICATE-----\nMIIDADCCAeigAwIBAgIgNjlF\n-----END CERTIFICATE-----"'
+    template = ['config vpn certificate ca', 'edit "Stores_CA2"', certificate, 'next', 'end']
+    store = ['config vpn certificate ca', 'edit "Stores_CA2"', certificate.replace('NjlF', 'NjlG'), 'next', 'end']
+    differences = compare_configs(parse_config(template), parse_config(store), IgnoreRules.from_file())
+    assert [difference.path for difference in differences] == [('vpn certificate ca', 'Stores_CA2', 'ca')]
+
+def test_parse_node_types(config):
+    assert isinstance(config['firewall policy'], ConfigSection)
+    assert isinstance(config['firewall policy']['1'], ConfigEntry)
+    assert isinstance(config['router static']['1']['entries'], ConfigSection)
+
+def test_values_are_shared_between_configs_of_one_batch(config, tmp_path):
+    values = ValueTable()
+    first = parse_config(SAMPLE_CONFIG.splitlines(), values)
+    second = parse_config(SAMPLE_CONFIG.splitlines(), values)
+    assert second['firewall policy']['1']['dstaddr'] is first['firewall policy']['1']['dstaddr']
+    # Without a table in common nothing outlives the parse
+    assert config['firewall policy']['1']['dstaddr'] is not first['firewall policy']['1']['dstaddr']
+
+    # Trees unpickled from the parse cache are pointed at the batch's values too
+    config_file = tmp_path / 'IBR_SONIC-07993.conf'
+    config_file.write_text(SAMPLE_CONFIG)
+    cache = ParseCache(str(tmp_path / 'cache'))
+    load_config(str(config_file), cache)
+    cached = load_config(str(config_file), cache, values)
+    assert cached['firewall policy']['1']['dstaddr'] is first['firewall policy']['1']['dstaddr']
+
+def test_empty_sections_are_dropped(config):
+    assert 'system empty' not in config
+
+def test_compare_nested_difference(config):
+    other = parse_config(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2').splitlines())
+    differences = compare_configs(config, other)
+    assert differences == [Difference(CHANGED, ('router static', '1', 'entries', 'wan1', 'gateway'), ('10.0.0.1',), ('10.0.0.2',))]
+
+def test_digest_matches_for_identical_subtrees(config):
+    other = parse_config(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2').splitlines())
+    assert config.digest != other.digest
+    assert config['firewall policy'].digest == other['firewall policy'].digest
+    assert config['router static'].digest != other['router static'].digest
+
+def test_digest_ignores_attribute_order():
+    first = parse_config(['config system global', 'set a 1', 'set b 2', 'end'])
+    second = parse_config(['config system global', 'set b 2', 'set a 1', 'end'])
+    assert first.digest == second.digest
+
+# Build a firewall policy table from (policy ID, name, action) tuples
+def policy_table(policies):
+    lines = ['config firewall policy']
+    for policy_id, name, action in policies:
+        lines += [f'    edit {policy_id}', f'        set name "{name}"', f'        set action {action}', '    next']
+    return parse_config(lines + ['end'])
+
+def test_digest_depends_on_policy_order():
+    first = policy_table([(1, 'a', 'accept'), (2, 'b', 'deny')])
+    second = policy_table([(2, 'b', 'deny'), (1, 'a', 'accept')])
+    assert first.digest != second.digest
+
+def test_longest_increasing_subsequence():
+    sequence = [3, 1, 2, 5, 4, 6]
+    indices = longest_increasing_subsequence(sequence)
+    assert len(indices) == 4
+    values = [sequence[index] for index in sorted(indices)]
+    assert values == sorted(values)
+    assert longest_increasing_subsequence([]) == set()
+
+def test_reordered_policies_report_fewest_moves():
+    first = policy_table([(1, 'a', 'accept'), (2, 'b', 'accept'), (3, 'c', 'accept'), (4, 'd', 'deny')])
+    second = policy_table([(4, 'd', 'deny'), (1, 'a', 'accept'), (2, 'b', 'accept'), (3, 'c', 'accept')])
+    assert compare_configs(first, second) == [Difference(MOVED, ('firewall policy', '4'), ('4',), ('1',))]
+
+def test_renumbered_policies_are_matched_by_name():
+    first = policy_table([(1, 'a', 'accept'), (2, 'b', 'accept')])
+    second = policy_table([(7, 'a', 'accept'), (9, 'b', 'deny')])
+    assert compare_configs(first, second) == [
+        Difference(CHANGED, ('firewall policy', '1', 'policyid'), ('1',), ('7',)),
+        Difference(CHANGED, ('firewall policy', '2', 'policyid'), ('2',), ('9',)),
+        Difference(CHANGED, ('firewall policy', '2', 'action'), ('accept',), ('deny',)),
+    ]
+
+def test_policies_are_matched_by_uuid_before_name():
+    first = parse_config(['config firewall policy', 'edit 1', 'set uuid u1', 'set name "old"', 'next',
+                          'edit 2', 'set uuid u2', 'set name "other"', 'next', 'end'])
+    second = parse_config(['config firewall policy', 'edit 2', 'set uuid u2', 'set name "other"', 'next',
+                           'edit 1', 'set uuid u1', 'set name "new"', 'next', 'end'])
+    differences = compare_configs(first, second)
+    assert Difference(CHANGED, ('firewall policy', '1', 'name'), ('old',), ('new',)) in differences
+    assert [difference.kind for difference in differences].count(MOVED) == 1
+
+def test_inserted_and_deleted_policies_are_not_moves():
+    first = policy_table([(1, 'a', 'accept'), (2, 'b', 'accept'), (3, 'c', 'accept')])
+    second = policy_table([(1, 'a', 'accept'), (5, 'new', 'accept'), (3, 'c', 'accept')])
+    differences = compare_configs(first, second)
+    assert {(difference.kind, difference.path) for difference in differences} == {
+        (MISSING_RIGHT, ('firewall policy', '2')),
+        (MISSING_LEFT, ('firewall policy', '5')),
+    }
+    text = ''.join(render_differences(compare_configs(policy_table([(1, 'a', 'accept'), (2, 'b', 'accept')]),
+                                                      policy_table([(2, 'b', 'accept'), (1, 'a', 'accept')])), 'A', 'B'))
+    assert "[Entry Moved]\n  Section: 'firewall policy'\n  Entry: '" in text
+
+def test_compare_missing_sections_and_keys(config):
+    other = parse_config(SAMPLE_CONFIG.replace('        unset icmptype\n', '').replace('config system global', 'config system settings').splitlines())
+    differences = compare_configs(config, other)
+    assert {(difference.kind, difference.path) for difference in differences} == {
+        (MISSING_RIGHT, ('system global',)),
+        (MISSING_RIGHT, ('firewall policy', '1', 'icmptype')),
+        (MISSING_LEFT, ('system settings',)),
+    }
+
+def test_render_text_matches_report_format(config):
+    other = parse_config(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2').replace('config system global', 'config system settings').splitlines())
+    text = ''.join(render_differences(compare_configs(config, other), 'A', 'B'))
+    assert "[Value Difference]\n  Section: 'router static > 1 > entries > wan1'\n  Key: 'gateway'\n  A: '10.0.0.1'\n  B: '10.0.0.2'\n" in text
+    assert "[Section Missing in B]\n  Section: 'system global' is in A but not in B\n" in text
+    assert "[Section Missing in A]\n  Section: 'system settings' is in B but not in A\n" in text
+
+@pytest.mark.parametrize('output_format', ['text', 'jsonl', 'csv', 'html'])
+def test_render_formats(config, output_format):
+    other = parse_config(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2').splitlines())
+    output = ''.join(render_differences(compare_configs(config, other), 'A', 'B', output_format))
+    assert '10.0.0.2' in output
+
+def test_render_jsonl_and_csv_keep_both_values_for_equal_names(config):
+    other = parse_config(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2').splitlines())
+    differences = compare_configs(config, other)
+    record = json.loads(''.join(render_differences(differences, 'IBR_SONIC-07993', 'IBR_SONIC-07993', 'jsonl')))
+    assert (record['left'], record['right']) == (['10.0.0.1'], ['10.0.0.2'])
+    rows = list(csv.DictReader(''.join(render_differences(differences, 'IBR_SONIC-07993', 'IBR_SONIC-07993', 'csv')).splitlines()))
+    assert (rows[0]['left'], rows[0]['right'], rows[0]['left_name']) == ('10.0.0.1', '10.0.0.2', 'IBR_SONIC-07993')
+
+def test_render_unknown_format():
+    with pytest.raises(ValueError):
+        render_differences([], 'A', 'B', 'xml')
+
+def test_compare_identical_configs(config):
+    assert compare_configs(config, parse_config(SAMPLE_CONFIG.splitlines())) == []
+
+def test_compare_fleet_writes_diff_per_store_and_summary(tmp_path):
+    template = tmp_path / 'TEMPLATE.conf'
+    template.write_text(SAMPLE_CONFIG)
+    (tmp_path / 'IBR_SONIC-00001.conf').write_text(SAMPLE_CONFIG)
+    (tmp_path / 'IBR_SONIC-00002.conf').write_text(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2'))
+    stores = [str(tmp_path / 'IBR_SONIC-00001.conf'), str(tmp_path / 'IBR_SONIC-00002.conf'), str(tmp_path / 'missing.conf')]
+
+    results, summary_file = compare_fleet(str(template), stores, str(tmp_path / 'out'), workers=1)
+
+    assert [result['difference_count'] for result in results] == [0, 1, '']
+    assert 'File not found' in results[2]['error']
+    lines = (tmp_path / 'out' / 'IBR_SONIC-00002.jsonl').read_text().splitlines()
+    assert json.loads(lines[0]) == {'kind': 'changed', 'path': ['router static', '1', 'entries', 'wan1', 'gateway'],
+                                    'left_name': 'TEMPLATE', 'right_name': 'IBR_SONIC-00002',
+                                    'left': ['10.0.0.1'], 'right': ['10.0.0.2']}
+    with open(summary_file, newline='') as file:
+        assert len(list(csv.DictReader(file))) == 3
+
+def test_fleet_drift_reports_outliers_against_the_majority(config):
+    ip_changed = parse_config(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2').splitlines())
+    no_routes = parse_config(SAMPLE_CONFIG.replace('config router static', 'config router bgp').splitlines())
+    drift = FleetDrift()
+    for store in (config, parse_config(SAMPLE_CONFIG.splitlines()), ip_changed, config, no_routes):
+        drift.add(store)
+
+    drifts = {path: [(value, store_indices(stores)) for value, stores in histogram]
+              for path, histogram in drift.drifts()}
+    assert drifts == {
+        ('router static',): [(NODE, [0, 1, 2, 3]), (ABSENT, [4])],
+        ('router static', '1', 'entries', 'wan1', 'gateway'): [(('10.0.0.1',), [0, 1, 3]), (('10.0.0.2',), [2])],
+        ('router bgp',): [(ABSENT, [0, 1, 2, 3]), (NODE, [4])],
+    }
+
+def test_fleet_drift_skips_ignored_values(config):
+    drift = FleetDrift(IgnoreRules([('key', 'hostname')]))
+    drift.add(config)
+    drift.add(parse_config(SAMPLE_CONFIG.replace('IBR_SONIC-07993', 'IBR_SONIC-00001').splitlines()))
+    assert list(drift.drifts()) == []
+
+def test_compare_fleet_drift_writes_outliers_and_summary(tmp_path):
+    stores = []
+    for number, gateway in enumerate(['10.0.0.1', '10.0.0.1', '10.0.0.9'], 1):
+        path = tmp_path / f'IBR_SONIC-0000{number}.conf'
+        path.write_text(SAMPLE_CONFIG.replace('10.0.0.1', gateway))
+        stores.append(str(path))
+    stores.append(str(tmp_path / 'missing.conf'))
+
+    drifts, results, drift_file, summary_file = compare_fleet_drift(stores, str(tmp_path / 'out'), workers=1)
+
+    assert [result['outlier_count'] for result in results] == [0, 0, 1, '']
+    assert json.loads(open(drift_file).read()) == {
+        'path': ['router static', '1', 'entries', 'wan1', 'gateway'], 'majority': '10.0.0.1', 'majority_count': 2,
+        'outliers': [{'value': '10.0.0.9', 'stores': ['IBR_SONIC-00003']}]}
+    with open(summary_file, newline='') as file:
+        assert len(list(csv.DictReader(file))) == 4
+
+def test_minhash_similarity_estimates_jaccard_similarity():
+    features1 = set(range(1000))
+    features2 = set(range(200, 1200))
+    hashes1 = {hash(('feature', value)) % (1 << 64) for value in features1}
+    hashes2 = {hash(('feature', value)) % (1 << 64) for value in features2}
+    similarity = estimated_similarity(minhash_signature(hashes1), minhash_signature(hashes2))
+    assert abs(similarity - 800 / 1200) < 0.15
+    assert minhash_signature(hashes1) == minhash_signature(set(hashes1))
+    assert len(minhash_signature({1, 2})) == 128
+
+def test_similarity_index_clusters_stores_and_picks_medoids(config):
+    rules = IgnoreRules([('key', 'hostname')])
+    other_template = "\n".join(f"config firewall address\n    edit \"a{number}\"\n        set subnet 10.{number}.0.0 255.255.0.0\n    next\nend"
+                               for number in range(40))
+    stores = [config, parse_config(SAMPLE_CONFIG.replace('IBR_SONIC-07993', 'IBR_SONIC-00001').splitlines()),
+              parse_config(other_template.splitlines()), parse_config(other_template.replace('10.39.', '10.99.').splitlines())]
+    index = SimilarityIndex(threshold=0.5)
+    for store in stores:
+        index.add(config_signature(store, rules))
+
+    clusters = index.clusters()
+    assert sorted(sorted(cluster.members) for cluster in clusters) == [[0, 1], [2, 3]]
+    for cluster in clusters:
+        assert cluster.medoid in cluster.members
+        assert cluster.similarity[cluster.members.index(cluster.medoid)] == 1.0
+
+def test_cluster_fleet_writes_membership_with_medoids(tmp_path):
+    stores = []
+    for number in range(1, 4):
+        path = tmp_path / f'IBR_SONIC-0000{number}.conf'
+        path.write_text(SAMPLE_CONFIG.replace('IBR_SONIC-07993', f'IBR_SONIC-0000{number}'))
+        stores.append(str(path))
+    stores.append(str(tmp_path / 'missing.conf'))
+
+    clusters, results, clusters_file = cluster_fleet(stores, str(tmp_path / 'out'), IgnoreRules([('key', 'hostname')]),
+                                                     workers=1)
+
+    assert len(clusters) == 1 and sorted(clusters[0].members) == stores[:3]
+    assert [result['cluster'] for result in results] == [1, 1, 1, '']
+    assert 'File not found' in results[3]['error']
+    with open(clusters_file, newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert {row['medoid'] for row in rows[:3]} == {os.path.basename(clusters[0].medoid)[:-5]}
+
+OBJECTS_CONFIG = """config system interface
+    edit "V100_POS"
+        set ip 10.1.0.1 255.255.255.0
+    next
+end
+config firewall address
+    edit "POS_1"
+        set subnet 10.1.0.10 255.255.255.255
+    next
+    edit "POS_2"
+        set subnet 10.1.0.11 255.255.255.255
+    next
+    edit "UNUSED"
+        set subnet 10.9.0.1 255.255.255.255
+    next
+end
+config firewall addrgrp
+    edit "POS_ALL"
+        set member "POS_1" "POS_GROUP"
+    next
+    edit "POS_GROUP"
+        set member "POS_2" "POS_1"
+    next
+end
+config firewall service custom
+    edit "HTTPS"
+        set tcp-portrange 443
+    next
+end
+config firewall policy
+    edit 1
+        set srcintf "V100_POS"
+        set dstintf "wan1"
+        set srcaddr "POS_ALL"
+        set dstaddr "all"
+        set service "HTTPS"
+    next
+    edit 2
+        set srcintf "V100_POS"
+        set srcaddr "POS_2"
+        set service "HTTPS"
+    next
+end
+"""
+
+def test_reference_index_links_policies_groups_and_objects():
+    index = ReferenceIndex(parse_config(OBJECTS_CONFIG.splitlines()))
+    assert index.expand('address', 'POS_ALL') == [('address', 'POS_1'), ('address', 'POS_2')]
+    assert index.expand('address', 'POS_1') == [('address', 'POS_1')]
+    assert sorted(index.policies_using('address', 'POS_2')) == [('firewall policy', '1'), ('firewall policy', '2')]
+    assert index.used_by('address', 'POS_GROUP') == [('firewall addrgrp', 'POS_ALL')]
+    assert index.policies_using('interface', 'V100_POS') == [('firewall policy', '1'), ('firewall policy', '2')]
+    assert index.references[('firewall policy', '2')] == [('address', 'POS_2'), ('service', 'HTTPS'), ('interface', 'V100_POS')]
+    assert index.objects[('address', 'POS_GROUP')] == ('firewall addrgrp', 'POS_GROUP')
+    assert not index.is_referenced('address', 'UNUSED')
+
+def test_reference_index_expands_every_group_of_a_cycle_fully():
+    config = parse_config("""config firewall addrgrp
+    edit "GROUP_A"
+        set member "GROUP_B" "HOST_A"
+    next
+    edit "GROUP_B"
+        set member "GROUP_A" "HOST_B"
+    next
+end
+""".splitlines())
+    index = ReferenceIndex(config)
+    assert sorted(index.expand('address', 'GROUP_A')) == [('address', 'HOST_A'), ('address', 'HOST_B')]
+    # GROUP_B was expanded as part of GROUP_A's cycle, and still reaches HOST_A
+    assert sorted(index.expand('address', 'GROUP_B')) == [('address', 'HOST_A'), ('address', 'HOST_B')]
+
+def test_referenced_differences_flag_only_objects_in_use():
+    config1 = parse_config(OBJECTS_CONFIG.splitlines())
+    config2 = parse_config(OBJECTS_CONFIG.replace('10.1.0.11', '10.1.0.12').replace('10.9.0.1', '10.9.0.2')
+                           .replace('443', '8443').splitlines())
+    differences = compare_configs(config1, config2)
+    assert len(differences) == 3
+
+    flagged = referenced_differences(differences, config1, config2)
+    assert [(item.kind, item.name) for item in flagged] == [('address', 'POS_2'), ('service', 'HTTPS')]
+    assert sorted(flagged[0].policies1) == [('firewall policy', '1'), ('firewall policy', '2')]
+
+def test_compare_fleet_keeps_stores_with_the_same_file_name_apart(tmp_path):
+    template = tmp_path / 'TEMPLATE.conf'
+    template.write_text(SAMPLE_CONFIG)
+    stores = []
+    for region, gateway in (('east', '10.0.0.2'), ('west', '10.0.0.3')):
+        (tmp_path / region).mkdir()
+        store = tmp_path / region / 'IBR_SONIC-00001.conf'
+        store.write_text(SAMPLE_CONFIG.replace('10.0.0.1', gateway))
+        stores.append(str(store))
+
+    results, _ = compare_fleet(str(template), stores + stores[:1], str(tmp_path / 'out'), workers=1)
+
+    diff_files = [result['diff_file'] for result in results]
+    assert len(set(diff_files)) == 3
+    assert '10.0.0.3' in open(diff_files[1]).read() and '10.0.0.3' not in open(diff_files[0]).read()
+
+@pytest.mark.parametrize('argv', [['--cluster', '--format', 'csv', 'stores'], ['--threshold', '0.5', '--drift', 'stores'],
+                                  ['--drift', '--format', 'html', 'stores'], ['stores'],
+                                  ['--drift', '--template', 'golden.conf', 'stores'],
+                                  ['--cluster', '--template', 'golden.conf', 'stores']])
+def test_fleet_main_rejects_options_the_mode_ignores(argv):
+    with pytest.raises(SystemExit):
+        fleet_main(argv)
+
+def test_parse_cache_reuses_parsed_config(tmp_path, mocker):
+    config_file = tmp_path / 'store.conf'
+    config_file.write_text(SAMPLE_CONFIG)
+    cache = ParseCache(str(tmp_path / 'cache'))
+
+    first = load_config(str(config_file), cache)
+    parse = mocker.patch('fortigate_config_comparator.parse_config')
+    second = load_config(str(config_file), cache)
+
+    parse.assert_not_called()
+    assert second.digest == first.digest
+    assert second['router static']['1']['entries']['wan1']['gateway'] == ('10.0.0.1',)
+
+def test_parse_cache_misses_on_changed_content(tmp_path):
+    config_file = tmp_path / 'store.conf'
+    config_file.write_text(SAMPLE_CONFIG)
+    cache = ParseCache(str(tmp_path / 'cache'))
+    first = load_config(str(config_file), cache)
+
+    config_file.write_text(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2'))
+    second = load_config(str(config_file), cache)
+
+    assert second.digest != first.digest
+    assert len(list((tmp_path / 'cache').glob('*.pickle'))) == 2
+
+def test_parse_cache_evicts_least_recently_used(tmp_path):
+    cache = ParseCache(str(tmp_path / 'cache'))
+    config_files = []
+    for index in range(3):
+        config_file = tmp_path / f'store{index}.conf'
+        config_file.write_text(SAMPLE_CONFIG.replace('10.0.0.1', f'10.0.0.{index}'))
+        config_files.append(config_file)
+
+    load_config(str(config_files[0]), cache)
+    entry_size = next((tmp_path / 'cache').glob('*.pickle')).stat().st_size
+    cache.max_bytes = entry_size * 2 + entry_size // 2
+    load_config(str(config_files[1]), cache)
+    load_config(str(config_files[2]), cache)
+
+    entries = list((tmp_path / 'cache').glob('*.pickle'))
+    assert len(entries) == 2
+    assert not any(entry.name.endswith(file_sha256(str(config_files[0])) + '.pickle') for entry in entries)
+
+def test_ignore_rules_skip_keys_paths_and_values(config):
+    other = parse_config(SAMPLE_CONFIG.replace('IBR_SONIC-07993', 'IBR_SONIC-07997')
+                         .replace('10.0.0.1', '10.0.0.2')
+                         .replace('set admin-sport 2456', 'set admin-sport 443\n    set password ENC abc123')
+                         .splitlines())
+    rules = IgnoreRules.parse([
+        '# comment',
+        'key hostname',
+        'path router static > *',
+        'value ENC *',
+    ])
+    differences = compare_configs(config, other, rules)
+    assert [difference.path for difference in differences] == [('system global', 'admin-sport')]
+
+def test_ignore_rules_regex_and_invalid_rule():
+    rules = IgnoreRules.parse(['regex ^firewall policy > \\d+ > comments$'])
+    assert rules.ignores('comments', 'firewall policy > 12')
+    assert not rules.ignores('comments', 'firewall address > 12')
+    with pytest.raises(ValueError):
+        IgnoreRules.parse(['keys hostname'])
+
+def test_default_ignore_rules_file():
+    rules = IgnoreRules.from_file()
+    assert rules.ignores('hostname')
+    assert rules.ignores('psksecret', 'vpn ipsec phase1-interface > Azure_East_PRM')
+    assert rules.ignores('vpn certificate local', '', ConfigSection('vpn certificate local'))
+    # Key rules match attribute names only, never whole sections or entries
+    assert not rules.ignores('system password-policy', '', ConfigSection('system password-policy'))
+    assert rules.ignores('hostname', 'waf profile > default > constraint')
+    assert not rules.ignores('hostname', 'waf profile > default > constraint', ConfigSection('hostname'))
+    assert rules.ignores_value(('ENC', 'abc'))
+    assert not rules.ignores('admin-sport', 'system global', ('2456',))
+
+def test_comparison_job_reports_status_and_writes_result(tmp_path):
+    left = tmp_path / 'IBR_SONIC-1_7-0.conf'
+    right = tmp_path / 'IBR_SONIC-2_7-0.conf'
+    left.write_text(SAMPLE_CONFIG)
+    right.write_text(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2'))
+    job_dir = tmp_path / 'job'
+    job_dir.mkdir()
+    comparison_jobs._init_job_worker(None, None)
+
+    assert comparison_jobs.run_comparison_job(str(job_dir), str(left), str(right))
+    status = comparison_jobs.read_status(str(job_dir))
+    assert status['state'] == comparison_jobs.DONE and status['difference_count'] == 1
+    assert "IBR_SONIC-2: '10.0.0.2'" in (job_dir / status['diff_file']).read_text()
+
+    assert not comparison_jobs.run_comparison_job(str(job_dir), str(left), str(tmp_path / 'missing.conf'))
+    assert comparison_jobs.read_status(str(job_dir))['state'] == comparison_jobs.FAILED
+
+def test_comparison_job_records_cancelled_future(tmp_path):
+    from concurrent.futures import Future
+    jobs = comparison_jobs.ComparisonJobs(str(tmp_path / 'jobs'))
+    job_dir = tmp_path / 'jobs' / 'job'
+    job_dir.mkdir()
+    jobs._pending = 1
+    future = Future()
+    future.cancel()
+    jobs._finished(future, str(job_dir))
+    assert jobs._pending == 0
+    assert comparison_jobs.read_status(str(job_dir))['state'] == comparison_jobs.FAILED
+
+def test_comparison_jobs_replace_a_pool_whose_worker_died(tmp_path):
+    import os
+    import signal
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    left = tmp_path / 'IBR_SONIC-1_7-0.conf'
+    right = tmp_path / 'IBR_SONIC-2_7-0.conf'
+    left.write_text(SAMPLE_CONFIG)
+    right.write_text(SAMPLE_CONFIG.replace('10.0.0.1', '10.0.0.2'))
+    jobs = comparison_jobs.ComparisonJobs(str(tmp_path / 'jobs'), workers=1, cache_dir=None)
+    try:
+        # Kill the only worker, as the OOM killer would, and wait for the pool to notice
+        executor = jobs._pool()
+        os.kill(executor.submit(os.getpid).result(), signal.SIGKILL)
+        with pytest.raises(BrokenProcessPool):
+            for _ in range(500):
+                executor.submit(os.getpid).result()
+
+        job_id = jobs.submit(lambda job_dir: (str(left), str(right)))
+        assert jobs._executor is not executor
+        for _ in range(1000):
+            if jobs.status(job_id)['state'] in (comparison_jobs.DONE, comparison_jobs.FAILED):
+                break
+            time.sleep(0.01)
+        assert jobs.status(job_id)['state'] == comparison_jobs.DONE
+
+        # A job whose worker died fails, and the next job gets a new pool
+        job_dir = tmp_path / 'jobs' / 'job'
+        job_dir.mkdir()
+        jobs._pending += 1
+        future = Future()
+        future.set_exception(BrokenProcessPool('A process in the process pool was terminated abruptly'))
+        jobs._finished(future, str(job_dir), jobs._executor)
+        assert jobs._executor is None
+        assert comparison_jobs.read_status(str(job_dir))['state'] == comparison_jobs.FAILED
+    finally:
+        jobs.shutdown()
+
+def test_comparison_jobs_reject_beyond_max_pending(tmp_path):
+    jobs = comparison_jobs.ComparisonJobs(str(tmp_path), max_pending=0)
+    with pytest.raises(comparison_jobs.QueueFull):
+        jobs.submit(lambda job_dir: None)
+    assert jobs.status('../etc') is None